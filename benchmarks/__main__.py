@@ -0,0 +1,166 @@
+"""
+Throughput and memory benchmarks of the policies and environments on synthetic ER instances (no data needed), e.g.
+    python -m benchmarks run --output benchmarks/results.json --sizes 10x30 100x100 --no_cuda
+    python -m benchmarks compare benchmarks/baseline.json benchmarks/results.json --tolerance 0.1
+    python -m benchmarks memory --models gnn attention --v_sizes 30 60 100 --batch_sizes 16 32 --budget_gb 16
+    python -m benchmarks distributed --model ff-hist --size 10x60 --world_sizes 1 2 4
+compare exits with status 1 if any benchmark regressed, so it can gate CI.
+"""
+import sys
+import argparse
+
+from benchmarks.throughput import MODELS, PROBLEMS, SIZES, MODES, run_benchmarks
+from benchmarks.compare import compare_results
+from benchmarks.memory import MEMORY_MODELS, run_memory_report
+from benchmarks.distributed import run_scaling
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Policy and environment benchmarks")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    run = commands.add_parser("run", help="Run the benchmarks and write their results")
+    run.add_argument("--models", nargs="+", default=MODELS, help="Models to benchmark")
+    run.add_argument(
+        "--problems",
+        nargs="+",
+        default=PROBLEMS,
+        help="Problems to benchmark",
+    )
+    run.add_argument(
+        "--sizes",
+        nargs="+",
+        default=SIZES,
+        help="Sizes of U and V, as UxV",
+    )
+    run.add_argument(
+        "--modes",
+        nargs="+",
+        default=MODES,
+        choices=MODES,
+        help="train (sampling and backward) and/or eval (greedy)",
+    )
+    run.add_argument("--batch_size", type=int, default=32, help="Instances per batch")
+    run.add_argument(
+        "--num_batches",
+        type=int,
+        default=5,
+        help="Timed batches, after a warm-up batch",
+    )
+    run.add_argument(
+        "--edge_prob",
+        type=float,
+        default=0.1,
+        help="Edge probability of the ER graphs",
+    )
+    run.add_argument(
+        "--seed",
+        type=int,
+        default=1234,
+        help="Random seed of the instances and models",
+    )
+    run.add_argument("--no_cuda", action="store_true", help="Benchmark on CPU")
+    run.add_argument(
+        "--output",
+        default="benchmarks/results.json",
+        help="JSON file to write the results to",
+    )
+
+    compare = commands.add_parser(
+        "compare", help="Flag throughput regressions against a baseline run"
+    )
+    compare.add_argument("baseline", help="JSON results of the baseline run")
+    compare.add_argument("results", help="JSON results to compare")
+    compare.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative drop in instances/s flagged as a regression",
+    )
+
+    memory = commands.add_parser(
+        "memory", help="Peak memory of a training step per model and graph size"
+    )
+    memory.add_argument(
+        "--models", nargs="+", default=MEMORY_MODELS, help="Models to measure"
+    )
+    memory.add_argument("--problem", default="e-obm", help="Problem to measure")
+    memory.add_argument("--u_sizes", type=int, nargs="+", default=[10, 100])
+    memory.add_argument("--v_sizes", type=int, nargs="+", default=[30, 60, 100, 200])
+    memory.add_argument("--batch_sizes", type=int, nargs="+", default=[16, 32])
+    memory.add_argument(
+        "--budget_gb",
+        type=float,
+        default=16,
+        help="RAM budget of the largest batch sizes, in GiB",
+    )
+    memory.add_argument(
+        "--edge_prob",
+        type=float,
+        default=0.1,
+        help="Edge probability of the ER graphs",
+    )
+    memory.add_argument("--seed", type=int, default=1234, help="Random seed")
+    memory.add_argument("--no_cuda", action="store_true", help="Measure on CPU")
+    memory.add_argument(
+        "--output",
+        default="benchmarks/memory.json",
+        help="JSON file to write the results to",
+    )
+
+    distributed = commands.add_parser(
+        "distributed",
+        help="Training throughput of --distributed training per number of CPU processes",
+    )
+    distributed.add_argument("--model", default="ff-hist", help="Model to train")
+    distributed.add_argument("--problem", default="e-obm", help="Problem to train on")
+    distributed.add_argument("--size", default="10x60", help="Size of U and V, as UxV")
+    distributed.add_argument(
+        "--world_sizes",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Numbers of processes to compare, the first one is the reference of the speedup",
+    )
+    distributed.add_argument(
+        "--batch_size", type=int, default=32, help="Instances per batch of every process"
+    )
+    distributed.add_argument(
+        "--num_batches",
+        type=int,
+        default=10,
+        help="Timed batches per process, after a warm-up batch",
+    )
+    distributed.add_argument(
+        "--edge_prob",
+        type=float,
+        default=0.1,
+        help="Edge probability of the ER graphs",
+    )
+    distributed.add_argument("--seed", type=int, default=1234, help="Random seed")
+    distributed.add_argument(
+        "--output",
+        default="benchmarks/distributed.json",
+        help="JSON file to write the results to",
+    )
+    # gloo data-parallel training runs on CPU
+    distributed.set_defaults(no_cuda=True)
+
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.command == "run":
+        run_benchmarks(args)
+    elif args.command == "memory":
+        run_memory_report(args)
+    elif args.command == "distributed":
+        run_scaling(args)
+    elif compare_results(args.baseline, args.results, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import json
+
+
+def _key(result):
+    return result["model"], result["problem"], result["size"], result["mode"]
+
+
+def load_results(path):
+    with open(path, "r") as f:
+        results = json.load(f)["results"]
+    return {_key(r): r for r in results if "error" not in r}
+
+
+def compare_results(baseline_path, results_path, tolerance=0.1):
+    """
+    Compares the throughput of a benchmark run to a stored baseline run, a combination regressed if its
+    instances per second dropped by more than the tolerance (relative). Returns the regressed combinations.
+    """
+    baseline = load_results(baseline_path)
+    results = load_results(results_path)
+    regressions = []
+    for key in sorted(baseline.keys() & results.keys()):
+        before = baseline[key]["instances_per_sec"]
+        after = results[key]["instances_per_sec"]
+        change = after / before - 1.0
+        regressed = change < -tolerance
+        if regressed:
+            regressions.append(key)
+        print(
+            "{:>14} {:>8} {:>9} {:>6}: {:10.1f} -> {:10.1f} instances/s ({:+6.1%}){}".format(
+                *key, before, after, change, "  REGRESSION" if regressed else ""
+            )
+        )
+    for key in sorted(baseline.keys() - results.keys()):
+        print("{:>14} {:>8} {:>9} {:>6}: missing from the results".format(*key))
+    print(
+        "{} regressions of more than {:.0%} in {} compared benchmarks".format(
+            len(regressions), tolerance, len(baseline.keys() & results.keys())
+        )
+    )
+    return regressions
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import socket
+import torch
+import torch.optim as optim
+import torch.multiprocessing as mp
+from torch_geometric.data import DataLoader as geoDataloader
+
+from train import set_decode_type, train_batch
+from utils.functions import load_problem, move_to
+from utils.distributed import (
+    init_distributed,
+    broadcast_parameters,
+    all_reduce_max,
+)
+from utils.reinforce_baselines import NoBaseline
+from benchmarks.synthetic import make_er_dataset
+from benchmarks.throughput import make_opts, make_model
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _train_rank(rank, world_size, port, args, results):
+    """
+    Trains args.num_batches batches of this rank's own instances after a warm-up batch, with the gradients
+    averaged over the ranks as in --distributed training. Rank 0 reports the duration of the slowest rank.
+    """
+    os.environ.update(
+        MASTER_ADDR="127.0.0.1",
+        MASTER_PORT=str(port),
+        RANK=str(rank),
+        WORLD_SIZE=str(world_size),
+    )
+    u_size, v_size = map(int, args.size.split("x"))
+    opts = make_opts(args.model, args.problem, u_size, v_size, args)
+    opts.distributed = True
+    opts.dataset_size = args.batch_size * world_size
+    init_distributed(opts)
+    problem = load_problem(args.problem)
+    dataset = make_er_dataset(
+        args.problem,
+        u_size,
+        v_size,
+        args.batch_size * (args.num_batches + 1),
+        args.edge_prob,
+        args.seed + rank,
+    )
+    batches = [
+        move_to(batch, opts.device)
+        for batch in geoDataloader(dataset, batch_size=args.batch_size)
+    ]
+    torch.manual_seed(args.seed)
+    model = make_model(opts, problem)
+    broadcast_parameters(model)
+    set_decode_type(model, "sampling")
+    model.train()
+    optimizers = [optim.Adam(model.parameters(), lr=opts.lr_model)]
+    baseline = NoBaseline()
+
+    # step 1 is never a logging step
+    train_batch(model, optimizers, baseline, 0, 0, 1, batches[0], None, opts)
+    torch.distributed.barrier()
+    start = time.perf_counter()
+    for batch_id, batch in enumerate(batches[1:]):
+        train_batch(model, optimizers, baseline, 0, batch_id, 1, batch, None, opts)
+    duration = all_reduce_max(torch.tensor(time.perf_counter() - start)).item()
+    if rank == 0:
+        results.put(duration)
+    torch.distributed.destroy_process_group()
+
+
+def run_scaling(args):
+    """
+    Training throughput of --distributed data-parallel training on CPU for every number of processes in
+    args.world_sizes, with the speedup and scaling efficiency over the first one. Written to args.output as JSON.
+    """
+    ctx = mp.get_context("spawn")
+    results = []
+    for world_size in args.world_sizes:
+        queue = ctx.SimpleQueue()
+        mp.start_processes(
+            _train_rank,
+            args=(world_size, _free_port(), args, queue),
+            nprocs=world_size,
+            start_method="spawn",
+        )
+        duration = queue.get()
+        result = {
+            "world_size": world_size,
+            "threads_per_rank": max(1, os.cpu_count() // world_size),
+            "instances_per_sec": world_size
+            * args.batch_size
+            * args.num_batches
+            / duration,
+        }
+        result["speedup"] = result["instances_per_sec"] / (
+            results[0]["instances_per_sec"] if results else result["instances_per_sec"]
+        )
+        result["efficiency"] = (
+            result["speedup"] * args.world_sizes[0] / world_size
+        )
+        print(
+            "{world_size} processes ({threads_per_rank} threads each): {instances_per_sec:.1f} instances/s, "
+            "speedup {speedup:.2f}x, efficiency {efficiency:.0%}".format(**result)
+        )
+        results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "model": args.model,
+                "problem": args.problem,
+                "size": args.size,
+                "batch_size": args.batch_size,
+                "num_batches": args.num_batches,
+                "cpu_count": os.cpu_count(),
+                "results": results,
+            },
+            f,
+            indent=True,
+        )
+    print("Results written to {}".format(args.output))
+    return results
@@ -0,0 +1,248 @@
+import json
+import resource
+import numpy as np
+import torch
+import multiprocessing as mp
+import torch.optim as optim
+from torch.profiler import profile, ProfilerActivity
+from torch_geometric.data import DataLoader as geoDataloader
+
+from train import set_decode_type, train_batch
+from utils.functions import load_problem, move_to
+from utils.profiling import start_phases, stop_phases
+from utils.reinforce_baselines import NoBaseline
+from benchmarks.synthetic import make_er_dataset
+from benchmarks.throughput import make_opts, make_model
+
+MEMORY_MODELS = ["gnn", "gnn-hist", "gnn-simp-hist", "attention"]
+
+
+def _max_rss():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _memory_usage(event, use_cuda):
+    if not use_cuda:
+        return event.cpu_memory_usage
+    return getattr(event, "device_memory_usage", None) or event.cuda_memory_usage
+
+
+def allocator_peaks(events, phases, use_cuda):
+    """
+    Replays the allocations and frees recorded by the profiler. Returns the peak of the live tensor memory of the
+    step and, for every phase, the largest increase of the live memory within one of its ranges.
+    """
+    memory = sorted(
+        (e.time_range.start, _memory_usage(e, use_cuda))
+        for e in events
+        if e.name == "[memory]"
+    )
+    times = np.array([t for t, _ in memory])
+    live = np.cumsum([m for _, m in memory]) if memory else np.zeros(0)
+    peak = int(max(live.max(initial=0), 0))
+    phase_peaks = {}
+    for e in events:
+        if e.name not in phases:
+            continue
+        first, last = np.searchsorted(times, [e.time_range.start, e.time_range.end])
+        if first == last:
+            continue
+        before = live[first - 1] if first > 0 else 0
+        increase = int(live[first:last].max() - before)
+        phase_peaks[e.name] = max(phase_peaks.get(e.name, 0), increase)
+    return peak, phase_peaks
+
+
+def measure_step(model_name, problem_name, u_size, v_size, batch_size, args):
+    """
+    Peak memory of one training step (sampling rollout, backward and update) of a grid point.
+    Runs in a fresh process, so that the peak RSS is the one of this step.
+    """
+    args.batch_size = batch_size
+    opts = make_opts(model_name, problem_name, u_size, v_size, args)
+    problem = load_problem(problem_name)
+    dataset = make_er_dataset(
+        problem_name, u_size, v_size, batch_size, args.edge_prob, args.seed
+    )
+    batch = move_to(
+        next(iter(geoDataloader(dataset, batch_size=batch_size))), opts.device
+    )
+    torch.manual_seed(args.seed)
+    model = make_model(opts, problem)
+    set_decode_type(model, "sampling")
+    model.train()
+    optimizers = [optim.Adam(model.parameters(), lr=opts.lr_model)]
+
+    activities = [ProfilerActivity.CPU]
+    if opts.use_cuda:
+        activities.append(ProfilerActivity.CUDA)
+        torch.cuda.reset_peak_memory_stats(opts.device)
+    rss_before = _max_rss()
+    timers = start_phases()
+    with profile(activities=activities, profile_memory=True) as prof:
+        train_batch(model, optimizers, NoBaseline(), 0, 0, 1, batch, None, opts)
+    stop_phases()
+    peak, phase_peaks = allocator_peaks(prof.events(), set(timers), opts.use_cuda)
+    if opts.use_cuda:
+        peak = torch.cuda.max_memory_allocated(opts.device)
+    return {
+        "rss_before": rss_before,
+        "peak_rss": _max_rss(),
+        "peak_allocated": peak,
+        "phases": phase_peaks,
+    }
+
+
+def _measure_in_child(conn, *point):
+    try:
+        conn.send(measure_step(*point))
+    except Exception as e:
+        conn.send({"error": "{}: {}".format(type(e).__name__, e)})
+    conn.close()
+
+
+def measure_in_process(*point):
+    ctx = mp.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_measure_in_child, args=(child_conn, *point))
+    p.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:  # Killed, most likely out of memory
+        result = {"error": "killed"}
+    p.join()
+    if p.exitcode != 0 and "error" not in result:
+        result = {"error": "exit code {}".format(p.exitcode)}
+    return result
+
+
+def fit_exponents(points):
+    """
+    Least squares fit of log(peak allocated) = c + a * log(u_size) + b * log(v_size) + g * log(batch_size) over
+    the grid points of a model, only for the dimensions the grid varies.
+    """
+    dims = [
+        d
+        for d in ("u_size", "v_size", "batch_size")
+        if len({p[d] for p in points}) > 1
+    ]
+    if not dims:
+        return {}
+    X = np.array([[1.0] + [np.log(p[d]) for d in dims] for p in points])
+    y = np.log([p["peak_allocated"] for p in points])
+    coef = np.linalg.lstsq(X, y, rcond=None)[0]
+    return dict(zip(dims, coef[1:].tolist()))
+
+
+def max_batch_size(points, budget):
+    """
+    Largest batch size whose peak RSS fits in the budget (bytes), from a linear fit of the peak RSS in the batch
+    size. With a single batch size, the memory of the process before the step is taken as the fixed part.
+    """
+    sizes = np.array([p["batch_size"] for p in points], dtype=float)
+    rss = np.array([p["peak_rss"] for p in points], dtype=float)
+    if len(set(sizes)) > 1:
+        slope, intercept = np.polyfit(sizes, rss, 1)
+    else:
+        intercept = np.mean([p["rss_before"] for p in points])
+        slope = (rss.mean() - intercept) / sizes[0]
+    if slope <= 0:
+        return None
+    return max(int((budget - intercept) // slope), 0)
+
+
+def format_point(point):
+    phases = sorted(point["phases"].items(), key=lambda kv: -kv[1])
+    return "peak RSS {:.1f} MiB, peak allocated {:.1f} MiB (phases: {})".format(
+        point["peak_rss"] / 2 ** 20,
+        point["peak_allocated"] / 2 ** 20,
+        ", ".join("{} +{:.1f}".format(k, v / 2 ** 20) for k, v in phases),
+    )
+
+
+def run_memory_report(args):
+    """
+    Peak memory of a training step for every (model, u_size, v_size, batch_size) grid point, with a breakdown
+    per phase, the fitted scaling exponents of every model and the largest batch size per size that fits in
+    args.budget_gb. Written to args.output as JSON.
+    """
+    results = []
+    for model_name in args.models:
+        for u_size in args.u_sizes:
+            for v_size in args.v_sizes:
+                for batch_size in args.batch_sizes:
+                    point = {
+                        "model": model_name,
+                        "problem": args.problem,
+                        "u_size": u_size,
+                        "v_size": v_size,
+                        "batch_size": batch_size,
+                    }
+                    point.update(
+                        measure_in_process(
+                            model_name, args.problem, u_size, v_size, batch_size, args
+                        )
+                    )
+                    print(
+                        "{model} {u_size}x{v_size} batch {batch_size}: ".format(**point)
+                        + (point["error"] if "error" in point else format_point(point))
+                    )
+                    results.append(point)
+
+    if all("error" in p for p in results):
+        raise RuntimeError(
+            "Every grid point failed, no report written (first error: {})".format(
+                results[0]["error"] if results else "empty grid"
+            )
+        )
+
+    budget = args.budget_gb * 2 ** 30
+    summary = {}
+    for model_name in args.models:
+        points = [
+            p
+            for p in results
+            if p["model"] == model_name
+            and "error" not in p
+            and p["peak_allocated"] > 0
+        ]
+        if not points:
+            continue
+        exponents = fit_exponents(points)
+        print(
+            "{}: peak allocated ~ {}".format(
+                model_name,
+                " * ".join("{}^{:.2f}".format(d, a) for d, a in exponents.items()),
+            )
+        )
+        max_batch_sizes = {}
+        for u_size in args.u_sizes:
+            for v_size in args.v_sizes:
+                size_points = [
+                    p
+                    for p in points
+                    if p["u_size"] == u_size and p["v_size"] == v_size
+                ]
+                if size_points:
+                    size = "{}x{}".format(u_size, v_size)
+                    max_batch_sizes[size] = max_batch_size(size_points, budget)
+                    print(
+                        "    {}: largest batch size in {} GiB: {}".format(
+                            size, args.budget_gb, max_batch_sizes[size]
+                        )
+                    )
+        summary[model_name] = {
+            "exponents": exponents,
+            "max_batch_sizes": max_batch_sizes,
+        }
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {"budget_gb": args.budget_gb, "results": results, "summary": summary},
+            f,
+            indent=True,
+        )
+    print("Results written to {}".format(args.output))
+    return results, summary
@@ -0,0 +1,87 @@
+import numpy as np
+import networkx as nx
+import torch
+
+from data.data_utils import from_networkx
+from data.generate_data import generate_er_graph
+
+NUM_GENRES = 15
+NUM_USERS = 200
+
+
+def _add_skip_node(g1, u_size, v_size, **attr):
+    # add extra node in U that represents not matching the current node to anything
+    g1.add_node(-1, bipartite=0)
+    g1.add_edges_from(list(zip([-1] * v_size, range(u_size, u_size + v_size))), **attr)
+    return g1
+
+
+def make_edge_obm_instance(u_size, v_size, p, seed, weight_param):
+    g1, _, _ = generate_er_graph(
+        u_size, v_size, None, None, None, p, seed, "uniform", weight_param
+    )
+    data = from_networkx(_add_skip_node(g1, u_size, v_size, weight=0))
+    data.x = torch.zeros(v_size, dtype=torch.long)
+    data.y = torch.tensor(1.0)
+    return data
+
+
+def make_adwords_instance(u_size, v_size, p, seed, weight_param):
+    g1, _, _, capacities = generate_er_graph(
+        u_size,
+        v_size,
+        None,
+        None,
+        None,
+        p,
+        seed,
+        "uniform",
+        weight_param,
+        False,
+        0.01,
+        max(float(v_size / u_size) * p * 0.5, 1.0),
+    )
+    data = from_networkx(_add_skip_node(g1, u_size, v_size, weight=0))
+    data.x = torch.tensor(capacities)
+    data.y = torch.cat((torch.ones(1), torch.zeros(v_size)))
+    return data
+
+
+def make_osbm_instance(u_size, v_size, p, seed, weight_param):
+    # Random genres for the movies, random genre preferences, features and ids for the users
+    rng = np.random.RandomState(seed)
+    g1 = nx.bipartite.random_graph(u_size, v_size, p, seed=seed)
+    data = from_networkx(_add_skip_node(g1, u_size, v_size))
+    movie_features = (rng.rand(u_size, NUM_GENRES) < 0.2).astype(float)
+    user_features = np.concatenate(
+        (
+            rng.dirichlet(np.ones(NUM_GENRES), v_size),
+            rng.rand(v_size, 3),
+            rng.randint(0, NUM_USERS, (v_size, 1)),
+        ),
+        axis=1,
+    )
+    data.x = torch.tensor(
+        np.concatenate((movie_features.flatten(), user_features.flatten()))
+    )
+    data.y = torch.cat((torch.ones(1), torch.zeros(v_size)))
+    return data
+
+
+def make_er_dataset(problem, u_size, v_size, num_instances, p=0.1, seed=0):
+    """
+    Random ER instances of a problem in the format of the generated datasets, so benchmarks run without any
+    downloaded data. The optimal matchings are not solved: the competitive ratios of these instances are meaningless.
+    """
+    make_instance = {
+        "e-obm": make_edge_obm_instance,
+        "adwords": make_adwords_instance,
+        "osbm": make_osbm_instance,
+    }.get(problem, None)
+    assert make_instance is not None, "No synthetic instances for problem {}".format(
+        problem
+    )
+    return [
+        make_instance(u_size, v_size, p, seed + i, (0, 1))
+        for i in range(num_instances)
+    ]
@@ -0,0 +1,202 @@
+import json
+import time
+import platform
+import torch
+import torch.optim as optim
+from torch_geometric.data import DataLoader as geoDataloader
+
+from options import get_options
+from run import MODEL_CLASSES
+from train import set_decode_type, train_batch
+from utils.functions import load_problem, move_to
+from utils.reinforce_baselines import NoBaseline
+from benchmarks.synthetic import make_er_dataset
+
+MODELS = [
+    "greedy",
+    "greedy-rt",
+    "greedy-t",
+    "greedy-m",
+    "ff",
+    "inv-ff",
+    "ff-hist",
+    "inv-ff-hist",
+    "gnn",
+    "gnn-hist",
+    "gnn-simp-hist",
+    "attention",
+]
+PROBLEMS = ["e-obm", "adwords", "osbm"]
+SIZES = ["10x30", "10x60", "100x100", "100x200", "100x1000"]
+MODES = ["train", "eval"]
+
+
+def make_opts(model, problem, u_size, v_size, args):
+    opts = get_options(
+        [
+            "--model",
+            model,
+            "--problem",
+            problem,
+            "--u_size",
+            str(u_size),
+            "--v_size",
+            str(v_size),
+            "--batch_size",
+            str(args.batch_size),
+            # The options check that the epoch is a whole number of batches
+            "--dataset_size",
+            str(args.batch_size),
+            "--graph_family",
+            "er",
+            "--graph_family_parameter",
+            str(args.edge_prob),
+            "--no_tensorboard",
+            "--no_progress_bar",
+        ]
+        + (["--no_cuda"] if args.no_cuda else [])
+    )
+    opts.device = torch.device("cuda:0" if opts.use_cuda else "cpu")
+    return opts
+
+
+def make_model(opts, problem):
+    model = MODEL_CLASSES[opts.model](
+        opts.embedding_dim,
+        opts.hidden_dim,
+        problem=problem,
+        n_encode_layers=opts.n_encode_layers,
+        mask_inner=True,
+        mask_logits=True,
+        normalization=opts.normalization,
+        tanh_clipping=opts.tanh_clipping,
+        checkpoint_encoder=opts.checkpoint_encoder,
+        shrink_size=opts.shrink_size,
+        num_actions=opts.u_size + 1,
+        n_heads=opts.n_heads,
+        encoder=opts.encoder,
+        opts=opts,
+    ).to(opts.device)
+    if getattr(model, "best_threshold", False) is None:
+        # Untuned greedy-t, the threshold does not change the work per arrival
+        model.best_threshold = 0.0
+    return model
+
+
+def time_batches(run_batch, batches, opts):
+    """
+    Seconds per batch of run_batch over the batches, the first batch is a warm-up and is not timed.
+    """
+    run_batch(batches[0])
+    if opts.use_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for batch in batches[1:]:
+        run_batch(batch)
+    if opts.use_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / (len(batches) - 1)
+
+
+def benchmark(model, batches, mode, opts):
+    if mode == "eval":
+        set_decode_type(model, "greedy")
+        model.eval()
+
+        def run_batch(batch):
+            with torch.no_grad():
+                model(batch, opts, None, None)
+
+    else:
+        set_decode_type(model, "sampling")
+        model.train()
+        optimizers = [optim.Adam(model.parameters(), lr=opts.lr_model)]
+        baseline = NoBaseline()
+
+        def run_batch(batch):
+            # step 1 is never a logging step, the benchmark measures the update only
+            train_batch(model, optimizers, baseline, 0, 0, 1, batch, None, opts)
+
+    seconds = time_batches(run_batch, batches, opts)
+    return {
+        "instances_per_sec": opts.batch_size / seconds,
+        "arrival_latency_ms": 1e3 * seconds / opts.v_size,
+    }
+
+
+def run_benchmarks(args):
+    """
+    Instances per second and latency per arrival (time of a batch step) of every model, problem, size and mode,
+    written to args.output as JSON. Combinations a model does not support are recorded with their error.
+    """
+    results = []
+    for problem_name in args.problems:
+        problem = load_problem(problem_name)
+        for size in args.sizes:
+            u_size, v_size = map(int, size.split("x"))
+            dataset = make_er_dataset(
+                problem_name,
+                u_size,
+                v_size,
+                args.batch_size * (args.num_batches + 1),
+                args.edge_prob,
+                args.seed,
+            )
+            for model_name in args.models:
+                opts = make_opts(model_name, problem_name, u_size, v_size, args)
+                batches = [
+                    move_to(batch, opts.device)
+                    for batch in geoDataloader(dataset, batch_size=opts.batch_size)
+                ]
+                torch.manual_seed(args.seed)
+                model = make_model(opts, problem)
+                for mode in args.modes:
+                    result = {
+                        "model": model_name,
+                        "problem": problem_name,
+                        "size": size,
+                        "mode": mode,
+                    }
+                    if mode == "train" and not any(
+                        p.requires_grad for p in model.parameters()
+                    ):
+                        continue  # Nothing to train
+                    try:
+                        result.update(benchmark(model, batches, mode, opts))
+                    except Exception as e:
+                        result["error"] = "{}: {}".format(type(e).__name__, e)
+                    print(
+                        "{model:>14} {problem:>8} {size:>9} {mode:>6}: ".format(**result)
+                        + (
+                            result["error"]
+                            if "error" in result
+                            else "{:10.1f} instances/s, {:8.3f} ms per arrival".format(
+                                result["instances_per_sec"],
+                                result["arrival_latency_ms"],
+                            )
+                        )
+                    )
+                    results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "meta": {
+                    "torch": torch.__version__,
+                    "device": "cuda"
+                    if torch.cuda.is_available() and not args.no_cuda
+                    else "cpu",
+                    "platform": platform.platform(),
+                    "num_threads": torch.get_num_threads(),
+                    "batch_size": args.batch_size,
+                    "num_batches": args.num_batches,
+                    "edge_prob": args.edge_prob,
+                    "time": time.strftime("%Y%m%dT%H%M%S"),
+                },
+                "results": results,
+            },
+            f,
+            indent=True,
+        )
+    print("Results written to {}".format(args.output))
+    return results
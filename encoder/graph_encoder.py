@@ -38,7 +38,6 @@ class MPNN(nn.Module):
         self.u_size = opts.u_size
         self.node_dim_u = node_dim_u
         self.node_dim_v = node_dim_v
-        self.batch_size = opts.batch_size
 
     def forward(self, x, edge_index, edge_attribute, i, dummy):
         i = i.item()
@@ -47,15 +46,16 @@ class MPNN(nn.Module):
             n_encode_layers = i + 1
         else:
             n_encode_layers = self.n_layers
+        batch_size = x.size(0)  # One row of node features per graph
         x_u = x[:, : self.node_dim_u * (self.u_size + 1)].reshape(
-            self.batch_size, self.u_size + 1, self.node_dim_u
+            batch_size, self.u_size + 1, self.node_dim_u
         )
         x_v = x[:, self.node_dim_u * (self.u_size + 1) :].reshape(
-            self.batch_size, i, self.node_dim_v
+            batch_size, i, self.node_dim_v
         )
         x_u = self.node_embed_u(x_u)
         x_v = self.node_embed_v(x_v)
-        x = torch.cat((x_u, x_v), dim=1).reshape(self.batch_size * graph_size, -1)
+        x = torch.cat((x_u, x_v), dim=1).reshape(batch_size * graph_size, -1)
 
         for j in range(n_encode_layers):
             # x = F.relu(x) # TODO: Change back
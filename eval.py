@@ -1,14 +1,21 @@
+import copy
 import numpy as np
 
 import pprint as pp
 
 import torch
+import multiprocessing as mp
 
 from torch_geometric.data import DataLoader
 
 # from nets.critic_network import CriticNetwork
 from options import get_options
-from train import get_inner_model, evaluate
+from train import (
+    get_inner_model,
+    evaluate_models,
+    summarize_result,
+    compare_results,
+)
 from policy.attention_model import AttentionModel
 from policy.ff_model import FeedForwardModel
 from policy.ff_model_invariant import InvariantFF
@@ -30,53 +37,154 @@ import pandas as pd
 
 # from nets.pointer_network import PointerNetwork, CriticNetworkLSTM
 from utils.functions import torch_load_cpu, load_problem
+from utils.eval_cache import result_key, load_result, save_result, CACHED_RESULTS
 
 matplotlib.use("Agg")
 
 
-def get_model_op_ratios(opts, model, problem):
+def _init_eval_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def size_opts(opts, u_size, v_size):
+    opts = copy.copy(opts)
+    opts.u_size = u_size
+    opts.v_size = v_size
+    return opts
+
+
+def evaluate_cell(dataset, u_size, v_size, models, baselines, opts):
     """
-    given the model, run the model on the evaluation dataset and return the optmiality ratios
+    Evaluates the models and the baselines on the eval dataset of a cell of the evaluation grid.
     """
-    # get the path to the test set dir
-    ops = []
-    # for i in graph family parameters
-    for i in range(len(opts.eval_set)):
-        dataset = opts.eval_dataset + "/parameter_{}".format(opts.eval_set[i])
-        # get the eval dataset as a pytorch dataset object
-        eval_dataset = problem.make_dataset(
-            dataset, opts.eval_size, opts.eval_size, opts.problem, opts
+    opts = size_opts(opts, u_size, v_size)
+    problem = load_problem(opts.problem)
+    # get the eval dataset as a pytorch dataset object
+    eval_dataset = problem.make_dataset(
+        dataset, opts.eval_size, opts.eval_size, opts.problem, opts
+    )
+    eval_dataloader = DataLoader(
+        eval_dataset, batch_size=opts.eval_batch_size, num_workers=0
+    )
+    return evaluate_models(models, baselines, eval_dataloader, opts)
+
+
+def evaluate_grid(cells, opts):
+    """
+    Evaluates the cells (arguments of evaluate_cell) of the evaluation grid, in a pool of opts.eval_workers
+    processes with opts.eval_worker_threads threads each. The results are in the order of the cells.
+    """
+    if opts.eval_workers == 1:
+        return [evaluate_cell(*cell, opts) for cell in cells]
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(
+        opts.eval_workers,
+        initializer=_init_eval_worker,
+        initargs=(opts.eval_worker_threads,),
+    ) as pool:
+        return pool.starmap(
+            evaluate_cell, [cell + (opts,) for cell in cells], chunksize=1
         )
-        eval_dataloader = DataLoader(
-            eval_dataset, batch_size=opts.eval_batch_size, num_workers=0
+
+
+def evaluate_cached(jobs, opts):
+    """
+    Results of every job (eval dataset, u_size, v_size, model, checkpoint or None for a baseline), read from the
+    cache in opts.eval_cache_dir. Only the jobs missing from the cache are evaluated and cached: serially, the
+    missing jobs of every dataset are a cell of the grid, with several workers every job is a cell.
+    """
+    keys = [
+        result_key(m, checkpoint, dataset, u_size, v_size, opts)
+        for dataset, u_size, v_size, m, checkpoint in jobs
+    ]
+    results = [load_result(opts.eval_cache_dir, key) for key in keys]
+    missing = [i for i, r in enumerate(results) if r is None]
+    assert (
+        not opts.eval_plot or not missing
+    ), "{} results are not in {}, run without --eval_plot to compute them".format(
+        len(missing), opts.eval_cache_dir
+    )
+    print(
+        "{} cached results, {} to evaluate".format(
+            len(jobs) - len(missing), len(missing)
         )
+    )
 
-        avg_cost, cr, avg_cr, op, *_ = evaluate([model, model], eval_dataloader, opts)
-        ops.append(op.cpu().numpy())
-    return np.array(ops)
+    groups = {}
+    for i in missing:
+        groups.setdefault(jobs[i][:3] if opts.eval_workers == 1 else i, []).append(i)
+    groups = list(groups.values())
+    cells = [jobs[g[0]][:3] + ([jobs[i][3] for i in g], []) for g in groups]
+    for group, (cell_results, _, _) in zip(groups, evaluate_grid(cells, opts)):
+        for i, r in zip(group, cell_results):
+            dataset, _, _, m, checkpoint = jobs[i]
+            save_result(
+                opts.eval_cache_dir, keys[i], r, m.model_name, checkpoint, dataset
+            )
+            results[i] = r
+    return [
+        summarize_result(
+            {k: r[k] for k in CACHED_RESULTS}, size_opts(opts, job[1], job[2])
+        )
+        for job, r in zip(jobs, results)
+    ]
 
 
-def get_models_op_ratios(opts, models, problem):
+def evaluate_eval_sets(opts, models, checkpoints, baselines):
     """
-    given the model, run the model trained on a parameter on the evaluation dataset for
-    that parameter and return the optmiality ratios
+    Results of the models and the baselines on every eval set (graph family parameter), through the results
+    cache. The models are compared with baselines[0].
+    :param models: the models of every type, one per eval set: models[j + i] was trained on eval set i
+    :param checkpoints: the checkpoint of every model
+    :return: the optimality ratios of every baseline per eval set, and for every model type the optimality
+    ratios, agreement with the baseline, agreement with optimal (of the baseline and of the model) and action
+    frequencies (of the model and of the baseline) per eval set
     """
-    # get the path to the test set dir
-    ops = []
-    # for i in graph family parameters
-    for i in range(len(opts.eval_set)):
+    num_sets = len(opts.eval_set)
+    num_types = len(models) // num_sets
+    jobs = []
+    for i in range(num_sets):
         dataset = opts.eval_dataset + "/parameter_{}".format(opts.eval_set[i])
-        # get the eval dataset as a pytorch dataset object
-        eval_dataset = problem.make_dataset(
-            dataset, opts.eval_size, opts.eval_size, opts.problem, opts
-        )
-        eval_dataloader = DataLoader(
-            eval_dataset, batch_size=opts.eval_batch_size, num_workers=0
-        )
+        jobs += [(dataset, opts.u_size, opts.v_size, b, None) for b in baselines]
+        jobs += [
+            (
+                dataset,
+                opts.u_size,
+                opts.v_size,
+                models[k * num_sets + i],
+                checkpoints[k * num_sets + i],
+            )
+            for k in range(num_types)
+        ]
+    results = evaluate_cached(jobs, opts)
 
-        avg_cost, cr, avg_cr, op, *_ = evaluate(models[i], eval_dataloader, opts)
-        ops.append(op.cpu().numpy())
-    return np.array(ops)
+    baseline_results = [[] for _ in baselines]
+    trained_models_results = [[[] for _ in range(6)] for _ in range(num_types)]
+    for i in range(num_sets):
+        set_results = results[
+            i * (len(baselines) + num_types) : (i + 1) * (len(baselines) + num_types)
+        ]
+        b_results = set_results[: len(baselines)]
+        for k, r in enumerate(b_results):
+            baseline_results[k].append(r["cr"].numpy())
+        for k, r in enumerate(set_results[len(baselines) :]):
+            c = compare_results(r, b_results[0], opts)
+            print(f"Average Jaccard Index: {opts.eval_set[i]}: {c['jaccard']}")
+            for l, v in enumerate(
+                (
+                    r["cr"].numpy(),
+                    c["agree"].numpy() / float(opts.eval_size),
+                    b_results[0]["agree_opt"].numpy() / float(opts.eval_size),
+                    r["agree_opt"].numpy() / float(opts.eval_size),
+                    r["count"].numpy() / float(r["count"].sum()),
+                    b_results[0]["count"].numpy() / float(b_results[0]["count"].sum()),
+                )
+            ):
+                trained_models_results[k][l].append(v)
+    return (
+        [np.array(r) for r in baseline_results],
+        [tuple(np.array(v) for v in r) for r in trained_models_results],
+    )
 
 
 def set_box_color(bp, color):
@@ -275,55 +383,14 @@ def initialize_models(opts, models, load_datas, Model):
         models.append(model)
 
 
-def compare_actions(opts, models, greedy, problem):
-    ops = []
-    ps = []
-    ps1 = []
-    ps2 = []
-    counts = []
-    counts1 = []
-    # for i in graph family parameters
-    for i in range(len(opts.eval_set)):
-        dataset = opts.eval_dataset + "/parameter_{}".format(opts.eval_set[i])
-        # get the eval dataset as a pytorch dataset object
-        eval_dataset = problem.make_dataset(
-            dataset, opts.eval_size, opts.eval_size, opts.problem, opts
-        )
-        eval_dataloader = DataLoader(
-            eval_dataset, batch_size=opts.eval_batch_size, num_workers=0
-        )
-
-        avg_cost, cr, avg_cr, op, p, p1, p2, count1, count2, avg_j, wil = evaluate(
-            [models[i], greedy], eval_dataloader, opts
-        )
-        print(f"Average Jaccard Index: {opts.eval_set[i]}: {avg_j}")
-        # print(f"Wilcoxon test p-value: {opts.eval_set[i]}: {wil}")
-        ops.append(op.cpu().numpy())
-        ps.append(p.cpu().numpy() / float(opts.eval_size))
-        ps1.append(p1.cpu().numpy() / float(opts.eval_size))
-        ps2.append(p2.cpu().numpy() / float(opts.eval_size))
-        counts.append(count1.cpu().numpy() / float(count1.sum()))
-        counts1.append(count2.cpu().numpy() / float(count2.sum()))
-    return (
-        np.array(ops),
-        np.array(ps),
-        np.array(ps1),
-        np.array(ps2),
-        np.array(counts),
-        np.array(counts1),
-    )
-
-
-def test_transeferability(opts, models, greedy, problem):
+def test_transeferability(opts, models, checkpoints, greedy, problem):
 
     # sns.set_style("darkgrid")
     # plt.figure()
     trained_on = (opts.u_size, opts.v_size)
-    g_sizes = [(10, 30)]
-    data = {"Model": [], "Graph Size": [], "Average Optimality Ratio": []}
-    data_matrix = []
+    g_sizes = [(10, 30), (10, 60), (100, 100), (100, 200)]
+    jobs = []
     for g in g_sizes:
-        g_list = []
         extention = "{}_{}_{}_{}{}_{}by{}".format(
             opts.problem,
             opts.graph_family,
@@ -335,69 +402,18 @@ def test_transeferability(opts, models, greedy, problem):
         ).replace(" ", "")
 
         eval_dataset = f"dataset/eval/{extention}/parameter_-1"
-        opts.u_size = g[0]
-        opts.v_size = g[1]
-        models = [greedy] + models
-
-        for m in models:
-            eval_dataset = problem.make_dataset(
-                eval_dataset, opts.eval_size, opts.eval_size, opts.problem, opts
-            )
-            eval_dataloader = DataLoader(
-                eval_dataset, batch_size=opts.eval_batch_size, num_workers=0
-            )
+        jobs.append((eval_dataset, g[0], g[1], greedy, None))
+        # The fixed size models do not transfer to other sizes of U
+        jobs += [
+            (eval_dataset, g[0], g[1], m, c)
+            for m, c in zip(models, checkpoints)
             if not (
                 m.model_name in ["ff", "ff-hist", "ff-supervised"]
                 and g[0] != trained_on[0]
-            ):
-                (
-                    avg_cost,
-                    cr,
-                    avg_cr,
-                    op,
-                    p,
-                    p1,
-                    p2,
-                    count1,
-                    count2,
-                    avg_j,
-                    wil,
-                ) = evaluate([m, greedy], eval_dataloader, opts)
-                data["Model"].append(m.model_name)
-                data["Graph Size"].append(f"{g[0]}×{g[1]}")
-                data["Average Optimality Ratio"].append(avg_cr.item())
-                g_list.append(avg_cr.item())
-        data_matrix.append(g_list)
-        # else:
-        #     data["Model"].append(m.model_name)
-        #     data["Graph Size"].append(f"{g[0]}×{g[1]}")
-        #     data["Average Optimality Ratio"].append(0.0)
-    data = pd.DataFrame(data)
-    # b = sns.catplot(
-    #     data=data,
-    #     hue="Graph Size",
-    #     x="Model",
-    #     y="Average Optimality Ratio",
-    #     legend_out=False,
-    #     height=7,
-    # )
-
-    data_matrix = np.array(
-        torch.load(
-            opts.eval_output
-            + "/{}_{}_{}by{}_graph_transfer.pt".format(
-                opts.problem, opts.graph_family, trained_on[0], trained_on[1]
-            ).replace(" ", "")
-        )
-    )
-    # b = sns.heatmap(data=data_matrix, annot=True, fmt="d")
-    g_sizes = ["10×30", "10×60", "100×100", "100×200"]
-    fig, ax = plt.subplots()
-    d1 = data_matrix.copy()
-    data_matrix = 1.0 - data_matrix
-    data_matrix[d1 == 0.0] = 0.1
-    ax.imshow(data_matrix)
+            )
+        ]
 
+    # Average optimality ratio per graph size and model, 0 if the model does not transfer to the size
     models = [
         "greedy",
         "inv-ff",
@@ -407,6 +423,20 @@ def test_transeferability(opts, models, greedy, problem):
         "inv-ff-hist",
         "gnn-hist",
     ]
+    data_matrix = np.zeros((len(g_sizes), len(models)))
+    for (_, u_size, v_size, m, _), r in zip(jobs, evaluate_cached(jobs, opts)):
+        if m.model_name in models:
+            data_matrix[
+                g_sizes.index((u_size, v_size)), models.index(m.model_name)
+            ] = r["cr"].mean().item()
+    # b = sns.heatmap(data=data_matrix, annot=True, fmt="d")
+    g_sizes = [f"{g[0]}×{g[1]}" for g in g_sizes]
+    fig, ax = plt.subplots()
+    d1 = data_matrix.copy()
+    data_matrix = 1.0 - data_matrix
+    data_matrix[d1 == 0.0] = 0.1
+    ax.imshow(data_matrix)
+
     # We want to show all ticks...
     ax.set_xticks(np.arange(len(models)))
     ax.set_yticks(np.arange(len(g_sizes)))
@@ -461,10 +491,6 @@ def run(opts):
 
     # Figure out what's the problem
     problem = load_problem(opts.problem)
-    if opts.eval_plot:
-        t = torch.load(opts.eval_results_file)
-        plot_box(opts, np.array(t))
-        return
 
     # load the basline and neural net models and save them in models, attention_models, ff_models, baseline_models
 
@@ -502,11 +528,13 @@ def run(opts):
         (gnn_simp_hist_models, GNNSimpHist),
     ]
     models = []
+    checkpoints = []
 
     for m_path, m_class in model_paths:
         if m_path is not None:
             model_param = load_models(opts, m_path)
             initialize_models(opts, models, model_param, m_class)
+            checkpoints += m_path
 
     # Initialize baseline models
     baseline_models = []
@@ -535,28 +563,16 @@ def run(opts):
         ).to(opts.device)
         baseline_models.append(model)
     if opts.test_transfer:
-        test_transeferability(opts, models, baseline_models[0], problem)
+        test_transeferability(
+            opts, models, checkpoints, baseline_models[0], problem
+        )
         return
     if len(opts.eval_set) > 0:
-        baseline_results = []
-        trained_models_results = []
-        # plot_data = []
-        for m in baseline_models:  # Get the performance of the baselines
-            ops = get_model_op_ratios(opts, m, problem)
-            baseline_results.append(ops)
-
         print(len(models))
-        if len(models) > 0:
-            # Get the performance of the trained models
-            for j in range(0, len(models), len(opts.eval_set)):
-                trained_models_results.append(
-                    compare_actions(
-                        opts,
-                        models[j : j + len(opts.eval_set)],
-                        baseline_models[0],
-                        problem,
-                    )
-                )
+        # Only the results missing from the cache are evaluated, by opts.eval_workers processes
+        baseline_results, trained_models_results = evaluate_eval_sets(
+            opts, models, checkpoints, baseline_models
+        )
 
         results = [
             np.array(baseline_results[i]) for i in range(len(baseline_results))
@@ -570,7 +586,7 @@ def run(opts):
         # results3 = [np.array(trained_models_results[i][3]) for i in range(len(trained_models_results))]
 
         plot_box(opts, results)
-        # test_transeferability(opts, models, baseline_models[0], problem)
+        # test_transeferability(opts, models, checkpoints, baseline_models[0], problem)
         # plot_agreemant(opts, results2)
         # plot_agreemant(opts, results3, with_opt=True)
 
@@ -138,7 +138,7 @@ def get_options(args=None):
     parser.add_argument(
         "--n_step",
         action="store_true",
-        help="Set to peform n-step training",
+        help="Set to peform truncated n-step training: update the policy every max_steps arrivals of an episode",
     )
     parser.add_argument(
         "--max_steps",
@@ -146,6 +146,101 @@ def get_options(args=None):
         default=10,
         help="Maximum number of steps before performing backward pass (used in n-step training)",
     )
+    parser.add_argument(
+        "--teacher_forcing",
+        action="store_true",
+        help="Train ff-supervised on features precomputed once by following the optimal matchings, "
+        "as shuffled minibatches of single arrivals",
+    )
+    parser.add_argument(
+        "--tf_batch_size",
+        type=int,
+        default=4096,
+        help="Number of arrivals per minibatch in teacher-forced training",
+    )
+    parser.add_argument(
+        "--dagger_every",
+        type=int,
+        default=0,
+        help="Refresh the teacher-forced features with the states visited by the current policy "
+        "every dagger_every epochs (0 to disable)",
+    )
+    parser.add_argument(
+        "--num_actors",
+        type=int,
+        default=0,
+        help="Number of actor processes for asynchronous actor-learner training of the ff policies "
+        "(0 to roll out in the learner)",
+    )
+    parser.add_argument(
+        "--sync_every",
+        type=int,
+        default=1,
+        help="Number of learner updates between publishing the parameters to the actors",
+    )
+    parser.add_argument(
+        "--is_clip",
+        type=float,
+        default=1.0,
+        help="Truncation of the importance weights correcting the policy lag of the actors",
+    )
+    parser.add_argument(
+        "--pipeline_rollouts",
+        action="store_true",
+        help="Roll out every batch as two halves in lockstep on two threads, overlapping the environment updates "
+        "of one half with the model forward of the other (CPU)",
+    )
+    parser.add_argument(
+        "--prioritized_sampling",
+        action="store_true",
+        help="Sample the training instances in proportion to their gap to optimal in their last rollout, "
+        "with importance weights correcting the policy gradient",
+    )
+    parser.add_argument(
+        "--priority_alpha",
+        type=float,
+        default=1.0,
+        help="Exponent of the gap to optimal in the sampling priorities (0 is uniform sampling)",
+    )
+    parser.add_argument(
+        "--priority_beta",
+        type=float,
+        default=1.0,
+        help="Exponent of the importance weights of prioritized sampling (1 fully corrects the bias)",
+    )
+    parser.add_argument(
+        "--ensemble_size",
+        type=int,
+        default=1,
+        help="Number of independently initialized copies of the ff policy trained together in one vectorized "
+        "model, each member decodes its own copy of the batches",
+    )
+    parser.add_argument(
+        "--ensemble_ent_rates",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Entropy regularization rate of every member of the ensemble (default --ent_rate for all)",
+    )
+    parser.add_argument(
+        "--ppo_epochs",
+        type=int,
+        default=0,
+        help="Number of passes of clipped-surrogate (PPO) updates over each batch of rollouts, 0 to "
+        "update once with REINFORCE",
+    )
+    parser.add_argument(
+        "--ppo_minibatch_size",
+        type=int,
+        default=1024,
+        help="Number of decoding steps in each PPO minibatch",
+    )
+    parser.add_argument(
+        "--ppo_clip",
+        type=float,
+        default=0.2,
+        help="Clipping range of the PPO probability ratio",
+    )
     # Training
     parser.add_argument(
         "--lr_model",
@@ -167,6 +262,13 @@ def get_options(args=None):
         "--n_epochs", type=int, default=1000, help="The number of epochs to train"
     )
     parser.add_argument("--seed", type=int, default=1234, help="Random seed to use")
+    parser.add_argument(
+        "--accumulation_steps",
+        type=int,
+        default=1,
+        help="Number of batches whose gradients are accumulated before each optimizer step "
+        "(effective batch size is batch_size * accumulation_steps)",
+    )
     parser.add_argument(
         "--max_grad_norm",
         type=float,
@@ -174,6 +276,12 @@ def get_options(args=None):
         help="Maximum L2 norm for gradient clipping, default 1.0 (0 to disable clipping)",
     )
     parser.add_argument("--no_cuda", action="store_true", help="Disable CUDA")
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help="Data-parallel training over CPU processes (gloo backend), launch with "
+        "torchrun --nproc_per_node=<num processes> run.py --distributed --no_cuda ...",
+    )
     parser.add_argument(
         "--exp_beta",
         type=float,
@@ -189,7 +297,15 @@ def get_options(args=None):
     parser.add_argument(
         "--baseline",
         default=None,
-        help="Baseline to use: 'rollout', 'critic' or 'exponential'. Defaults to no baseline.",
+        help="Baseline to use: 'rollout', 'critic', 'exponential' or 'self-critical' (greedy rollout of the "
+        "current policy decoded in the same batch). Defaults to no baseline.",
+    )
+    parser.add_argument(
+        "--num_rollouts",
+        type=int,
+        default=1,
+        help="Number of sampled trajectories per training instance, with more than one the baseline of a "
+        "trajectory is the mean cost of the trajectories of its instance (use without --baseline)",
     )
     parser.add_argument(
         "--bl_alpha",
@@ -197,6 +313,16 @@ def get_options(args=None):
         default=0.05,
         help="Significance in the t-test for updating rollout baseline",
     )
+    parser.add_argument(
+        "--bl_background",
+        action="store_true",
+        help="Challenge the rollout baseline in a background thread while the next epoch trains",
+    )
+    parser.add_argument(
+        "--bl_early_stop",
+        action="store_true",
+        help="Stop evaluating the candidate for the rollout baseline once the t-test is decisive",
+    )
     parser.add_argument(
         "--bl_warmup_epochs",
         type=int,
@@ -227,6 +353,20 @@ def get_options(args=None):
         default=1,
         help="checkpoint encoder every x epochs. NOTE: checkpointing here does not mean saving model.",
     )
+    parser.add_argument(
+        "--checkpoint_policy",
+        type=str,
+        default="every-k",
+        choices=["none", "every-k", "memory-budget"],
+        help="When to checkpoint the encoder during a rollout: 'none', 'every-k' (every checkpoint_every steps) "
+        "or 'memory-budget' (only as many steps as needed to fit checkpoint_budget)",
+    )
+    parser.add_argument(
+        "--checkpoint_budget",
+        type=float,
+        default=None,
+        help="Activation memory budget in bytes per episode, used by the memory-budget checkpoint policy",
+    )
     parser.add_argument(
         "--shrink_size",
         type=int,
@@ -292,12 +432,15 @@ def get_options(args=None):
     parser.add_argument(
         "--eval_plot",
         action="store_true",
-        help="plot results on test data",
+        help="Only plot the results in --eval_cache_dir, without evaluating the missing ones",
     )
     parser.add_argument(
-        "--eval_results_file",
+        "--eval_cache_dir",
         type=str,
-        help="file that containes test results",
+        default="eval_cache",
+        help="Directory caching the per-instance evaluation results of every checkpoint, dataset and eval "
+        "options, eval.py only evaluates the results missing from it. Bump CACHE_VERSION in utils/eval_cache.py "
+        "(or clear the directory) after changing the decoding of a policy",
     )
     parser.add_argument(
         "--eval_range",
@@ -372,6 +515,18 @@ def get_options(args=None):
         nargs="+",
         help="Set of family parameters to evaluate models on",
     )
+    parser.add_argument(
+        "--eval_workers",
+        type=int,
+        default=1,
+        help="Number of processes evaluating the grid of eval sets (and graph sizes) and models in parallel (CPU)",
+    )
+    parser.add_argument(
+        "--eval_worker_threads",
+        type=int,
+        default=None,
+        help="Number of threads of every evaluation process, the cores split between the processes by default",
+    )
 
     parser.add_argument(
         "--eval_num_range",
@@ -398,6 +553,31 @@ def get_options(args=None):
         action="store_true",
         help="Set this to true if you want to tune the hyperparameters",
     )
+    parser.add_argument(
+        "--sweep_workers",
+        type=int,
+        default=4,
+        help="Number of configurations trained concurrently by --tune",
+    )
+    parser.add_argument(
+        "--sweep_eta",
+        type=int,
+        default=3,
+        help="Successive halving rate of --tune: each rung keeps 1/eta of the configurations and trains "
+        "them eta times longer",
+    )
+    parser.add_argument(
+        "--sweep_min_epochs",
+        type=int,
+        default=1,
+        help="Number of epochs of the first rung of --tune",
+    )
+    parser.add_argument(
+        "--sweep_results",
+        type=str,
+        default="sweep_results.db",
+        help="SQLite file of the results table of --tune",
+    )
     parser.add_argument(
         "--tune_baseline",
         action="store_true",
@@ -422,6 +602,62 @@ def get_options(args=None):
         default="logs",
         help="Directory to write TensorBoard information to",
     )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Benchmark the candidate batch sizes and numbers of threads at the start of the run and train with "
+        "the fastest that fits in --autotune_memory_gb (CPU), the choice is cached per host, model and size",
+    )
+    parser.add_argument(
+        "--autotune_batch_sizes",
+        type=int,
+        nargs="+",
+        default=[50, 100, 200, 400],
+        help="Candidate batch sizes of --autotune",
+    )
+    parser.add_argument(
+        "--autotune_threads",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Candidate numbers of intra-op threads of --autotune, 1, half and all the cores by default",
+    )
+    parser.add_argument(
+        "--autotune_interop_threads",
+        type=int,
+        nargs="+",
+        default=[1, 2],
+        help="Candidate numbers of inter-op threads of --autotune",
+    )
+    parser.add_argument(
+        "--autotune_steps",
+        type=int,
+        default=3,
+        help="Timed training steps per candidate of --autotune",
+    )
+    parser.add_argument(
+        "--autotune_memory_gb",
+        type=float,
+        default=None,
+        help="Peak memory budget of the candidates of --autotune, in GiB (no limit by default)",
+    )
+    parser.add_argument(
+        "--autotune_cache",
+        default="autotune_cache.json",
+        help="File caching the configurations chosen by --autotune",
+    )
+    parser.add_argument(
+        "--profile",
+        type=int,
+        default=0,
+        help="Profile the first n batches of training (and of evaluation): print the time spent in every phase "
+        "and write a Chrome/Perfetto trace to --profile_dir (0 to disable)",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        default="profiles",
+        help="Directory to write the traces of --profile to",
+    )
     parser.add_argument("--run_name", default="run", help="Name to identify the run")
     parser.add_argument(
         "--output_dir", default="outputs", help="Directory to write output models to"
@@ -466,6 +702,113 @@ def get_options(args=None):
     if opts.bl_warmup_epochs is None:
         opts.bl_warmup_epochs = 1 if opts.baseline == "rollout" else 0
     assert (opts.bl_warmup_epochs == 0) or (opts.baseline == "rollout")
+    assert (
+        opts.checkpoint_policy != "memory-budget" or opts.checkpoint_budget is not None
+    ), "--checkpoint_budget is required with the memory-budget checkpoint policy"
+    assert (
+        not opts.teacher_forcing or opts.model == "ff-supervised"
+    ), "--teacher_forcing is only supported by the ff-supervised model"
+    assert opts.num_actors == 0 or opts.model in (
+        "ff",
+        "inv-ff",
+        "ff-hist",
+        "inv-ff-hist",
+    ), "Actor-learner training needs a policy whose steps can be replayed (ff, inv-ff, ff-hist, inv-ff-hist)"
+    assert (
+        opts.num_actors == 0 or not opts.n_step
+    ), "Actor-learner training does not support n-step updates"
+    assert (
+        opts.num_actors == 0 or not opts.use_cuda
+    ), "Actor-learner training runs on CPU, run with --no_cuda"
+    assert not (
+        opts.bl_background and opts.distributed
+    ), "The background baseline challenge cannot be combined with distributed training"
+    assert not opts.distributed or (
+        opts.num_actors == 0 and not opts.teacher_forcing
+    ), "Distributed training does not support actor-learner or teacher-forced training"
+    assert opts.baseline != "self-critical" or (
+        not opts.n_step and opts.num_actors == 0
+    ), "The self-critical baseline is not supported with n-step or actor-learner training"
+    assert opts.ppo_epochs == 0 or opts.model in (
+        "ff",
+        "inv-ff",
+        "ff-hist",
+        "inv-ff-hist",
+    ), "PPO training needs a policy whose steps can be replayed (ff, inv-ff, ff-hist, inv-ff-hist)"
+    assert opts.ppo_epochs == 0 or (
+        not opts.n_step
+        and opts.num_actors == 0
+        and opts.accumulation_steps == 1
+        and opts.num_rollouts == 1
+        and opts.baseline != "self-critical"
+    ), "PPO training does not support n-step, actor-learner, gradient accumulation or multiple rollouts"
+    assert not opts.tune or (
+        not opts.use_cuda and not opts.distributed
+    ), "The --tune sweep spawns CPU worker processes, run with --no_cuda"
+    assert opts.sweep_eta >= 2, "--sweep_eta must be at least 2"
+    assert opts.ensemble_size == 1 or opts.model in (
+        "ff",
+        "inv-ff",
+        "ff-hist",
+        "inv-ff-hist",
+    ), "Ensembles are only supported for the ff policies (ff, inv-ff, ff-hist, inv-ff-hist)"
+    assert opts.ensemble_size == 1 or (
+        not opts.n_step
+        and opts.num_actors == 0
+        and opts.ppo_epochs == 0
+        and opts.baseline in (None, "exponential", "self-critical")
+    ), (
+        "Ensembles support no baseline, the exponential or the self-critical baseline, "
+        "without n-step, actor-learner or PPO training"
+    )
+    assert not opts.prioritized_sampling or (
+        not opts.distributed
+        and not opts.n_step
+        and opts.num_actors == 0
+        and opts.ppo_epochs == 0
+        and not opts.teacher_forcing
+        and "supervised" not in opts.model
+    ), "Prioritized sampling is only supported by single-process REINFORCE training"
+    assert not opts.pipeline_rollouts or (
+        not opts.use_cuda
+        and not opts.n_step
+        and opts.num_rollouts == 1
+        and opts.ensemble_size == 1
+        and opts.baseline != "self-critical"
+        and "supervised" not in opts.model
+        and opts.checkpoint_policy != "memory-budget"
+    ), (
+        "Pipelined rollouts run on CPU and do not support n-step training, several rollouts per "
+        "instance, ensembles, supervised models or memory-budget checkpointing (the halves share the "
+        "checkpointer of the model)"
+    )
+    assert opts.profile >= 0, "--profile is a number of batches"
+    assert not opts.autotune or (
+        not opts.use_cuda and not opts.eval_only and not opts.tune
+    ), "--autotune tunes CPU training runs, run with --no_cuda"
+    assert not (
+        opts.autotune and opts.distributed
+    ), "--autotune cannot be combined with distributed training, the ranks could choose different batch sizes"
+    assert opts.eval_workers >= 1, "--eval_workers must be positive"
+    assert (
+        opts.eval_workers == 1 or not opts.use_cuda
+    ), "Parallel evaluation runs on CPU, run with --no_cuda"
+    if opts.eval_worker_threads is None:
+        opts.eval_worker_threads = max(1, torch.get_num_threads() // opts.eval_workers)
+    if opts.autotune_threads is None:
+        num_threads = torch.get_num_threads()
+        opts.autotune_threads = sorted({1, max(1, num_threads // 2), num_threads})
+    assert opts.num_rollouts >= 1, "--num_rollouts must be positive"
+    assert opts.num_rollouts == 1 or (
+        opts.baseline is None and not opts.n_step and opts.num_actors == 0
+    ), "Multiple rollouts per instance use their own baseline and do not support n-step or actor-learner training"
+    assert opts.accumulation_steps >= 1, "--accumulation_steps must be positive"
+    assert (
+        not opts.n_step or opts.accumulation_steps == 1
+    ), "Gradient accumulation is not supported with n-step training"
+    assert (
+        opts.model != "supervised" or opts.accumulation_steps == 1
+    ), "The supervised model steps its optimizer within its rollout, gradient accumulation is not supported"
     assert (
         opts.dataset_size % opts.batch_size == 0
     ), "Epoch size must be integer multiple of batch size!"
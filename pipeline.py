@@ -41,6 +41,7 @@ save_eval_data = True
 
 batch_size = 200
 eval_batch_size = 200
+autotune = False  # Pick the batch size and the number of threads of the training runs by benchmarking them (CPU)
 
 embedding_dim = 30  # 60
 n_heads = 1  # 3
@@ -247,6 +248,8 @@ def train_model():
             ent_rate,
         )
 
+        if autotune:
+            train += " --autotune --no_cuda"
         # print(train)
         subprocess.run(train, shell=True)
 
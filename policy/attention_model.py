@@ -1,6 +1,5 @@
 import torch
 from torch import nn
-from torch.utils.checkpoint import checkpoint
 import math
 from typing import NamedTuple
 
@@ -9,15 +8,18 @@ import torch.nn.functional as F
 # from utils.tensor_functions import compute_in_batches
 
 from encoder.graph_encoder_v2 import GraphAttentionEncoder
-from train import clip_grad_norms
+from policy.common import NStepTrainer, step_entropy, get_num_rollouts
 
 #from encoder.graph_encoder import MPNN
 from torch.nn import DataParallel
 from torch_geometric.utils import subgraph
+from utils.checkpointing import EncoderCheckpointer
 
 # from utils.functions import sample_many
 
 import time
+from utils.profiling import phase, profiled
+from utils.pipelined_rollout import model_phase
 
 
 def set_decode_type(model, decode_type):
@@ -26,26 +28,6 @@ def set_decode_type(model, decode_type):
     model.set_decode_type(decode_type)
 
 
-def train_n_step(cost, ll, x, optimizers, baseline, opts):
-    bl_val, bl_loss = baseline.eval(x, cost)
-
-    # Calculate loss
-    # print("\nCost: " , cost.item())
-    reinforce_loss = ((cost.squeeze(1) - bl_val) * ll).mean()
-    loss = reinforce_loss + bl_loss
-    # print(loss.item())
-    # Perform backward pass and optimization step
-    # s = time.time()
-    optimizers[0].zero_grad()
-    loss.backward()
-    # print(time.time() - s)
-    clip_grad_norms(optimizers[0].param_groups, opts.max_grad_norm)
-    optimizers[0].step()
-    # optimizers[1].step()
-    # print(time.time() - s)
-    return
-
-
 class AttentionModelFixed(NamedTuple):
     """
     Context for AttentionModel decoder that is fixed during decoding so can be precomputed/cached
@@ -153,6 +135,9 @@ class AttentionModel(nn.Module):
         # nn.init.xavier_uniform_(self.project_out.weight)
         # self.init_parameters()
         self.dummy = torch.ones(1, dtype=torch.float32, requires_grad=True)
+        self.checkpointer = EncoderCheckpointer(
+            opts.checkpoint_policy, opts.checkpoint_every, opts.checkpoint_budget
+        )
 
     def init_parameters(self):
         for name, param in self.named_parameters():
@@ -179,29 +164,29 @@ class AttentionModel(nn.Module):
         # # else:
         #     embeddings, _ = self.embedder(self._init_embed(input))
         # s = time.time()
-        _log_p, pi, cost = self._inner(input, opts, optimizer, baseline)
+        _log_p, pi, cost, entropy = self._inner(input, opts, optimizer, baseline)
         # print(time.time() - s)
         # cost, mask = self.problem.get_costs(input, pi)
         # Log likelyhood is calculated within the model since returning it per action does not work well with
         # DataParallel since sequences can be of different lengths
-        ll = self._calc_log_likelihood(_log_p, pi, None)
+        ll, e = self._calc_log_likelihood(_log_p, entropy, None)
         if return_pi:
-            return -cost, ll, pi
+            return -cost, ll, pi, e
 
-        return -cost, ll
+        return -cost, ll, e
 
     def beam_search(self, *args, **kwargs):
         return self.problem.beam_search(*args, **kwargs, model=self)
 
     def precompute_fixed(self, input):
-        embeddings, _ = self.embedder(self._init_embed(input))
+        with model_phase("policy/encoder"):
+            embeddings, _ = self.embedder(self._init_embed(input))
         # Use a CachedLookup such that if we repeatedly index this object with the same index we only need to do
         # the lookup once... this is the case if all elements in the batch have maximum batch size
         return CachedLookup(self._precompute(embeddings))
 
-    def _calc_log_likelihood(self, _log_p, a, mask):
-        # Get log_p corresponding to selected actions
-        log_p = _log_p.gather(2, a.unsqueeze(-1)).squeeze(-1)
+    def _calc_log_likelihood(self, log_p, entropy, mask):
+        # log_p holds the log-probabilities of the selected actions (batch_size, v_size)
 
         # Optional: mask out actions irrelevant to objective so they do not get reinforced
         if mask is not None:
@@ -210,7 +195,7 @@ class AttentionModel(nn.Module):
             log_p > -1000
         ).data.all(), "Logprobs should not be -inf, check sampling procedure!"
         # Calculate log_likelihood
-        return log_p.sum(1)
+        return log_p.sum(1), entropy.mean()
 
     def _init_embed(self, input):
 
@@ -220,13 +205,26 @@ class AttentionModel(nn.Module):
 
         outputs = []
         sequences = []
-
-        state = self.problem.make_state(input, opts.u_size, opts.v_size, opts)
+        entropy = 0.0
+
+        state = self.problem.make_state(
+            input,
+            opts.u_size,
+            opts.v_size,
+            opts,
+            num_rollouts=get_num_rollouts(self.decode_type, opts),
+        )
+        n_step = (
+            NStepTrainer(self, optimizer, state, opts)
+            if NStepTrainer.is_active(optimizer, opts)
+            else None
+        )
         # Compute keys, values for the glimpse and keys for the logits once as they can be reused in every step
         # fixed = self._precompute(embeddings)
         step_context = 0
         batch_size = state.batch_size
         graph_size = state.u_size + state.v_size + 1
+        self.checkpointer.reset()
         i = 1
 
         while not (state.all_finished()):
@@ -255,25 +253,24 @@ class AttentionModel(nn.Module):
                     0, batch_size * graph_size, graph_size, device=opts.device
                 ).unsqueeze(1)
             ).flatten()  # The nodes of the current subgraphs
-            edge_i, weights = subgraph(
-                subgraphs,
-                state.graphs.edge_index,
-                state.graphs.weight.unsqueeze(1),
-                relabel_nodes=True,
-            )
-            if i % opts.checkpoint_every == 0:
-                embeddings = checkpoint(
+            with phase("policy/subgraph"):
+                edge_i, weights = subgraph(
+                    subgraphs,
+                    state.get_edge_index(),
+                    state.get_graph_weights().unsqueeze(1),
+                    relabel_nodes=True,
+                )
+            with model_phase("policy/encoder"):
+                embeddings = self.checkpointer(
                     self.embedder,
+                    i,
+                    edge_i.size(1),
                     node_features,
                     edge_i,
                     weights.float(),
                     torch.tensor(i),
                     self.dummy,
                 ).reshape(batch_size, step_size, -1)
-            else:
-                embeddings = self.embedder(
-                    node_features, edge_i, weights.float(), i
-                ).reshape(batch_size, step_size, -1)
 
             # context node embedding
             fixed = self._precompute(embeddings, step_size, opts, state)
@@ -310,24 +307,14 @@ class AttentionModel(nn.Module):
             )  # Incremental averaging of selected edges
             # Collect output of step
             # step_size = ((state.i.item() - state.u_size.item() + 1) * (state.u_size + 1))
-            outputs.append(log_p[:, 0, :])
+            # Keep only the log-probability of the selected action and a running entropy
+            outputs.append(log_p[:, 0, :].gather(1, selected.unsqueeze(-1)).squeeze(-1))
+            entropy = entropy + step_entropy(log_p[:, 0, :], opts)
             sequences.append(selected)
 
-            if (
-                (optimizer is not None)
-                and opts.n_step
-                and (i % opts.max_steps == 0 or state.all_finished())
-            ):
-                _log_p, pi, cost = (
-                    torch.stack(outputs[i - opts.max_steps : i], 1),
-                    torch.stack(sequences[i - opts.max_steps : i], 1),
-                    -state.size / i,
-                )
-
-                # policy gradient
-                ll = self._calc_log_likelihood(_log_p, pi, None)
-                train_n_step(cost, ll, None, optimizer, baseline, opts)
+            if n_step is not None and n_step.step(outputs, entropy, state):
                 step_context = step_context.detach()
+                entropy = entropy.detach()
                 # initial_embeddings = self.project_node_features(node_features).reshape(batch_size, graph_size, -1)
                 # state = state._replace(size=state.size.detach())
             i += 1
@@ -336,8 +323,10 @@ class AttentionModel(nn.Module):
             torch.stack(outputs, 1),
             torch.stack(sequences, 1),
             state.size,
+            entropy,
         )
 
+    @profiled("policy/select")
     def _select_node(self, probs, mask):
         assert (probs == probs).all(), "Probs should not contain any nans"
         if self.decode_type == "greedy":
@@ -353,6 +342,12 @@ class AttentionModel(nn.Module):
             while mask.gather(1, selected.unsqueeze(-1)).data.any():
                 print("Sampled bad values, resampling!")
                 selected = probs.multinomial(1).squeeze(1)
+        elif self.decode_type == "self-critical":
+            # Sample the first half of the trajectories, decode the second half greedily
+            half = probs.size(0) // 2
+            selected = torch.cat(
+                (probs[:half].multinomial(1).squeeze(1), probs[half:].max(1)[1])
+            )
         else:
             assert False, "Unknown decode type"
         return selected
@@ -464,7 +459,7 @@ class AttentionModel(nn.Module):
                             # batch_size, 1, self.W_placeholder.size(-1)
                             # ),
                             curr_node.unsqueeze(1),
-                            state.adj[:, 0, :].float().unsqueeze(1),
+                            state.get_current_adj().float().unsqueeze(1),
                         ),
                         dim=2,
                     )
@@ -476,7 +471,7 @@ class AttentionModel(nn.Module):
                     return torch.cat(
                         (
                             curr_node.unsqueeze(1),
-                            state.adj[:, 0, :].float().unsqueeze(1),
+                            state.get_current_adj().float().unsqueeze(1),
                         ),
                         dim=2,
                     )  # add embedding of arriving node to context
@@ -0,0 +1,159 @@
+import math
+import torch
+
+from utils.distributed import average_gradients
+
+
+def clip_grad_norms(param_groups, max_norm=math.inf):
+    """
+    Clips the norms for all param groups to max_norm and returns gradient norms before clipping
+    :param optimizer:
+    :param max_norm:
+    :param gradient_norms_log:
+    :return: grad_norms, clipped_grad_norms: list with (clipped) gradient norms per group
+    """
+    grad_norms = [
+        torch.nn.utils.clip_grad_norm_(
+            group["params"],
+            max_norm
+            if max_norm > 0
+            else math.inf,  # Inf so no clipping but still call to calc
+            norm_type=2,
+        )
+        for group in param_groups
+    ]
+    grad_norms_clipped = (
+        # clamp instead of min so that the norms stay on the device (no synchronization)
+        [g_norm.clamp(max=max_norm) for g_norm in grad_norms]
+        if max_norm > 0
+        else grad_norms
+    )
+    return grad_norms, grad_norms_clipped
+
+
+def step_entropy(log_p, opts):
+    """
+    Entropy (batch_size) of one decoding step given its log-probabilities (batch_size, num_actions).
+    The graph is only kept if the entropy is regularized during training.
+    """
+    # The members of an ensemble have their own entropy rates
+    regularized = opts.ent_rate != 0 or (
+        opts.ensemble_size > 1 and any(opts.ensemble_ent_rates or [])
+    )
+    if not regularized or not torch.is_grad_enabled():
+        log_p = log_p.detach()
+    # Clamp so that masked (-inf) actions do not give nan entropies
+    log_p = log_p.clamp(min=-1e8)
+    return -(log_p.exp() * log_p).sum(1)
+
+
+def get_num_rollouts(decode_type, opts):
+    """
+    Number of trajectories decoded per instance, self-critical decodes each instance once by sampling and
+    once greedily in the same batch, training samples opts.num_rollouts trajectories of each instance.
+    Every member of an ensemble decodes its own trajectories.
+    """
+    num_rollouts = 1
+    if decode_type == "self-critical":
+        num_rollouts = 2
+    elif decode_type == "sampling":
+        num_rollouts = getattr(opts, "num_rollouts", 1)
+    return num_rollouts * getattr(opts, "ensemble_size", 1)
+
+
+class NStepTrainer(object):
+    """
+    Truncated (n-step) policy gradient for long horizons.
+
+    Used inside a policy's rollout loop: after every decoding step call step(), every opts.max_steps steps
+    (and at the end of the episode) it performs a REINFORCE update on the steps of the last segment and
+    detaches their outputs, so the autograd graph never spans more than opts.max_steps steps.
+    The return of a segment is the reward collected during the segment, the baseline is its batch mean.
+    """
+
+    def __init__(self, model, optimizers, state, opts):
+        self.model = model
+        self.optimizers = optimizers
+        self.opts = opts
+        self.start = 0  # first step of the current segment
+        self.prev_size = state.size.clone()
+        self.prev_entropy = 0.0
+        self.num_steps = 0
+
+    @staticmethod
+    def is_active(optimizers, opts):
+        return optimizers is not None and opts.n_step
+
+    def step(self, outputs, entropy, state):
+        """
+        :param outputs: list of (batch_size) log-probabilities of the selected actions, one per step so far
+        :param entropy: (batch_size) running entropy of the episode so far
+        :return: True if an update was made, the caller should then detach any tensor it carries over steps
+        (including the running entropy)
+        """
+        self.num_steps += 1
+        if not (self.num_steps % self.opts.max_steps == 0 or state.all_finished()):
+            return False
+        ll = torch.stack(outputs[self.start :], 1).sum(1)
+        segment_entropy = (entropy - self.prev_entropy).mean()
+
+        cost = -(state.size - self.prev_size).squeeze(1)
+        reinforce_loss = ((cost - cost.mean()) * ll).mean()
+        loss = reinforce_loss - self.opts.ent_rate * segment_entropy
+        self.optimizers[0].zero_grad()
+        loss.backward()
+        average_gradients(self.optimizers[0].param_groups)
+        grad_norms = clip_grad_norms(
+            self.optimizers[0].param_groups, self.opts.max_grad_norm
+        )
+        self.optimizers[0].step()
+        # Logged by train_batch, the update of the last segment of the batch
+        self.model.n_step_stats = (grad_norms, reinforce_loss.detach())
+
+        # The graph of the segment is freed, keep only the values
+        outputs[self.start :] = [o.detach() for o in outputs[self.start :]]
+        self.start = len(outputs)
+        self.prev_size = state.size.clone()
+        self.prev_entropy = entropy.detach()
+        checkpointer = getattr(self.model, "checkpointer", None)
+        if checkpointer is not None:
+            checkpointer.free()
+        return True
+
+
+class ActorLearnerPolicy(object):
+    """
+    act() and replay() of the ff policies for actor-learner training. The policy records the (features, mask)
+    inputs of every decoding step in the states list passed to its _inner, and masks the infeasible actions with
+    mask_value before its softmax.
+    """
+
+    mask_value = -1e6
+
+    def act(self, x, opts):
+        """
+        Rolls out the batch without keeping the graph, for the actors of actor-learner training.
+        :return: costs, log-likelihood and actions of the episodes, and the (features, mask) inputs of every step
+        (batch_size, v_size, ...) from which replay() recomputes the log-likelihood
+        """
+        states = []
+        _log_p, pi, cost, _ = self._inner(x, opts, states=states)
+        return (
+            -cost,
+            _log_p.sum(1),
+            pi,
+            (torch.stack([s for s, _ in states], 1), torch.stack([m for _, m in states], 1)),
+        )
+
+    def replay(self, states, actions, opts):
+        """
+        Log-likelihood and entropy of the actions of an actor under the current parameters. All the steps
+        are computed at once since the inputs of every step were recorded.
+        """
+        s, mask = states
+        probs = self.ff(s).reshape(mask.shape)
+        probs[mask] = self.mask_value
+        log_p = torch.log_softmax(probs, dim=2)
+        ll = log_p.gather(2, actions.unsqueeze(-1)).squeeze(-1)
+        entropy = step_entropy(log_p.flatten(0, 1), opts).view(mask.shape[:2]).sum(1)
+        return self._calc_log_likelihood(ll, entropy, None)
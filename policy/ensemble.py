@@ -0,0 +1,77 @@
+import copy
+import torch
+from torch import nn
+from torch.func import stack_module_state, functional_call, vmap
+
+
+class EnsembleMLP(nn.Module):
+    """
+    The MLPs of the members of an ensemble with their parameters stacked along a leading member dimension, all the
+    members are evaluated in one vectorized call.
+    """
+
+    def __init__(self, mlps):
+        super(EnsembleMLP, self).__init__()
+        params, _ = stack_module_state(mlps)
+        self.names = list(params.keys())
+        self.params = nn.ParameterList([nn.Parameter(params[k]) for k in self.names])
+        # Stateless copy of a member, only used for its structure (kept in a list so it is not registered)
+        self.base = [copy.deepcopy(mlps[0]).to("meta")]
+        self.num_members = len(mlps)
+        self.num_instances = None  # Set by the ensemble before each episode
+
+    def _call_member(self, params, s):
+        return functional_call(self.base[0], dict(zip(self.names, params)), (s,))
+
+    def forward(self, s):
+        # Trajectory k * num_instances + b belongs to member k % num_members
+        x = s.view(-1, self.num_members, self.num_instances, *s.shape[1:]).transpose(
+            0, 1
+        )
+        out = vmap(self._call_member)(tuple(self.params), x)
+        return out.transpose(0, 1).reshape(s.size(0), *out.shape[3:])
+
+
+class FFEnsemble(nn.Module):
+    """
+    opts.ensemble_size independently initialized copies of a feed-forward policy (ff, ff-hist, inv-ff or
+    inv-ff-hist) trained simultaneously on the same batches. Every member decodes its own copy of the batch, the
+    MLP of the policy is replaced by the vectorized MLPs of all the members.
+    """
+
+    def __init__(self, member_class, *args, **kwargs):
+        super(FFEnsemble, self).__init__()
+        opts = kwargs["opts"]
+        self.ensemble_size = opts.ensemble_size
+        members = [member_class(*args, **kwargs) for _ in range(self.ensemble_size)]
+        self.policy = members[0]
+        self.policy.ff = EnsembleMLP([m.ff for m in members])
+        self.model_name = self.policy.model_name
+        self.problem = self.policy.problem
+        ent_rates = opts.ensemble_ent_rates or [opts.ent_rate] * self.ensemble_size
+        assert (
+            len(ent_rates) == self.ensemble_size
+        ), "--ensemble_ent_rates needs one entropy rate per member"
+        self.register_buffer("ent_rates", torch.tensor(ent_rates))
+
+    @property
+    def decode_type(self):
+        return self.policy.decode_type
+
+    def set_decode_type(self, decode_type, temp=None):
+        self.policy.set_decode_type(decode_type, temp)
+
+    def member_mean(self, t):
+        """
+        Mean of a per-trajectory tensor over the trajectories of every member (ensemble_size).
+        """
+        return t.view(-1, self.ensemble_size, self.policy.ff.num_instances).mean((0, 2))
+
+    def forward(self, x, opts, optimizer, baseline, return_pi=False):
+        self.policy.ff.num_instances = x.num_graphs
+        _log_p, pi, cost, entropy = self.policy._inner(x, opts, optimizer)
+        ll, _ = self.policy._calc_log_likelihood(_log_p, entropy, None)
+        e = self.member_mean(entropy)  # Every member is regularized with its own rate
+        if return_pi:
+            return -cost, ll, pi, e
+        return -cost, ll, e
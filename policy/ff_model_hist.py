@@ -1,9 +1,19 @@
 import torch
 from torch import nn
 import math
+from policy.common import (
+    NStepTrainer,
+    step_entropy,
+    get_num_rollouts,
+    ActorLearnerPolicy,
+)
+from utils.profiling import profiled
+from utils.pipelined_rollout import model_phase
 
 
-class FeedForwardModelHist(nn.Module):
+class FeedForwardModelHist(ActorLearnerPolicy, nn.Module):
+    mask_value = -1e8
+
     def __init__(
         self,
         embedding_dim,
@@ -54,23 +64,20 @@ class FeedForwardModelHist(nn.Module):
 
     def forward(self, x, opts, optimizer, baseline, return_pi=False):
 
-        _log_p, pi, cost = self._inner(x, opts)
+        _log_p, pi, cost, entropy = self._inner(x, opts, optimizer)
 
         # cost, mask = self.problem.get_costs(input, pi)
         # Log likelyhood is calculated within the model since returning it per action does not work well with
         # DataParallel since sequences can be of different lengths
-        ll, e = self._calc_log_likelihood(_log_p, pi, None)
+        ll, e = self._calc_log_likelihood(_log_p, entropy, None)
         if return_pi:
             return -cost, ll, pi, e
         # print(ll)
         return -cost, ll, e
 
-    def _calc_log_likelihood(self, _log_p, a, mask):
+    def _calc_log_likelihood(self, log_p, entropy, mask):
 
-        # Get log_p corresponding to selected actions
-        # print(a[0, :])
-        entropy = -(_log_p * _log_p.exp()).sum(2).sum(1).mean()
-        log_p = _log_p.gather(2, a.unsqueeze(-1)).squeeze(-1)
+        # log_p holds the log-probabilities of the selected actions (batch_size, v_size)
 
         # Optional: mask out actions irrelevant to objective so they do not get reinforced
         if mask is not None:
@@ -83,13 +90,25 @@ class FeedForwardModelHist(nn.Module):
 
         # Calculate log_likelihood
         # print(_log_p)
-        return log_p.sum(1), entropy
+        return log_p.sum(1), entropy.mean()
 
-    def _inner(self, input, opts):
+    def _inner(self, input, opts, optimizer=None, states=None):
 
         outputs = []
         sequences = []
-        state = self.problem.make_state(input, opts.u_size, opts.v_size, opts)
+        entropy = 0.0
+        state = self.problem.make_state(
+            input,
+            opts.u_size,
+            opts.v_size,
+            opts,
+            num_rollouts=get_num_rollouts(self.decode_type, opts),
+        )
+        n_step = (
+            NStepTrainer(self, optimizer, state, opts)
+            if NStepTrainer.is_active(optimizer, opts)
+            else None
+        )
 
         i = 1.0
         while not (state.all_finished()):
@@ -97,24 +116,33 @@ class FeedForwardModelHist(nn.Module):
             state.get_current_weights(mask)
 
             s, mask = state.get_curr_state(self.model_name)
-            pi = self.ff(s)
+            if states is not None:
+                states.append((s, mask.bool()))
+            with model_phase("policy/ff"):
+                pi = self.ff(s)
             # Select the indices of the next nodes in the sequences, result (batch_size) long
             selected, p = self._select_node(pi, mask.bool())
             state = state.update((selected)[:, None])
-            outputs.append(p)
+            # Keep only the log-probability of the selected action and a running entropy
+            outputs.append(p.gather(1, selected.unsqueeze(-1)).squeeze(-1))
+            entropy = entropy + step_entropy(p, opts)
             sequences.append(selected)
+            if n_step is not None and n_step.step(outputs, entropy, state):
+                entropy = entropy.detach()
             i += 1.0
         # Collected lists, return Tensor
         return (
             torch.stack(outputs, 1),
             torch.stack(sequences, 1),
             state.size,
+            entropy,
         )
 
+    @profiled("policy/select")
     def _select_node(self, probs, mask):
         assert (probs == probs).all(), "Probs should not contain any nans"
 
-        probs[mask] = -1e8
+        probs[mask] = self.mask_value
         p = torch.log_softmax(probs, dim=1)
         if self.decode_type == "greedy":
             _, selected = p.max(1)
@@ -130,6 +158,13 @@ class FeedForwardModelHist(nn.Module):
                 print("Sampled bad values, resampling!")
                 selected = p.exp().multinomial(1).squeeze(1)
 
+        elif self.decode_type == "self-critical":
+            # Sample the first half of the trajectories, decode the second half greedily
+            half = p.size(0) // 2
+            selected = torch.cat(
+                (p[:half].exp().multinomial(1).squeeze(1), p[half:].max(1)[1])
+            )
+
         else:
             assert False, "Unknown decode type"
         return selected, p
@@ -2,6 +2,7 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.nn import DataParallel
+from utils.profiling import phase, profiled
 
 
 def set_decode_type(model, decode_type):
@@ -29,6 +30,19 @@ def get_loss(log_p, y, optimizers, w, opts):
     return loss
 
 
+def get_class_weights(opts):
+    # The skip action is down-weighted as it is the optimal action for most arrivals when v_size > u_size
+    if opts.problem != "adwords":
+        none_node_w = torch.tensor(
+            [1.0 / (opts.v_size / opts.u_size)], device=opts.device
+        ).float()
+    else:
+        none_node_w = torch.tensor([1.0], device=opts.device).float()
+    return torch.cat(
+        [none_node_w, torch.ones(opts.u_size, device=opts.device).float()], dim=0,
+    )
+
+
 class SupervisedFFModel(nn.Module):
     def __init__(
         self,
@@ -69,6 +83,8 @@ class SupervisedFFModel(nn.Module):
             nn.ReLU(),
             nn.Linear(100, opts.u_size + 1),
         )
+        # (teacher-forced, on-policy) feature datasets used with --teacher_forcing, see train_epoch_teacher_forced
+        self.feature_cache = None
 
     def forward(
         self,
@@ -129,7 +145,8 @@ class SupervisedFFModel(nn.Module):
             w = state.get_current_weights(mask)
             s, mask = state.get_curr_state(self.model_name)
             # s = w
-            pi = self.ff(s)
+            with phase("policy/ff"):
+                pi = self.ff(s)
             # Select the indices of the next nodes in the sequences, result (batch_size) long
             # if training:
             #     mask = torch.zeros(mask.shape, device=opts.device)
@@ -143,16 +160,7 @@ class SupervisedFFModel(nn.Module):
             sequences.append(selected)
 
             # do backprop if in training mode
-            if opts.problem != "adwords":
-                none_node_w = torch.tensor(
-                    [1.0 / (opts.v_size / opts.u_size)], device=opts.device
-                ).float()
-            else:
-                none_node_w = torch.tensor([1.0], device=opts.device).float()
-            w = torch.cat(
-                [none_node_w, torch.ones(opts.u_size, device=opts.device).float()],
-                dim=0,
-            )
+            w = get_class_weights(opts)
             # supervised learning
             y = opt_match[:, i - 1]
             # print('y: ', y)
@@ -165,14 +173,7 @@ class SupervisedFFModel(nn.Module):
         # Collected lists, return Tensor
         batch_loss = total_loss / state.v_size
         # print(batch_loss)
-        if optimizer is not None and training:
-            # print('epoch {} batch loss {}'.format(i, batch_loss))
-            # print('outputs: ', outputs)
-            # print('sequences: ', sequences)
-            # print('optimal solution: ', opt_match)
-            optimizer[0].zero_grad()
-            batch_loss.backward()
-            optimizer[0].step()
+        # The backward pass and optimizer step are done by train_batch_supervised (with gradient accumulation)
         return (
             torch.stack(outputs, 1),
             torch.stack(sequences, 1),
@@ -180,6 +181,34 @@ class SupervisedFFModel(nn.Module):
             batch_loss,
         )
 
+    def collect_features(self, input, opt_match, opts, teacher_forcing=True):
+        """
+        Runs the episodes of the batch and returns the state features of every arrival
+        (batch_size * v_size, num_actions) labelled with its optimal action (batch_size * v_size).
+        :param teacher_forcing: step the environment with the optimal actions, otherwise with the greedy
+        actions of the model so that the states are the ones visited by the current policy (DAgger)
+        """
+        features = []
+        labels = []
+        state = self.problem.make_state(input, opts.u_size, opts.v_size, opts)
+        i = 1
+        while not (state.all_finished()):
+            # As in _inner, get_current_weights adds the weights of the arrival to the state (osbm)
+            mask = state.get_mask()
+            state.get_current_weights(mask)
+            s, mask = state.get_curr_state(self.model_name)
+            y = opt_match[:, i - 1].long()
+            features.append(s)
+            labels.append(y)
+            if teacher_forcing:
+                selected = y
+            else:
+                selected, _ = self._select_node(self.ff(s), mask.bool())
+            state = state.update((selected)[:, None])
+            i += 1
+        return torch.cat(features, 0), torch.cat(labels, 0)
+
+    @profiled("policy/select")
     def _select_node(self, probs, mask):
         assert (probs == probs).all(), "Probs should not contain any nans"
         mask[:, 0] = False
@@ -1,6 +1,5 @@
 import torch
 from torch import nn
-from torch.utils.checkpoint import checkpoint
 import math
 
 from encoder.graph_encoder_v2 import GraphAttentionEncoder
@@ -8,6 +7,10 @@ from encoder.graph_encoder_v2 import GraphAttentionEncoder
 from encoder.graph_encoder import MPNN
 from torch.nn import DataParallel
 from torch_geometric.utils import subgraph
+from utils.checkpointing import EncoderCheckpointer
+from policy.common import NStepTrainer, step_entropy, get_num_rollouts
+from utils.profiling import phase, profiled
+from utils.pipelined_rollout import model_phase
 
 
 def set_decode_type(model, decode_type):
@@ -77,6 +80,9 @@ class GNNHist(nn.Module):
         self.initial_stepcontext = nn.Parameter(torch.Tensor(1, 1, embedding_dim))
         self.initial_stepcontext.data.uniform_(-1, 1)
         self.dummy = torch.ones(1, dtype=torch.float32, requires_grad=True)
+        self.checkpointer = EncoderCheckpointer(
+            opts.checkpoint_policy, opts.checkpoint_every, opts.checkpoint_budget
+        )
         self.model_name = "gnn-hist"
 
     def init_parameters(self):
@@ -91,22 +97,20 @@ class GNNHist(nn.Module):
 
     def forward(self, x, opts, optimizer, baseline, return_pi=False):
 
-        _log_p, pi, cost = self._inner(x, opts)
+        _log_p, pi, cost, entropy = self._inner(x, opts, optimizer)
 
         # cost, mask = self.problem.get_costs(input, pi)
         # Log likelyhood is calculated within the model since returning it per action does not work well with
         # DataParallel since sequences can be of different lengths
-        ll, e = self._calc_log_likelihood(_log_p, pi, None)
+        ll, e = self._calc_log_likelihood(_log_p, entropy, None)
         if return_pi:
             return -cost, ll, pi, e
         # print(ll)
         return -cost, ll, e
 
-    def _calc_log_likelihood(self, _log_p, a, mask):
+    def _calc_log_likelihood(self, log_p, entropy, mask):
 
-        entropy = -(_log_p * _log_p.exp()).sum(2).sum(1).mean()
-        # Get log_p corresponding to selected actions
-        log_p = _log_p.gather(2, a.unsqueeze(-1)).squeeze(-1)
+        # log_p holds the log-probabilities of the selected actions (batch_size, v_size)
 
         # Optional: mask out actions irrelevant to objective so they do not get reinforced
         if mask is not None:
@@ -120,17 +124,30 @@ class GNNHist(nn.Module):
         # Calculate log_likelihood
         # print(log_p.sum(1))
 
-        return log_p.sum(1), entropy
+        return log_p.sum(1), entropy.mean()
 
-    def _inner(self, input, opts):
+    def _inner(self, input, opts, optimizer=None):
 
         outputs = []
         sequences = []
+        entropy = 0.0
 
-        state = self.problem.make_state(input, opts.u_size, opts.v_size, opts)
+        state = self.problem.make_state(
+            input,
+            opts.u_size,
+            opts.v_size,
+            opts,
+            num_rollouts=get_num_rollouts(self.decode_type, opts),
+        )
+        n_step = (
+            NStepTrainer(self, optimizer, state, opts)
+            if NStepTrainer.is_active(optimizer, opts)
+            else None
+        )
 
         batch_size = state.batch_size
         graph_size = state.u_size + state.v_size + 1
+        self.checkpointer.reset()
         i = 1
         step_context = 0.0
         while not (state.all_finished()):
@@ -152,27 +169,31 @@ class GNNHist(nn.Module):
                 ).unsqueeze(1)
             ).flatten()  # The nodes of the current subgraphs
             graph_weights = state.get_graph_weights()
-            edge_i, weights = subgraph(
-                subgraphs,
-                state.graphs.edge_index,
-                graph_weights.unsqueeze(1),
-                relabel_nodes=True,
-            )
-            embeddings = checkpoint(
-                self.embedder,
-                node_features,
-                edge_i,
-                weights.float(),
-                torch.tensor(i),
-                self.dummy,
-                # opts,
-            ).reshape(batch_size, step_size, -1)
+            with phase("policy/subgraph"):
+                edge_i, weights = subgraph(
+                    subgraphs,
+                    state.get_edge_index(),
+                    graph_weights.unsqueeze(1),
+                    relabel_nodes=True,
+                )
+            with model_phase("policy/encoder"):
+                embeddings = self.checkpointer(
+                    self.embedder,
+                    i,
+                    edge_i.size(1),
+                    node_features,
+                    edge_i,
+                    weights.float(),
+                    torch.tensor(i),
+                    self.dummy,
+                    # opts,
+                ).reshape(batch_size, step_size, -1)
             pos = torch.argsort(state.idx[:i])[-1]
             incoming_node_embeddings = embeddings[
                 :, pos + state.u_size + 1, :
             ].unsqueeze(1)
             # print(incoming_node_embeddings)
-            w = (state.adj[:, state.get_current_node(), :]).float()
+            w = (state.get_current_adj()).float()
             # mean_w = w.mean(1)[:, None, None].repeat(1, state.u_size + 1, 1)
             s = w.reshape(state.batch_size, state.u_size + 1, 1)
             idx = (
@@ -229,23 +250,30 @@ class GNNHist(nn.Module):
                 ),
                 dim=2,
             ).float()
-            pi = self.ff(s).reshape(state.batch_size, state.u_size + 1)
+            with model_phase("policy/ff"):
+                pi = self.ff(s).reshape(state.batch_size, state.u_size + 1)
             # Select the indices of the next nodes in the sequences, result (batch_size) long
             selected, p = self._select_node(
                 pi, mask.bool()
             )  # Squeeze out steps dimension
             # entropy += torch.sum(p * (p.log()), dim=1)
             state = state.update((selected)[:, None])
-            outputs.append(p)
+            # Keep only the log-probability of the selected action and a running entropy
+            outputs.append(p.gather(1, selected.unsqueeze(-1)).squeeze(-1))
+            entropy = entropy + step_entropy(p, opts)
             sequences.append(selected)
+            if n_step is not None and n_step.step(outputs, entropy, state):
+                entropy = entropy.detach()
             i += 1
         # Collected lists, return Tensor
         return (
             torch.stack(outputs, 1),
             torch.stack(sequences, 1),
             state.size,
+            entropy,
         )
 
+    @profiled("policy/select")
     def _select_node(self, probs, mask):
         assert (probs == probs).all(), "Probs should not contain any nans"
         probs[mask] = -1e6
@@ -265,6 +293,13 @@ class GNNHist(nn.Module):
             #     print("Sampled bad values, resampling!")
             #     selected = probs.multinomial(1).squeeze(1)
 
+        elif self.decode_type == "self-critical":
+            # Sample the first half of the trajectories, decode the second half greedily
+            half = p.size(0) // 2
+            selected = torch.cat(
+                (p[:half].exp().multinomial(1).squeeze(1), p[half:].max(1)[1])
+            )
+
         else:
             assert False, "Unknown decode type"
         return selected, p
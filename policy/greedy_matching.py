@@ -32,7 +32,7 @@ class GreedyMatching(nn.Module):
         state = self.problem.make_state(x, opts.u_size, opts.v_size, opts)
         t = opts.threshold
         sequences = []
-        batch_size = opts.batch_size
+        batch_size = state.batch_size
         graph_size = opts.u_size + opts.v_size + 1
         i = 1
         while not (state.all_finished()):
@@ -52,7 +52,7 @@ class GreedyRt(nn.Module):
         t = torch.tensor(
             np.e
             ** np.random.randint(
-                1, np.ceil(np.log(1 + self.max_weight)), (opts.batch_size, 1)
+                1, np.ceil(np.log(1 + self.max_weight)), (state.batch_size, 1)
             ),
             device=opts.device,
         )
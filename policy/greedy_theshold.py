@@ -26,10 +26,25 @@ class GreedyThresh(nn.Module):
         self.problem = problem
         self.model_name = "greedy-t"
         self.best_threshold = get_best_t(self.model_name, opts)
+        self.thresholds = None  # Set to decode every instance with each of these thresholds at once
 
     def forward(self, x, opts, optimizer, baseline, return_pi=False):
-        state = self.problem.make_state(x, opts.u_size, opts.v_size, opts)
+        assert self.thresholds is not None or self.best_threshold is not None, (
+            "No tuned threshold for {}/{} {}x{}, run --tune_baseline for this problem and graph family "
+            "first".format(
+                opts.problem, opts.graph_family, opts.u_size, opts.v_size
+            )
+        )
+        num_rollouts = 1 if self.thresholds is None else self.thresholds.size(0)
+        state = self.problem.make_state(
+            x, opts.u_size, opts.v_size, opts, num_rollouts=num_rollouts
+        )
         t = self.best_threshold
+        if self.thresholds is not None:
+            # Trajectory k * num_instances + b decodes instance b with threshold k
+            t = self.thresholds.repeat_interleave(
+                state.batch_size // num_rollouts
+            ).unsqueeze(1)
         sequences = []
         while not (state.all_finished()):
             mask = state.get_mask()
@@ -1,8 +1,18 @@
 import torch
 from torch import nn
+from policy.common import (
+    NStepTrainer,
+    step_entropy,
+    get_num_rollouts,
+    ActorLearnerPolicy,
+)
+from utils.profiling import profiled
+from utils.pipelined_rollout import model_phase
 
 
-class InvariantFFHist(nn.Module):
+class InvariantFFHist(ActorLearnerPolicy, nn.Module):
+    mask_value = -1e8
+
     def __init__(
         self,
         embedding_dim,
@@ -37,19 +47,17 @@ class InvariantFFHist(nn.Module):
 
     def forward(self, x, opts, optimizer, baseline, return_pi=False):
 
-        _log_p, pi, cost = self._inner(x, opts)
+        _log_p, pi, cost, entropy = self._inner(x, opts, optimizer)
 
-        ll, e = self._calc_log_likelihood(_log_p, pi, None)
+        ll, e = self._calc_log_likelihood(_log_p, entropy, None)
         if return_pi:
             return -cost, ll, pi, e
 
         return -cost, ll, e
 
-    def _calc_log_likelihood(self, _log_p, a, mask):
+    def _calc_log_likelihood(self, log_p, entropy, mask):
 
-        # Get log_p corresponding to selected actions
-        entropy = -(_log_p * _log_p.exp()).sum(2).sum(1).mean()
-        log_p = _log_p.gather(2, a.unsqueeze(-1)).squeeze(-1)
+        # log_p holds the log-probabilities of the selected actions (batch_size, v_size)
 
         # Optional: mask out actions irrelevant to objective so they do not get reinforced
         if mask is not None:
@@ -60,13 +68,25 @@ class InvariantFFHist(nn.Module):
             log_p > -1e8
         ).data.all(), "Logprobs should not be -inf, check sampling procedure!"
         # Calculate log_likelihood
-        return log_p.sum(1), entropy
+        return log_p.sum(1), entropy.mean()
 
-    def _inner(self, input, opts):
+    def _inner(self, input, opts, optimizer=None, states=None):
 
         outputs = []
         sequences = []
-        state = self.problem.make_state(input, opts.u_size, opts.v_size, opts)
+        entropy = 0.0
+        state = self.problem.make_state(
+            input,
+            opts.u_size,
+            opts.v_size,
+            opts,
+            num_rollouts=get_num_rollouts(self.decode_type, opts),
+        )
+        n_step = (
+            NStepTrainer(self, optimizer, state, opts)
+            if NStepTrainer.is_active(optimizer, opts)
+            else None
+        )
 
         # Perform decoding steps
         i = 1
@@ -74,26 +94,35 @@ class InvariantFFHist(nn.Module):
             mask = state.get_mask()
             state.get_current_weights(mask)
             s, mask = state.get_curr_state(self.model_name)
-            pi = self.ff(s).reshape(state.batch_size, state.u_size + 1)
+            if states is not None:
+                states.append((s, mask.bool()))
+            with model_phase("policy/ff"):
+                pi = self.ff(s).reshape(state.batch_size, state.u_size + 1)
             # Select the indices of the next nodes in the sequences, result (batch_size) long
             selected, p = self._select_node(
                 pi, mask.bool()
             )  # Squeeze out steps dimension
             # entropy += torch.sum(p * (p.log()), dim=1)
             state = state.update((selected)[:, None])
-            outputs.append(p)
+            # Keep only the log-probability of the selected action and a running entropy
+            outputs.append(p.gather(1, selected.unsqueeze(-1)).squeeze(-1))
+            entropy = entropy + step_entropy(p, opts)
             sequences.append(selected)
+            if n_step is not None and n_step.step(outputs, entropy, state):
+                entropy = entropy.detach()
             i += 1
         # Collected lists, return Tensor
         return (
             torch.stack(outputs, 1),
             torch.stack(sequences, 1),
             state.size,
+            entropy,
         )
 
+    @profiled("policy/select")
     def _select_node(self, probs, mask):
         assert (probs == probs).all(), "Probs should not contain any nans"
-        probs[mask] = -1e8
+        probs[mask] = self.mask_value
         p = torch.log_softmax(probs, dim=1)
         # print(p)
         if self.decode_type == "greedy":
@@ -110,6 +139,13 @@ class InvariantFFHist(nn.Module):
             #     print("Sampled bad values, resampling!")
             #     selected = p.exp().multinomial(1).squeeze(1)
 
+        elif self.decode_type == "self-critical":
+            # Sample the first half of the trajectories, decode the second half greedily
+            half = p.size(0) // 2
+            selected = torch.cat(
+                (p[:half].exp().multinomial(1).squeeze(1), p[half:].max(1)[1])
+            )
+
         else:
             assert False, "Unknown decode type"
         return selected, p
@@ -9,7 +9,7 @@ import torch.nn.functional as F
 # from utils.tensor_functions import compute_in_batches
 
 from encoder.graph_encoder_v2 import GraphAttentionEncoder
-from train import clip_grad_norms
+from policy.common import clip_grad_norms
 
 from encoder.graph_encoder import MPNN
 from torch.nn import DataParallel
@@ -18,6 +18,7 @@ from torch_geometric.utils import subgraph
 # from utils.functions import sample_many
 
 import time
+from utils.profiling import phase, profiled
 
 
 def set_decode_type(model, decode_type):
@@ -31,7 +32,7 @@ def train_supervised(log_p, y, optimizers, opts):
     total_loss = torch.zeros(y.shape)
 
     # Calculate loss of v_t
-    if opts.batch_size == 1:
+    if log_p.size(0) == 1:
         loss_t = -torch.gather(log_p, 1, torch.unsqueeze(y, 0))
     else:
         loss_t = -torch.gather(log_p, 1, torch.unsqueeze(y, 1))
@@ -178,7 +179,8 @@ class SupervisedModel(nn.Module):
         return self.problem.beam_search(*args, **kwargs, model=self)
 
     def precompute_fixed(self, input):
-        embeddings, _ = self.embedder(self._init_embed(input))
+        with phase("policy/encoder"):
+            embeddings, _ = self.embedder(self._init_embed(input))
         # Use a CachedLookup such that if we repeatedly index this object with the same index we only need to do
         # the lookup once... this is the case if all elements in the batch have maximum batch size
         return CachedLookup(self._precompute(embeddings))
@@ -235,25 +237,27 @@ class SupervisedModel(nn.Module):
                     0, batch_size * graph_size, graph_size, device=opts.device
                 ).unsqueeze(1)
             ).flatten()  # The nodes of the current subgraphs
-            edge_i, weights = subgraph(
-                subgraphs,
-                state.graphs.edge_index,
-                state.graphs.weight.unsqueeze(1),
-                relabel_nodes=True,
-            )
-            if i % opts.checkpoint_every == 0:
-                embeddings = checkpoint(
-                    self.embedder, 
-                    node_features, 
-                    edge_i,
-                    weights.float(),
-                    torch.tensor(i),
-                    self.dummy
-                ).reshape(batch_size, step_size, -1)
-            else:
-                embeddings = self.embedder(
-                    node_features, edge_i, weights.float(), self.dummy,
-                ).reshape(batch_size, step_size, -1)
+            with phase("policy/subgraph"):
+                edge_i, weights = subgraph(
+                    subgraphs,
+                    state.graphs.edge_index,
+                    state.graphs.weight.unsqueeze(1),
+                    relabel_nodes=True,
+                )
+            with phase("policy/encoder"):
+                if i % opts.checkpoint_every == 0:
+                    embeddings = checkpoint(
+                        self.embedder, 
+                        node_features, 
+                        edge_i,
+                        weights.float(),
+                        torch.tensor(i),
+                        self.dummy
+                    ).reshape(batch_size, step_size, -1)
+                else:
+                    embeddings = self.embedder(
+                        node_features, edge_i, weights.float(), self.dummy,
+                    ).reshape(batch_size, step_size, -1)
             
             # context node embedding
             fixed = self._precompute(embeddings, step_size, opts, state)
@@ -323,6 +327,7 @@ class SupervisedModel(nn.Module):
             batch_loss 
         )
 
+    @profiled("policy/select")
     def _select_node(self, probs, mask):
         assert (probs == probs).all(), "Probs should not contain any nans"
         _, selected = probs.max(1)
@@ -2,6 +2,8 @@ from torch_geometric.data import Dataset
 import torch
 from problem_state.adwords_env import StateAdwordsBipartite
 from data.generate_data import generate_adwords_data_geometric
+from utils.profiling import profiled
+from utils.state_cache import reuse_initial_state
 
 
 class AdwordsBipartite(object):
@@ -13,6 +15,8 @@ class AdwordsBipartite(object):
         return AdwordsBipartiteDataset(*args, **kwargs)
 
     @staticmethod
+    @profiled("env/make_state")
+    @reuse_initial_state
     def make_state(*args, **kwargs):
         return StateAdwordsBipartite.initialize(*args, **kwargs)
 
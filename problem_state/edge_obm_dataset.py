@@ -4,6 +4,8 @@ import os
 import pickle
 from problem_state.edge_obm_env import StateEdgeBipartite
 from data.generate_data import generate_edge_obm_data_geometric
+from utils.profiling import profiled
+from utils.state_cache import reuse_initial_state
 
 
 class EdgeBipartite(object):
@@ -15,6 +17,8 @@ class EdgeBipartite(object):
         return EdgeBipartiteDataset(*args, **kwargs)
 
     @staticmethod
+    @profiled("env/make_state")
+    @reuse_initial_state
     def make_state(*args, **kwargs):
         return StateEdgeBipartite.initialize(*args, **kwargs)
 
@@ -1,6 +1,7 @@
 import torch
 from typing import NamedTuple
 from torch_geometric.utils import to_dense_adj
+from utils.profiling import profiled
 
 # from utils.boolmask import mask_long2bool, mask_long_scatter
 
@@ -26,6 +27,9 @@ class StateEdgeBipartite(NamedTuple):
     i: int  # Keeps track of step
     opts: dict
     idx: torch.Tensor
+    # Number of trajectories per instance, the dense adjacency is shared by the rollouts of an instance
+    num_rollouts: int = 1
+    edge_index: torch.Tensor = None  # edges of the graphs, repeated for each rollout
 
     @staticmethod
     def initialize(
@@ -33,14 +37,23 @@ class StateEdgeBipartite(NamedTuple):
         u_size,
         v_size,
         opts,
+        num_rollouts=1,
     ):
         graph_size = u_size + v_size + 1
-        batch_size = int(input.batch.size(0) / graph_size)
+        num_instances = int(input.batch.size(0) / graph_size)
+        batch_size = num_instances * num_rollouts  # Number of trajectories
         # print(batch_size, input.batch.size(0), graph_size)
         adj = to_dense_adj(
             input.edge_index, input.batch, input.weight.unsqueeze(1)
         ).squeeze(-1)
         adj = adj[:, u_size + 1 :, : u_size + 1]
+        edge_index = torch.cat(
+            [
+                input.edge_index + k * num_instances * graph_size
+                for k in range(num_rollouts)
+            ],
+            dim=1,
+        )
 
         # permute the nodes for data
         idx = torch.arange(adj.shape[1], device=opts.device)
@@ -94,6 +107,8 @@ class StateEdgeBipartite(NamedTuple):
             i=u_size + 1,
             opts=opts,
             idx=idx,
+            num_rollouts=num_rollouts,
+            edge_index=edge_index,
         )
 
     def get_final_cost(self):
@@ -103,20 +118,53 @@ class StateEdgeBipartite(NamedTuple):
 
         return self.size
 
+    @profiled("env/get_current_weights")
     def get_current_weights(self, mask):
-        return self.adj[:, 0, :].float()
+        return self._tile(self.adj[:, 0, :]).float()
 
     def get_graph_weights(self):
-        return self.graphs.weight
+        return self._tile(self.graphs.weight)
+
+    def _tile(self, t):
+        """
+        Repeats a tensor of the instances (num_instances, ...) for each of their rollouts (batch_size, ...),
+        trajectory k of instance b is at position k * num_instances + b. This copies the instance rows, it is
+        only used for the tensors handed to the policies, the env steps broadcast with _by_instance instead.
+        """
+        if self.num_rollouts == 1:
+            return t
+        return (
+            t.unsqueeze(0)
+            .expand(self.num_rollouts, *t.shape)
+            .reshape(-1, *t.shape[1:])
+        )
+
+    def _by_instance(self, t):
+        """
+        View of a tensor of the trajectories (batch_size, ...) as (num_rollouts, num_instances, ...), it
+        broadcasts against the tensors of the instances (num_instances, ...) without copying them.
+        """
+        return t.view(self.num_rollouts, -1, *t.shape[1:])
+
+    def _instances(self):
+        # Instance of every trajectory
+        return torch.arange(self.batch_size, device=self.adj.device) % self.adj.size(0)
+
+    def get_edge_index(self):
+        return self.edge_index
 
+    def get_current_adj(self):
+        return self._tile(self.adj[:, self.get_current_node(), :])
+
+    @profiled("env/update")
     def update(self, selected):
         # Update the state
         nodes = self.matched_nodes.scatter_(-1, selected, 1)
         nodes[
             :, 0
         ] = 0  # node that represents not being matched to anything can be matched to more than once
-        w = self.adj[:, 0, :].clone()
-        selected_weights = w.gather(1, selected).to(self.adj.device)
+        w = self.adj[:, 0, :]  # (num_instances, u_size + 1), shared by the rollouts
+        selected_weights = w[self._instances(), selected.squeeze(1)].unsqueeze(1)
         skip = (selected == 0).float()
         num_skip = self.num_skip + skip
         if self.i == self.u_size + 1:
@@ -133,9 +181,15 @@ class StateEdgeBipartite(NamedTuple):
         total_weights = self.size + selected_weights
         sum_sol_sq = self.sum_sol_sq + selected_weights ** 2
 
-        hist_sum = self.hist_sum + w.unsqueeze(1)
-        hist_sum_sq = self.hist_sum_sq + w.unsqueeze(1) ** 2
-        hist_deg = self.hist_deg + (w.unsqueeze(1) != 0).float()
+        hist_sum = (self._by_instance(self.hist_sum) + w.unsqueeze(1)).view_as(
+            self.hist_sum
+        )
+        hist_sum_sq = (
+            self._by_instance(self.hist_sum_sq) + w.unsqueeze(1) ** 2
+        ).view_as(self.hist_sum_sq)
+        hist_deg = (
+            self._by_instance(self.hist_deg) + (w.unsqueeze(1) != 0).float()
+        ).view_as(self.hist_deg)
         hist_deg[:, :, 0] = float(self.i - self.u_size)
         return self._replace(
             matched_nodes=nodes,
@@ -158,10 +212,11 @@ class StateEdgeBipartite(NamedTuple):
     def get_current_node(self):
         return 0
 
+    @profiled("env/get_curr_state")
     def get_curr_state(self, model):
         mask = self.get_mask()
         opts = self.opts
-        w = self.adj[:, 0, :].float().clone()
+        w = self._tile(self.adj[:, 0, :]).float().clone()
         s = None
         if model == "ff":
             s = torch.cat((w, mask.float()), dim=1)
@@ -261,6 +316,7 @@ class StateEdgeBipartite(NamedTuple):
 
         return s, mask
 
+    @profiled("env/get_node_features")
     def get_node_features(self):
         step_size = self.i + 1
         batch_size = self.batch_size
@@ -280,6 +336,7 @@ class StateEdgeBipartite(NamedTuple):
 
         return node_features
 
+    @profiled("env/get_hist_features")
     def get_hist_features(self):
         i = self.i - (self.u_size + 1)
         if i != 0:
@@ -332,6 +389,7 @@ class StateEdgeBipartite(NamedTuple):
             n_skip,
         )
 
+    @profiled("env/get_mask")
     def get_mask(self):
         """
         Returns a mask vector which includes only nodes in U that can matched.
@@ -344,5 +402,7 @@ class StateEdgeBipartite(NamedTuple):
             :, 0
         ] = 0  # node that represents not being matched to anything can be matched to more than once
         return (
-            self.matched_nodes + mask > 0
+            (self._by_instance(self.matched_nodes) + mask > 0).view_as(
+                self.matched_nodes
+            )
         ).long()  # Hacky way to return bool or uint8 depending on pytorch version
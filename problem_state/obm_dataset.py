@@ -3,6 +3,7 @@ import torch
 import os
 import pickle
 from problem_state.obm_env import StateBipartite
+from utils.profiling import profiled
 
 
 class Bipartite(object):
@@ -31,6 +32,7 @@ class Bipartite(object):
         return BipartiteDataset(*args, **kwargs)
 
     @staticmethod
+    @profiled("env/make_state")
     def make_state(*args, **kwargs):
         return StateBipartite.initialize(*args, **kwargs)
 
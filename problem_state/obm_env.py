@@ -1,5 +1,6 @@
 import torch
 from typing import NamedTuple
+from utils.profiling import profiled
 
 # from utils.boolmask import mask_long2bool, mask_long_scatter
 
@@ -78,6 +79,7 @@ class StateBipartite(NamedTuple):
 
         return self.size
 
+    @profiled("env/update")
     def update(self, selected):
         # Update the state
         nodes = self.matched_nodes.squeeze(1).scatter_(-1, selected, 1)
@@ -93,6 +95,7 @@ class StateBipartite(NamedTuple):
     def get_current_node(self):
         return self.i.item()
 
+    @profiled("env/get_mask")
     def get_mask(self):
         """
         Returns a mask vector which includes only nodes in U that can matched.
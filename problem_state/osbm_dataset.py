@@ -4,6 +4,8 @@ import os
 import pickle
 from problem_state.osbm_env import StateOSBM
 from data.generate_data import generate_osbm_data_geometric
+from utils.profiling import profiled
+from utils.state_cache import reuse_initial_state
 
 
 class OSBM(object):
@@ -15,6 +17,8 @@ class OSBM(object):
         return OSBMDataset(*args, **kwargs)
 
     @staticmethod
+    @profiled("env/make_state")
+    @reuse_initial_state
     def make_state(*args, **kwargs):
         return StateOSBM.initialize(*args, **kwargs)
 
@@ -1,6 +1,7 @@
 import torch
 from typing import NamedTuple
 from torch_geometric.utils import to_dense_adj, sort_edge_index
+from utils.profiling import profiled
 
 
 class StateOSBM(NamedTuple):
@@ -28,6 +29,11 @@ class StateOSBM(NamedTuple):
     max_sol: torch.Tensor
     sum_sol_sq: torch.Tensor
     num_skip: torch.Tensor
+    # Number of trajectories per instance. The adjacency is rewritten with the weights of each trajectory
+    # during the episode, so unlike the other problems it is repeated for every rollout. The node features are
+    # fixed and kept once per instance
+    num_rollouts: int = 1
+    edge_index: torch.Tensor = None  # edges of the graphs, repeated for each rollout
 
     @staticmethod
     def initialize(
@@ -35,28 +41,35 @@ class StateOSBM(NamedTuple):
         u_size,
         v_size,
         opts,
+        num_rollouts=1,
     ):
         num_genres = 15
         num_users = 200
         graph_size = u_size + v_size + 1
-        batch_size = int(input.batch.size(0) / graph_size)
+        num_instances = int(input.batch.size(0) / graph_size)
+        batch_size = num_instances * num_rollouts  # Number of trajectories
         adj = to_dense_adj(input.edge_index, input.batch)[
             :, u_size + 1 :, : u_size + 1
         ].squeeze(-1)
-        u_features = input.x.reshape(batch_size, -1)[:, : u_size * num_genres].reshape(
-            batch_size, u_size, -1
-        )
+        u_features = input.x.reshape(num_instances, -1)[
+            :, : u_size * num_genres
+        ].reshape(num_instances, u_size, -1)
         # add features of future node
         u_features = torch.cat(
-            (torch.zeros(batch_size, 1, num_genres, device=opts.device), u_features),
+            (
+                torch.zeros(num_instances, 1, num_genres, device=opts.device),
+                u_features,
+            ),
             dim=1,
         )
         # print(u_features)
         offset = u_size * num_genres
 
-        v_features = input.x.reshape(batch_size, -1)[:, offset:].reshape(
-            batch_size, v_size, -1
+        v_features = input.x.reshape(num_instances, -1)[:, offset:].reshape(
+            num_instances, v_size, -1
         )
+        if num_rollouts > 1:
+            adj = adj.repeat(num_rollouts, 1, 1)
         idx = torch.arange(adj.shape[1], device=opts.device)
         # print(v_features)
         # permute the nodes for data
@@ -69,6 +82,10 @@ class StateOSBM(NamedTuple):
         edge_index, _ = sort_edge_index(input.edge_index)
         input.edge_index = edge_index
         input.weight = weights
+        edge_index = torch.cat(
+            [edge_index + k * num_instances * graph_size for k in range(num_rollouts)],
+            dim=1,
+        )
         return StateOSBM(
             graphs=input,
             adj=adj,
@@ -121,6 +138,8 @@ class StateOSBM(NamedTuple):
             num_users=num_users,
             opts=opts,
             idx=idx,
+            num_rollouts=num_rollouts,
+            edge_index=edge_index,
         )
 
     def get_final_cost(self):
@@ -129,22 +148,17 @@ class StateOSBM(NamedTuple):
 
         return self.size
 
+    @profiled("env/update")
     def update(self, selected):
         # Update the state
         v = self.idx[self.i - (self.u_size + 1)]
-        users_features = self.v_features[:, v, :]
+        users_features = self._tile(self.v_features[:, v, :])
         idx = (
-            selected
-            + torch.arange(
-                0,
-                self.batch_size * (self.u_size + 1),
-                (self.u_size + 1),
-                device=self.adj.device,
-            ).unsqueeze(1)
+            selected + (self._instances() * (self.u_size + 1)).unsqueeze(1)
         ).flatten()
 
         selected_movie_genre = self.u_features.reshape(
-            self.batch_size * (self.u_size + 1), -1
+            -1, self.u_features.size(-1)
         ).index_select(0, idx)
         users_idx = users_features[:, -1].int() + torch.arange(
             0, self.batch_size * self.num_users, self.num_users, device=self.adj.device
@@ -196,9 +210,10 @@ class StateOSBM(NamedTuple):
             sum_sol_sq=sum_sol_sq,
         )
 
+    @profiled("env/get_current_weights")
     def get_current_weights(self, mask, users_covered_genre=None):
         v = self.i - (self.u_size + 1)
-        users_features = self.v_features[:, v, :]
+        users_features = self._tile(self.v_features[:, v, :])
         if users_covered_genre is None:
             users_idx = users_features[:, -1].int() + torch.arange(
                 0,
@@ -209,10 +224,11 @@ class StateOSBM(NamedTuple):
             users_covered_genre = self.users.reshape(
                 self.batch_size * self.num_users, -1
             ).index_select(0, users_idx)
+        # Broadcasts the features of the instances against the trajectories
         covered_genres = (
-            (self.u_features + users_covered_genre.unsqueeze(1)).reshape(
-                self.batch_size, self.u_size + 1, -1
-            )
+            (
+                self.u_features + self._by_instance(users_covered_genre.unsqueeze(1))
+            ).reshape(self.batch_size, self.u_size + 1, -1)
             > 0
         ).float()
         prev = (
@@ -238,6 +254,32 @@ class StateOSBM(NamedTuple):
         self.adj[:, v, :] = w
         return
 
+    def _tile(self, t):
+        """
+        Repeats a tensor of the instances (num_instances, ...) for each of their rollouts (batch_size, ...),
+        trajectory k of instance b is at position k * num_instances + b. This copies the instance rows, it is
+        only used for the small per-step tensors and the ones handed to the policies.
+        """
+        if self.num_rollouts == 1:
+            return t
+        return (
+            t.unsqueeze(0)
+            .expand(self.num_rollouts, *t.shape)
+            .reshape(-1, *t.shape[1:])
+        )
+
+    def _by_instance(self, t):
+        """
+        View of a tensor of the trajectories (batch_size, ...) as (num_rollouts, num_instances, ...), it
+        broadcasts against the tensors of the instances (num_instances, ...) without copying them.
+        """
+        return t.view(self.num_rollouts, -1, *t.shape[1:])
+
+    def _instances(self):
+        # Instance of every trajectory
+        num_instances = self.u_features.size(0)
+        return torch.arange(self.batch_size, device=self.adj.device) % num_instances
+
     def get_graph_weights(self):
         graph_weights = torch.cat(
             (
@@ -250,6 +292,12 @@ class StateOSBM(NamedTuple):
 
         return graph_weights
 
+    def get_edge_index(self):
+        return self.edge_index
+
+    def get_current_adj(self):
+        return self.adj[:, self.get_current_node(), :]
+
     def all_finished(self):
         # Exactly v_size steps
         return (self.i - (self.u_size + 1)) >= self.v_size
@@ -258,6 +306,7 @@ class StateOSBM(NamedTuple):
         v = self.i - (self.u_size + 1)
         return self.idx[v]
 
+    @profiled("env/get_curr_state")
     def get_curr_state(self, model):
         mask = self.get_mask().float()
         opts = self.opts
@@ -360,17 +409,18 @@ class StateOSBM(NamedTuple):
 
         return s, mask
 
+    @profiled("env/get_node_features")
     def get_node_features(self):
 
         num_v = self.i - self.u_size
         batch_size = self.batch_size
-        incoming_node_features = self.v_features[
-            :, :num_v, self.num_genres : -1
-        ].reshape(
+        incoming_node_features = self._tile(
+            self.v_features[:, :num_v, self.num_genres : -1]
+        ).reshape(
             batch_size * num_v, -1
         )  # Collecting node features up until the ith incoming node
         fixed_node_feature = torch.cat(
-            (self.u_features, self.matched_nodes.unsqueeze(2)), dim=2
+            (self._tile(self.u_features), self.matched_nodes.unsqueeze(2)), dim=2
         ).reshape(batch_size * (self.u_size + 1), -1)
 
         node_features = torch.cat(
@@ -382,6 +432,7 @@ class StateOSBM(NamedTuple):
         )
         return node_features.float()
 
+    @profiled("env/get_hist_features")
     def get_hist_features(self):
         i = self.i - (self.u_size + 1)
         if i != 0:
@@ -434,6 +485,7 @@ class StateOSBM(NamedTuple):
             n_skip,
         )
 
+    @profiled("env/get_mask")
     def get_mask(self):
         """
         Returns a mask vector which includes only nodes in U that can matched.
@@ -6,6 +6,7 @@ import pprint as pp
 import torch
 import torch.optim as optim
 from itertools import product
+from functools import partial
 import wandb
 
 # from tensorboard_logger import Logger as TbLogger
@@ -14,7 +15,7 @@ from torch_geometric.data import DataLoader as geoDataloader
 
 # from nets.critic_network import CriticNetwork
 from options import get_options
-from train import train_epoch, validate, get_inner_model
+from train import train_epoch, validate, get_inner_model, sweep_thresholds
 from utils.reinforce_baselines import (
     NoBaseline,
     ExponentialBaseline,
@@ -38,9 +39,43 @@ from policy.ff_supervised import SupervisedFFModel
 from policy.gnn_hist import GNNHist
 from policy.gnn_simp_hist import GNNSimpHist
 from policy.gnn import GNN
+from policy.ensemble import FFEnsemble
 
 # from nets.pointer_network import PointerNetwork, CriticNetworkLSTM
-from utils.functions import torch_load_cpu, load_problem
+from utils.functions import (
+    torch_load_cpu,
+    load_problem,
+    get_threshold_results_file,
+)
+from utils.sweep import run_sweep
+from utils.autotune import autotune, apply_cached_interop_threads
+from utils.log_utils import MetricsLogger
+from utils.prioritized_sampling import IndexedDataset, PrioritizedSampler
+from utils.distributed import (
+    init_distributed,
+    is_main_process,
+    broadcast_parameters,
+    make_training_dataloader,
+)
+
+
+MODEL_CLASSES = {
+    "attention": AttentionModelgeo,
+    "ff": FeedForwardModel,
+    "greedy": Greedy,
+    "greedy-rt": GreedyRt,
+    "greedy-t": GreedyThresh,
+    "greedy-m": GreedyMatching,
+    "simple-greedy": SimpleGreedy,
+    "inv-ff": InvariantFF,
+    "inv-ff-hist": InvariantFFHist,
+    "ff-hist": FeedForwardModelHist,
+    "supervised": SupervisedModel,
+    "ff-supervised": SupervisedFFModel,
+    "gnn-hist": GNNHist,
+    "gnn-simp-hist": GNNSimpHist,
+    "gnn": GNN,
+}
 
 
 def run(opts):
@@ -48,8 +83,13 @@ def run(opts):
     # Pretty print the run args
     pp.pprint(vars(opts))
 
+    if opts.autotune:
+        # The inter-op threads can only be set before any torch op
+        apply_cached_interop_threads(opts)
+
     # Set the random seed
     torch.manual_seed(opts.seed)
+    init_distributed(opts)
     # torch.backends.cudnn.benchmark = True
     # torch.autograd.set_detect_anomaly(True)
     # Optionally configure tensorboard
@@ -62,7 +102,11 @@ def run(opts):
                 opts.run_name,
             )
         )
-    if not opts.eval_only and not os.path.exists(opts.save_dir):
+    if (
+        not opts.eval_only
+        and is_main_process(opts)
+        and not os.path.exists(opts.save_dir)
+    ):
         os.makedirs(opts.save_dir)
         # Save arguments so exact configuration can always be found
         with open(os.path.join(opts.save_dir, "args.json"), "w") as f:
@@ -87,32 +131,18 @@ def run(opts):
     #     print("  [*] Loading data from {}".format(opts.load_path2))
     #     load_data2 = torch_load_cpu(opts.load_path2)
     # Initialize model
-    model_class = {
-        "attention": AttentionModelgeo,
-        "ff": FeedForwardModel,
-        "greedy": Greedy,
-        "greedy-rt": GreedyRt,
-        "greedy-t": GreedyThresh,
-        "greedy-m": GreedyMatching,
-        "simple-greedy": SimpleGreedy,
-        "inv-ff": InvariantFF,
-        "inv-ff-hist": InvariantFFHist,
-        "ff-hist": FeedForwardModelHist,
-        "supervised": SupervisedModel,
-        "ff-supervised": SupervisedFFModel,
-        "gnn-hist": GNNHist,
-        "gnn-simp-hist": GNNSimpHist,
-        "gnn": GNN,
-    }.get(opts.model, None)
+    model_class = MODEL_CLASSES.get(opts.model, None)
     assert model_class is not None, "Unknown model: {}".format(model_class)
+    training_dataset = problem.make_dataset(
+        opts.train_dataset, opts.dataset_size, opts.problem, seed=None, opts=opts
+    )
+    if opts.autotune:
+        # Sets the batch sizes and the number of threads before they are used
+        autotune(model_class, problem, training_dataset, opts)
     # if not opts.tune:
     model, lr_schedulers, optimizers, val_dataloader, baseline = setup_training_env(
         opts, model_class, problem, load_data, tb_logger
     )
-
-    training_dataset = problem.make_dataset(
-        opts.train_dataset, opts.dataset_size, opts.problem, seed=None, opts=opts
-    )
     # training_dataloader = DataLoader(
     #    baseline.wrap_dataset(training_dataset), batch_size=opts.batch_size, num_workers=1, shuffle=True,
     # )
@@ -151,6 +181,10 @@ def run(opts):
                 [1.0, 0.99, 0.98, 0.97, 0.96],  # lr decay
             )
         )
+        PARAM_GRID = [
+            {"lr_model": lr, "exp_beta": exp_decay, "lr_decay": lr_decay}
+            for lr, exp_decay, lr_decay in PARAM_GRID
+        ]
         # total number of slurm workers detected
         # defaults to 1 if not running under SLURM
         N_WORKERS = int(os.getenv("SLURM_ARRAY_TASK_COUNT", 1))
@@ -158,80 +192,44 @@ def run(opts):
         # this worker's array index. Assumes slurm array job is zero-indexed
         # defaults to zero if not running under SLURM
         this_worker = int(os.getenv("SLURM_ARRAY_TASK_ID", 0))
-        SCOREFILE = os.path.expanduser(
-            f"./val_rewards_{opts.model}_{opts.u_size}_{opts.v_size}_{opts.graph_family}_{opts.graph_family_parameter}_2.csv"
+        # The configurations of this worker are trained concurrently on the training dataset loaded above
+        run_sweep(
+            PARAM_GRID[this_worker::N_WORKERS],
+            setup_training_env,
+            model_class,
+            problem,
+            training_dataset,
+            opts,
         )
-        for param_ix in range(this_worker, len(PARAM_GRID), N_WORKERS):
-            torch.manual_seed(opts.seed)
-            params = PARAM_GRID[param_ix]
-            lr = params[0]
-            #            embedding_dim = params[1][0]
-            #            n_heads = params[1][1]
-            exp_decay = params[1]
-            lr_decay = params[2]
-            opts.lr_model = lr
-            opts.lr_decay = lr_decay
-            opts.exp_beta = exp_decay
-            # opts.embedding_dim = embedding_dim
-            # opts.n_heads = n_heads
-            if not opts.no_tensorboard:
-                tb_logger = SummaryWriter(
-                    os.path.join(
-                        opts.log_dir,
-                        "{}_{}_{}_{}_{}".format(
-                            opts.lr_decay,
-                            opts.exp_beta,
-                            opts.lr_model,
-                            opts.embedding_dim,
-                            opts.n_heads,
-                        ),
-                        opts.run_name,
-                    )
-                )
-            load_data = {}
-            (
-                model,
-                lr_schedulers,
-                optimizers,
-                val_dataloader,
-                baseline,
-            ) = setup_training_env(opts, model_class, problem, load_data, tb_logger)
-            training_dataset = problem.make_dataset(
-                opts.train_dataset,
-                opts.dataset_size,
-                opts.problem,
-                seed=None,
-                opts=opts,
+    elif opts.tune_baseline and opts.model == "greedy-t":
+        # All the thresholds are evaluated together, in one episode per batch
+        thresholds = torch.tensor(
+            np.round(np.linspace(0, 1, 100), decimals=2), dtype=torch.float
+        )
+        training_dataloader = geoDataloader(
+            training_dataset, batch_size=opts.batch_size, num_workers=0
+        )
+        avg_reward, avg_cr = sweep_thresholds(
+            model, training_dataloader, thresholds, opts
+        )
+        best = int(torch.argmax(avg_reward))
+        results_file = get_threshold_results_file(opts.model, opts)
+        with open(results_file, "w") as f:
+            json.dump(
+                {
+                    "thresholds": thresholds.tolist(),
+                    "avg_reward": avg_reward.tolist(),
+                    "avg_cr": avg_cr.tolist(),
+                    "best_threshold": thresholds[best].item(),
+                },
+                f,
+                indent=True,
             )
-
-            # training_dataloader = DataLoader(
-            #    baseline.wrap_dataset(training_dataset), batch_size=opts.batch_size, num_workers=1, shuffle=True,
-            # )
-            best_avg_cr = 0
-            for epoch in range(opts.epoch_start, opts.epoch_start + opts.n_epochs):
-                training_dataloader = geoDataloader(
-                    baseline.wrap_dataset(training_dataset),
-                    batch_size=opts.batch_size,
-                    num_workers=0,
-                    shuffle=True,
-                )
-                avg_reward, min_cr, avg_cr, loss = train_epoch(
-                    model,
-                    optimizers,
-                    baseline,
-                    lr_schedulers,
-                    epoch,
-                    val_dataloader,
-                    training_dataloader,
-                    problem,
-                    tb_logger,
-                    opts,
-                    best_avg_cr,
-                )
-                best_avg_cr = max(best_avg_cr, avg_cr)
-            avg_reward, min_cr, avg_cr = avg_reward.item(), min_cr, avg_cr.item()
-            with open(SCOREFILE, "a") as f:
-                f.write(f'{",".join(map(str, params + (avg_reward,min_cr,avg_cr)))}\n')
+        print(
+            "Best threshold {}, avg reward {}, results written to {}".format(
+                thresholds[best].item(), avg_reward[best].item(), results_file
+            )
+        )
     elif opts.tune_baseline:
         PARAM_GRID = np.round(np.linspace(0, 1, 100).tolist(), decimals=2)
         N_WORKERS = int(os.getenv("SLURM_ARRAY_TASK_COUNT", 1))
@@ -266,15 +264,26 @@ def run(opts):
 
     else:
         best_avg_cr = 0.0
+        # Batch metrics are buffered and written by a background thread every opts.log_step batches
+        tb_logger = MetricsLogger(
+            tb_logger,
+            csv_path=os.path.join(opts.save_dir, "metrics.csv")
+            if is_main_process(opts)
+            else None,
+            flush_every=opts.log_step,
+        )
+        sampler = None
+        if opts.prioritized_sampling:
+            # Hard instances are sampled more often, the instances carry their index for the sampler
+            training_dataset = IndexedDataset(training_dataset)
+            sampler = PrioritizedSampler(
+                len(training_dataset), opts.priority_alpha, opts.priority_beta
+            )
+            if "sampler" in load_data:
+                sampler.load_state_dict(load_data["sampler"])
         for epoch in range(opts.epoch_start, opts.epoch_start + opts.n_epochs):
-            # with profiler.profile() as prof:
-            #    with profiler.record_function("model_inference"):
-
-            training_dataloader = geoDataloader(
-                baseline.wrap_dataset(training_dataset),
-                batch_size=opts.batch_size,
-                num_workers=0,
-                shuffle=True,
+            training_dataloader = make_training_dataloader(
+                baseline.wrap_dataset(training_dataset), epoch, opts, sampler=sampler
             )
             avg_reward, min_cr, avg_cr, loss = train_epoch(
                 model,
@@ -289,8 +298,8 @@ def run(opts):
                 opts,
                 best_avg_cr,
             )
-            # print(prof.key_averages().table(sort_by="cpu_time_total", row_limit=20))
             best_avg_cr = max(best_avg_cr, avg_cr)
+        tb_logger.close()
 
 
 def train_wandb(model_class, problem, tb_logger, opts, config=None):
@@ -323,12 +332,15 @@ def train_wandb(model_class, problem, tb_logger, opts, config=None):
         #    baseline.wrap_dataset(training_dataset), batch_size=opts.batch_size, num_workers=1, shuffle=True,
         # )
         best_avg_cr = 0.0
+        # Logged like the batches of a run, wandb only gets the validation results of the epochs
+        tb_logger = MetricsLogger(
+            tb_logger,
+            csv_path=os.path.join(opts.save_dir, "metrics.csv"),
+            flush_every=opts.log_step,
+        )
         for epoch in range(opts.epoch_start, opts.epoch_start + opts.n_epochs):
-            training_dataloader = geoDataloader(
-                baseline.wrap_dataset(training_dataset),
-                batch_size=opts.batch_size,
-                num_workers=0,
-                shuffle=True,
+            training_dataloader = make_training_dataloader(
+                baseline.wrap_dataset(training_dataset), epoch, opts
             )
             avg_reward, min_cr, avg_cr, loss = train_epoch(
                 model,
@@ -362,9 +374,12 @@ def train_wandb(model_class, problem, tb_logger, opts, config=None):
                         "min_cr": abs(min_cr),
                     }
                 )
+        tb_logger.close()
 
 
 def setup_training_env(opts, model_class, problem, load_data, tb_logger):
+    if opts.ensemble_size > 1:
+        model_class = partial(FFEnsemble, model_class)
     model = model_class(
         opts.embedding_dim,
         opts.hidden_dim,
@@ -388,10 +403,13 @@ def setup_training_env(opts, model_class, problem, load_data, tb_logger):
     # Overwrite model parameters by parameters to load
     model_ = get_inner_model(model)
     model_.load_state_dict({**model_.state_dict(), **load_data.get("model", {})})
+    broadcast_parameters(model_)
 
     # Initialize baseline
     if opts.baseline == "exponential":
-        baseline = ExponentialBaseline(opts.exp_beta)
+        baseline = ExponentialBaseline(
+            opts.exp_beta, opts.accumulation_steps, opts.ensemble_size
+        )
     elif opts.baseline == "greedy":
         baseline_class = {"e-obm": Greedy, "obm": SimpleGreedy}.get(opts.problem, None)
 
@@ -412,13 +430,19 @@ def setup_training_env(opts, model_class, problem, load_data, tb_logger):
         baseline = GreedyBaseline(greedybaseline, opts)
     elif opts.baseline == "rollout":
         baseline = RolloutBaseline(model, problem, opts)
+    elif opts.baseline == "self-critical":
+        # The greedy rollouts are decoded by the model itself, see train_batch
+        baseline = NoBaseline()
     else:
         assert opts.baseline is None, "Unknown baseline: {}".format(opts.baseline)
         baseline = NoBaseline()
 
     if opts.bl_warmup_epochs > 0:
         baseline = WarmupBaseline(
-            baseline, opts.bl_warmup_epochs, warmup_exp_beta=opts.exp_beta
+            baseline,
+            opts.bl_warmup_epochs,
+            warmup_exp_beta=opts.exp_beta,
+            accumulation_steps=opts.accumulation_steps,
         )
 
     # Load baseline from data, make sure script is called with same type of baseline
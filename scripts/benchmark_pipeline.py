@@ -0,0 +1,111 @@
+"""
+Throughput of pipelined (two half batches in lockstep on two threads) against sequential rollouts on CPU, for
+evaluation (greedy, no graph) and training (sampling rollout, backward and update through train_batch).
+Takes the flags of run.py, e.g.
+    python scripts/benchmark_pipeline.py --problem e-obm --u_size 10 --v_size 30 --batch_size 200 \
+        --train_dataset dataset/train/... --dataset_size 2000 --no_cuda
+"""
+import os
+import sys
+import time
+import torch
+import torch.optim as optim
+from torch_geometric.data import DataLoader as geoDataloader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from options import get_options
+from train import set_decode_type, train_batch
+from utils.functions import load_problem, move_to
+from utils.pipelined_rollout import PipelinedRollout, shutdown_pipeline
+from utils.reinforce_baselines import NoBaseline
+from policy.ff_model_hist import FeedForwardModelHist
+from policy.gnn_hist import GNNHist
+
+MODELS = {"ff-hist": FeedForwardModelHist, "gnn-hist": GNNHist}
+
+
+def throughput(run_batch, dataloader, opts):
+    num_instances = 0
+    start = time.time()
+    for batch in dataloader:
+        run_batch(move_to(batch, opts.device))
+        num_instances += batch.num_graphs
+    return num_instances / (time.time() - start)
+
+
+def eval_throughputs(model, dataloader, opts):
+    set_decode_type(model, "greedy")
+    model.eval()
+    pipelined = PipelinedRollout()
+    with torch.no_grad():
+        sequential_throughput = throughput(
+            lambda x: model(x, opts, None, None), dataloader, opts
+        )
+        # Tune the threads before timing
+        pipelined(model, move_to(next(iter(dataloader)), opts.device), opts, None, None)
+        pipelined_throughput = throughput(
+            lambda x: pipelined(model, x, opts, None, None), dataloader, opts
+        )
+    pipelined.close()
+    return sequential_throughput, pipelined_throughput, pipelined.num_threads
+
+
+def train_throughputs(model, dataloader, opts):
+    set_decode_type(model, "sampling")
+    model.train()
+    optimizers = [optim.Adam(model.parameters(), lr=opts.lr_model)]
+    baseline = NoBaseline()
+
+    def run_batch(x):
+        # step 1 is never a logging step
+        train_batch(model, optimizers, baseline, 0, 0, 1, x, None, opts)
+
+    throughputs = []
+    for pipeline_rollouts in (False, True):
+        opts.pipeline_rollouts = pipeline_rollouts
+        # Warm up, and tune the threads of the pipelined rollouts of this model
+        run_batch(move_to(next(iter(dataloader)), opts.device))
+        throughputs.append(throughput(run_batch, dataloader, opts))
+    shutdown_pipeline()
+    return tuple(throughputs)
+
+
+def main():
+    opts = get_options()
+    opts.device = torch.device("cpu")
+    problem = load_problem(opts.problem)
+    dataset = problem.make_dataset(
+        opts.train_dataset, opts.dataset_size, opts.problem, seed=None, opts=opts
+    )
+    dataloader = geoDataloader(dataset, batch_size=opts.batch_size, num_workers=0)
+    for name, model_class in MODELS.items():
+        opts.model = name
+        model = model_class(
+            opts.embedding_dim,
+            opts.hidden_dim,
+            problem=problem,
+            n_encode_layers=opts.n_encode_layers,
+            normalization=opts.normalization,
+            checkpoint_encoder=opts.checkpoint_encoder,
+            num_actions=opts.u_size + 1,
+            n_heads=opts.n_heads,
+            encoder=opts.encoder,
+            opts=opts,
+        ).to(opts.device)
+        sequential, pipelined, num_threads = eval_throughputs(model, dataloader, opts)
+        print(
+            "{} eval: sequential {:.1f} instances/s, pipelined {:.1f} instances/s ({:.2f}x, {} threads)".format(
+                name, sequential, pipelined, pipelined / sequential, num_threads
+            )
+        )
+        sequential, pipelined = train_throughputs(model, dataloader, opts)
+        print(
+            "{} train: sequential {:.1f} instances/s, pipelined {:.1f} instances/s ({:.2f}x)".format(
+                name, sequential, pipelined, pipelined / sequential
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
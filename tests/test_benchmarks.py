@@ -0,0 +1,28 @@
+from benchmarks.__main__ import build_parser
+from benchmarks.throughput import make_opts
+
+
+def test_run_defaults_build_options():
+    args = build_parser().parse_args(["run"])
+    for model in args.models:
+        for problem in args.problems:
+            u_size, v_size = map(int, args.sizes[0].split("x"))
+            opts = make_opts(model, problem, u_size, v_size, args)
+            assert opts.dataset_size % opts.batch_size == 0
+
+
+def test_memory_defaults_build_options():
+    args = build_parser().parse_args(["memory"])
+    for batch_size in args.batch_sizes:
+        args.batch_size = batch_size
+        opts = make_opts(
+            args.models[0], args.problem, args.u_sizes[0], args.v_sizes[0], args
+        )
+        assert opts.batch_size == batch_size
+
+
+def test_distributed_defaults_build_options():
+    args = build_parser().parse_args(["distributed"])
+    u_size, v_size = map(int, args.size.split("x"))
+    opts = make_opts(args.model, args.problem, u_size, v_size, args)
+    assert not opts.use_cuda
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+import torch
+
+from utils.eval_cache import (
+    EVAL_OPTIONS,
+    CACHED_RESULTS,
+    result_key,
+    load_result,
+    save_result,
+)
+
+
+def make_dataset(path, eval_size):
+    path.mkdir()
+    for i in range(eval_size):
+        (path / "data_{}.pt".format(i)).write_bytes(bytes([i]) * 16)
+    return str(path)
+
+
+def test_round_trip_and_key_invalidation(tmp_path):
+    opts = SimpleNamespace(**{k: None for k in EVAL_OPTIONS})
+    opts.eval_size = 2
+    dataset = make_dataset(tmp_path / "dataset", opts.eval_size)
+    cache_dir = str(tmp_path / "cache")
+    model = SimpleNamespace(model_name="greedy-t", best_threshold=0.3)
+    key = result_key(model, None, dataset, 10, 30, opts)
+    assert load_result(cache_dir, key) is None
+
+    result = {
+        "cost": torch.tensor([-3.0, -4.0]),
+        "cr": torch.tensor([0.75, 1.0]),
+        "actions": torch.tensor([[1, 0], [2, 1]]),
+        "matches_opt": torch.tensor([[True, False], [True, True]]),
+    }
+    save_result(cache_dir, key, result, model.model_name, None, dataset)
+    cached = load_result(cache_dir, key)
+    assert sorted(cached) == sorted(CACHED_RESULTS)
+    for k in CACHED_RESULTS:
+        assert torch.equal(cached[k], result[k])
+
+    # Another tuned threshold, graph size or eval option is a miss
+    assert result_key(model, None, dataset, 10, 30, opts) == key
+    retuned = SimpleNamespace(model_name="greedy-t", best_threshold=0.4)
+    assert load_result(cache_dir, result_key(retuned, None, dataset, 10, 30, opts)) is None
+    assert load_result(cache_dir, result_key(model, None, dataset, 10, 60, opts)) is None
+    opts.seed = 1
+    assert load_result(cache_dir, result_key(model, None, dataset, 10, 30, opts)) is None
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from torch_geometric.data import DataLoader as geoDataloader
+
+from benchmarks.synthetic import make_er_dataset
+from benchmarks.throughput import make_opts
+from policy.greedy_theshold import GreedyThresh
+from train import sweep_thresholds
+from utils.functions import load_problem, move_to
+
+
+def test_untuned_threshold_fails_with_message(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # No threshold results here
+    opts = SimpleNamespace(
+        problem="e-obm",
+        u_size=10,
+        v_size=30,
+        graph_family="er",
+        graph_family_parameter=0.1,
+    )
+    model = GreedyThresh(None, None, problem=None, opts=opts)
+    assert model.best_threshold is None
+    with pytest.raises(AssertionError, match="run --tune_baseline"):
+        model(None, opts, None, None)
+
+
+def test_sweep_matches_every_threshold_alone(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    args = SimpleNamespace(batch_size=4, edge_prob=0.3, no_cuda=True)
+    opts = make_opts("greedy-t", "e-obm", 5, 10, args)
+    problem = load_problem("e-obm")
+    dataset = geoDataloader(
+        make_er_dataset("e-obm", 5, 10, 8, 0.3, seed=0), batch_size=4
+    )
+    model = GreedyThresh(None, None, problem=problem, opts=opts)
+    thresholds = torch.tensor([0.0, 0.3, 0.6, 0.9])
+
+    rewards, _ = sweep_thresholds(model, dataset, thresholds, opts)
+    assert model.thresholds is None
+    for t, reward in zip(thresholds.tolist(), rewards):
+        model.best_threshold = t
+        with torch.no_grad():
+            alone = torch.cat(
+                [-model(move_to(b, opts.device), opts, None, None)[0] for b in dataset]
+            )
+        assert torch.allclose(reward, alone.float().mean())
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+
+from policy.common import NStepTrainer
+
+
+class FakeState(object):
+    def __init__(self, batch_size):
+        self.size = torch.zeros(batch_size, 1)
+        self.finished = False
+
+    def all_finished(self):
+        return self.finished
+
+
+def test_updates_on_the_steps_of_each_segment_only():
+    opts = SimpleNamespace(max_steps=2, ent_rate=0.0, max_grad_norm=0)
+    model = nn.Module()
+    model.theta = nn.Parameter(torch.zeros(()))
+    optimizers = [torch.optim.SGD(model.parameters(), lr=1.0)]
+    state = FakeState(2)
+    trainer = NStepTrainer(model, optimizers, state, opts)
+    entropy = torch.zeros(2)
+    # Per step: the features of the log-probability of the action and the reward of every instance
+    steps = [
+        (torch.tensor([1.0, 2.0]), torch.tensor([1.0, 0.0])),
+        (torch.tensor([3.0, 1.0]), torch.tensor([0.0, 0.0])),
+        (torch.tensor([2.0, 4.0]), torch.tensor([1.0, 0.0])),
+    ]
+    outputs, updates = [], []
+    for i, (a, r) in enumerate(steps):
+        outputs.append(model.theta * a)
+        state.size = state.size + r.unsqueeze(1)
+        state.finished = i == len(steps) - 1
+        updates.append(trainer.step(outputs, entropy, state))
+        if i == 1:
+            # Segment costs [-1, 0] centered to [-0.5, 0.5], features [1 + 3, 2 + 1]:
+            # gradient mean([-0.5 * 4, 0.5 * 3]) = -0.25
+            assert torch.allclose(model.theta.detach(), torch.tensor(0.25))
+    assert updates == [False, True, True]
+    assert not any(o.requires_grad for o in outputs)
+    # The last segment is the single step 3: costs [-1, 0] centered to [-0.5, 0.5],
+    # gradient mean([-0.5 * 2, 0.5 * 4]) = 0.5
+    assert torch.allclose(model.theta.detach(), torch.tensor(-0.25))
+    assert trainer.start == 3
@@ -0,0 +1,33 @@
+import torch
+
+from utils.prioritized_sampling import PrioritizedSampler
+
+
+def test_importance_weights_of_priorities():
+    sampler = PrioritizedSampler(4, alpha=1.0, beta=1.0, eps=0.01)
+    sampler.update(torch.arange(4), torch.tensor([1.0, 0.5, 0.0, 0.99]))
+    assert torch.allclose(sampler.priorities, torch.tensor([0.01, 0.51, 1.01, 0.02]))
+
+    ids = list(iter(sampler))
+    assert len(ids) == 4
+    assert torch.allclose(sampler.probs, sampler.priorities / sampler.priorities.sum())
+    # With beta = 1 the weight is p_min / p_i, the least likely instance has weight 1
+    weights = sampler.weights(torch.arange(4))
+    assert torch.allclose(weights, 0.01 / sampler.priorities)
+
+
+def test_uniform_before_any_update_and_without_correction():
+    sampler = PrioritizedSampler(3, alpha=1.0, beta=0.0)
+    list(iter(sampler))
+    assert torch.allclose(sampler.probs, torch.full((3,), 1.0 / 3))
+    sampler.update(torch.tensor([0]), torch.tensor([0.2]))
+    list(iter(sampler))
+    assert torch.allclose(sampler.weights(torch.arange(3)), torch.ones(3))
+
+
+def test_priorities_round_trip():
+    sampler = PrioritizedSampler(3)
+    sampler.update(torch.tensor([1]), torch.tensor([0.25]))
+    restored = PrioritizedSampler(3)
+    restored.load_state_dict(sampler.state_dict())
+    assert torch.equal(restored.priorities, sampler.priorities)
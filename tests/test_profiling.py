@@ -0,0 +1,48 @@
+import time
+import threading
+
+from utils.profiling import phase, count_env_time, start_phases, stop_phases
+
+
+def test_env_time_split_per_thread():
+    barrier = threading.Barrier(2)
+    env_times = {}
+
+    def rollout(name, env_seconds, model_seconds):
+        with count_env_time() as env_time:
+            barrier.wait()
+            with phase("env/step"):
+                time.sleep(env_seconds)
+            with phase("model/forward"):
+                time.sleep(model_seconds)
+        env_times[name] = env_time[0]
+
+    # The worker steps its env while the main thread runs its model phase
+    worker = threading.Thread(target=rollout, args=("worker", 0.2, 0.0))
+    worker.start()
+    start = time.perf_counter()
+    rollout("main", 0.05, 0.15)
+    total = time.perf_counter() - start
+    worker.join()
+
+    assert 0.05 <= env_times["main"] < 0.15
+    assert total - env_times["main"] >= 0.15
+    assert env_times["worker"] >= 0.2
+
+
+def test_phase_timers_of_recording_thread_only():
+    def step():
+        with phase("env/worker"):
+            pass
+
+    timers = start_phases()
+    try:
+        with phase("env/step"):
+            pass
+        worker = threading.Thread(target=step)
+        worker.start()
+        worker.join()
+    finally:
+        stop_phases()
+    assert timers["env/step"][1] == 1
+    assert "env/worker" not in timers
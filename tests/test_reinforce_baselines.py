@@ -0,0 +1,27 @@
+import torch
+
+from utils.reinforce_baselines import ExponentialBaseline
+
+
+def member_costs(*means):
+    # Member k decodes trajectories k * batch_size + b, 3 instances per member
+    return torch.tensor([[m + d] for m in means for d in (-1.0, 0.0, 1.0)])
+
+
+def test_exponential_baseline_per_member():
+    baseline = ExponentialBaseline(0.5, num_members=2)
+    v, loss = baseline.eval(None, member_costs(2.0, 5.0))
+    assert loss == 0
+    assert torch.allclose(v, torch.tensor([2.0] * 3 + [5.0] * 3))
+    v, _ = baseline.eval(None, member_costs(4.0, 1.0))
+    assert torch.allclose(v, torch.tensor([3.0] * 6))
+
+
+def test_accumulated_micro_batches_share_the_baseline():
+    baseline = ExponentialBaseline(0.5, accumulation_steps=2, num_members=2)
+    baseline.load_state_dict({"v": torch.tensor([2.0, 5.0])})
+    for means in [(4.0, 1.0), (6.0, 3.0)]:
+        v, _ = baseline.eval(None, member_costs(*means))
+        assert torch.allclose(v, torch.tensor([2.0] * 3 + [5.0] * 3))
+    # Updated once with the mean of the effective batch: 0.5 * [2, 5] + 0.5 * [5, 2]
+    assert torch.allclose(baseline.v, torch.tensor([3.5, 3.5]))
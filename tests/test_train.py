@@ -0,0 +1,21 @@
+from types import SimpleNamespace
+
+import torch
+
+from train import accumulate_gradients
+
+
+def test_accumulate_gradients_averages_every_window():
+    # 5 batches with 3 accumulation steps: a full window of 3 and a last window of 2
+    opts = SimpleNamespace(accumulation_steps=3, max_grad_norm=0)
+    w = torch.zeros(1, requires_grad=True)
+    optimizers = [torch.optim.SGD([w], lr=1.0)]
+    costs = [1.0, 2.0, 6.0, 4.0, 8.0]
+    steps = []
+    for batch_id, c in enumerate(costs):
+        grad_norms = accumulate_gradients(w.sum() * c, optimizers, batch_id, 5, opts)
+        steps.append(grad_norms is not None)
+        if batch_id == 2:
+            assert torch.allclose(w, torch.tensor([-3.0]))
+    assert steps == [False, False, True, False, True]
+    assert torch.allclose(w, torch.tensor([-3.0 - 6.0]))
@@ -4,11 +4,27 @@ from tqdm import tqdm
 import torch
 import math
 import matplotlib.pyplot as plt
+from contextlib import nullcontext
+from collections import defaultdict
 
 from torch.nn import DataParallel
-
-from utils.log_utils import log_values
-from utils.functions import move_to
+from torch.utils.data import ConcatDataset, DataLoader, TensorDataset
+
+from utils.log_utils import log_values, MetricsLogger
+from utils.functions import move_to, get_peak_memory, load_problem
+from utils.state_cache import shared_initial_state
+from utils.distributed import (
+    average_gradients,
+    is_main_process,
+    all_reduce_sum,
+    all_reduce_max,
+)
+from utils.actor_learner import ActorPool
+from utils.prioritized_sampling import PrioritizedSampler
+from utils.pipelined_rollout import pipelined_forward
+from utils.profiling import PhaseProfiler, phase, count_env_time
+from policy.ff_supervised import get_loss, get_class_weights
+from policy.common import clip_grad_norms
 
 
 import numpy as np
@@ -73,6 +89,12 @@ def validate(model, dataset, opts):
         )
     )
     print("\nValidation competitive ratio", min_cr.item())
+    if getattr(opts, "ensemble_size", 1) > 1:
+        print(
+            "\nValidation avg ratio to optimal of the ensemble members: {}".format(
+                cr.view(-1, opts.ensemble_size).mean(0).tolist()
+            )
+        )
 
     return avg_cost, min_cr.item(), avg_cr, loss
 
@@ -103,114 +125,115 @@ def eval_model(models, problem, opts):
 
 
 def rollout_eval(models, dataset, opts):
-    # Put in greedy evaluation mode!
-    model = models[0]
-    g = models[1]
-    set_decode_type(model, "greedy")
-    model.eval()
+    """
+    Evaluates models[0] in greedy mode and compares its actions with the ones of the baseline models[1].
+    """
+    (result,), (baseline_result,), comparisons = evaluate_models(
+        models[:1], models[1:], dataset, opts
+    )
+    comparison = comparisons[0, 0]
+    return (
+        result["cost"],
+        result["cr"],
+        comparison["agree"],
+        baseline_result["agree_opt"],
+        result["agree_opt"],
+        result["count"],
+        baseline_result["count"],
+        comparison["jaccard"],
+        comparison["wilcoxon"],
+    )
+
+
+def summarize_result(result, opts):
+    """
+    Adds the aggregates of the per-instance results of a policy: agree_opt, the number of instances in which each
+    arrival is matched as in the optimal matching, and count, the actions taken for the first 20 arrivals.
+    """
+    return {
+        **result,
+        "agree_opt": result["matches_opt"].float().sum(0),
+        "count": torch.bincount(
+            result["actions"][:, :20].flatten(), minlength=opts.u_size + 1
+        ),
+    }
 
-    def eval_model_bat(bat, optimal):
-        bat = move_to(bat, opts.device)
-        if opts.problem == "osbm" or opts.problem == "adwords":
-            matchings = bat.y.reshape(opts.batch_size, opts.v_size + 1)[:, 1:]
-            opt_size = bat.y.reshape(opts.batch_size, opts.v_size + 1)[:, 0]
-        else:
-            matchings = bat.x.reshape(opts.batch_size, opts.v_size)
-            opt_size = bat.y
-        with torch.no_grad():
-            if model.model_name == "supervised" or model.model_name == "ff-supervised":
-                cost, _, a, _ = model(move_to(bat, opts.device), matchings, opts, False)
-            else:
-                cost, _, a, _ = model(
-                    move_to(bat, opts.device),
-                    opts,
-                    baseline=None,
-                    return_pi=True,
-                    optimizer=None,
-                )
-            cost1, _, a1, _ = g(
-                move_to(bat, opts.device),
-                opts,
-                baseline=None,
-                return_pi=True,
-                optimizer=None,
-            )
-        # print(-cost.data.flatten())
-        jaccard = (a == a1).float().sum(1) / (
-            2 * opts.v_size - (a == a1).float().sum(1)
-        )
-        num_agree = ((a == a1).float()).sum(0)
-        count = torch.bincount(a[:, :20].flatten(), minlength=opts.u_size + 1)
-        count1 = torch.bincount(a1[:, :20].flatten(), minlength=opts.u_size + 1)
 
+def compare_results(result, baseline_result, opts):
+    """
+    Compares the per-instance results of a policy with the ones of a baseline (agree: number of instances in which
+    each arrival is matched the same, jaccard: mean Jaccard index of the matchings, wilcoxon: statistic and
+    p-value of the policy beating the baseline in every batch of opts.eval_batch_size instances)
+    """
+    same = (result["actions"] == baseline_result["actions"]).float()
+    num_same = same.sum(1)
+    wp = []
+    for cost, cost1 in zip(
+        result["cost"].split(opts.eval_batch_size),
+        baseline_result["cost"].split(opts.eval_batch_size),
+    ):
         if (cost == cost1).all().item():
             w, p = 0, 0
         else:
-            w, p = wilcoxon(
-                -cost.squeeze().cpu(), -cost1.squeeze().cpu(), alternative="greater"
-            )
-        cr = -cost.data.flatten() / move_to(
-            opt_size + (opt_size == 0).float(), opts.device
-        )
-        # print(
-        #     "\nBatch Competitive ratio: ", min(cr).item(),
-        # )
+            w, p = wilcoxon(-cost, -cost1, alternative="greater")
+        wp.append(torch.tensor([w, p])[None, :])
+    return {
+        "agree": same.sum(0),
+        "jaccard": (num_same / (2 * opts.v_size - num_same)).mean(),
+        "wilcoxon": torch.cat(wp, 0),
+    }
 
-        num_agree_opt = (a == matchings).float().sum(0)
-        greedy_agree_opt = (a1 == matchings).float().sum(0)
-        return (
-            cost.data.cpu(),
-            cr,
-            num_agree,
-            num_agree_opt,
-            greedy_agree_opt,
-            count,
-            count1,
-            jaccard,
-            [w, p],
-        )
 
-    cost = []
-    crs = []
-    n_greedy = []
-    n_greedy_opts = []
-    n_model_opts = []
-    count_actions = []
-    count_actions1 = []
-    avg_jaccard = []
-    wp = []
-    for batch in tqdm(dataset):
-        (
-            c,
-            cr,
-            num_agree,
-            num_model_opt,
-            num_greedy_opt,
-            count,
-            count1,
-            j,
-            wilcox,
-        ) = eval_model_bat(batch, None)
-        cost.append(c)
-        crs.append(cr)
-        n_greedy.append(num_agree[None, :])
-        n_greedy_opts.append(num_greedy_opt[None, :])
-        n_model_opts.append(num_model_opt[None, :])
-        count_actions.append(count[None, :])
-        count_actions1.append(count1[None, :])
-        avg_jaccard.append(j[None, :])
-        wp.append(torch.tensor(wilcox)[None, :])
-    return (
-        torch.cat(cost, 0),
-        torch.cat(crs, 0),
-        torch.cat(n_greedy, 0).sum(0),
-        torch.cat(n_greedy_opts, 0).sum(0),
-        torch.cat(n_model_opts, 0).sum(0),
-        torch.cat(count_actions, 0).sum(0),
-        torch.cat(count_actions1, 0).sum(0),
-        torch.cat(avg_jaccard, 0).mean(),
-        torch.cat(wp, 0),
-    )
+def evaluate_models(models, baselines, dataset, opts):
+    """
+    Evaluates the models and the baselines in a single pass over the dataset: every batch is moved to the device
+    and its initial state is built once, then every model and baseline is rolled out once on it (greedy).
+    :return: the results of every model and of every baseline (per instance: cost, cr, actions and matches_opt,
+    whether each arrival is matched as in the optimal matching, with the aggregates of summarize_result) and
+    the comparison (compare_results) of every (model index, baseline index) pair
+    """
+    problem = load_problem(opts.problem)
+    policies = models + baselines
+    for m in policies:
+        set_decode_type(m, "greedy")
+        m.eval()
+
+    def run(m, bat, matchings):
+        with torch.no_grad(), phase("eval/{}".format(m.model_name)):
+            if m.model_name == "supervised" or m.model_name == "ff-supervised":
+                cost, _, a, _ = m(bat, matchings, opts, False)
+            else:
+                cost, _, a, _ = m(
+                    bat, opts, baseline=None, return_pi=True, optimizer=None
+                )
+        return cost.data.flatten(), a
+
+    results = [defaultdict(list) for _ in policies]
+    profiler = PhaseProfiler(opts, "eval")
+    for bat in tqdm(dataset, disable=opts.no_progress_bar):
+        bat = move_to(bat, opts.device)
+        matchings = get_optimal_matchings(bat, opts)
+        opt_size = get_optimal_sizes(bat, opts)
+        with shared_initial_state(problem, bat, opts):
+            outputs = [run(m, bat, matchings) for m in policies]
+        for (cost, a), r in zip(outputs, results):
+            r["cost"].append(cost.cpu())
+            r["cr"].append((-cost / (opt_size + (opt_size == 0).float())).cpu())
+            r["actions"].append(a.cpu())
+            r["matches_opt"].append((a == matchings).cpu())
+        profiler.step()
+    profiler.stop()
+
+    results = [
+        summarize_result({k: torch.cat(v, 0) for k, v in r.items()}, opts)
+        for r in results
+    ]
+    comparisons = {
+        (i, j): compare_results(results[i], results[len(models) + j], opts)
+        for i in range(len(models))
+        for j in range(len(baselines))
+    }
+    return results[: len(models)], results[len(models) :], comparisons
 
 
 def rollout(model, dataset, opts):
@@ -221,28 +244,29 @@ def rollout(model, dataset, opts):
     def eval_model_bat(bat, optimal):
         batch_loss = 0
         bat = move_to(bat, opts.device)
-        if opts.problem == "osbm" or opts.problem == "adwords":
-            matchings = bat.y.reshape(opts.batch_size, opts.v_size + 1)[:, 1:]
-            opt_size = bat.y.reshape(opts.batch_size, opts.v_size + 1)[:, 0]
-        else:
-            matchings = bat.x.reshape(opts.batch_size, opts.v_size)
-            opt_size = bat.y
+        matchings = get_optimal_matchings(bat, opts)
+        opt_size = get_optimal_sizes(bat, opts)
         with torch.no_grad():
             if opts.model == "supervised" or opts.model == "ff-supervised":
                 cost, _, _, batch_loss = model(bat, matchings, opts, False)
+            elif getattr(opts, "pipeline_rollouts", False):
+                cost, *_ = pipelined_forward(model, bat, opts, None, None)
             else:
                 cost, *_ = model(bat, opts, None, None)
 
         # print(-cost.data.flatten())
         # print(bat[-1])
 
-        cr = (-cost.data.flatten()) / move_to(
-            opt_size + (opt_size == 0).float(), opts.device
-        )
+        cost = cost.data.flatten()
+        if cost.size(0) > opt_size.size(0):
+            # The members of an ensemble decode trajectory k * batch_size + b, order them by instance
+            cost = cost.view(-1, opt_size.size(0)).t().flatten()
+            opt_size = opt_size.repeat_interleave(cost.size(0) // opt_size.size(0))
+        cr = (-cost) / move_to(opt_size + (opt_size == 0).float(), opts.device)
         # print(
         #     "\nBatch Competitive ratio: ", min(cr).item(),
         # )
-        return cost.data.cpu(), cr, batch_loss
+        return cost.view(-1, 1).cpu(), cr, batch_loss
 
     cost = []
     crs = []
@@ -266,27 +290,45 @@ def rollout(model, dataset, opts):
     # )
 
 
-def clip_grad_norms(param_groups, max_norm=math.inf):
+def sweep_thresholds(model, dataset, thresholds, opts):
+    """
+    Evaluates greedy-t with all the thresholds in a single episode per batch, the batch is decoded once for every
+    threshold along an extra batch dimension.
+    :return: average reward and average ratio to optimal (num_thresholds) of every threshold
+    """
+    model.eval()
+    model.thresholds = thresholds.to(opts.device)
+    rewards, crs = [], []
+    for bat in tqdm(dataset, disable=opts.no_progress_bar):
+        bat = move_to(bat, opts.device)
+        opt_size = get_optimal_sizes(bat, opts)
+        with torch.no_grad():
+            cost, *_ = model(bat, opts, None, None)
+        reward = -cost.view(len(thresholds), -1)
+        rewards.append(reward.cpu())
+        crs.append((reward / (opt_size + (opt_size == 0).float())).cpu())
+    model.thresholds = None
+    return torch.cat(rewards, 1).mean(1), torch.cat(crs, 1).mean(1)
+
+
+def clip_member_grad_norms(param_groups, max_norm=math.inf):
     """
-    Clips the norms for all param groups to max_norm and returns gradient norms before clipping
-    :param optimizer:
-    :param max_norm:
-    :param gradient_norms_log:
-    :return: grad_norms, clipped_grad_norms: list with (clipped) gradient norms per group
+    Clips the gradient norm of every member of an ensemble, whose parameters are stacked along their first
+    dimension, to max_norm separately.
+    :return: grad_norms, clipped_grad_norms: list with the largest (clipped) member gradient norm per group
     """
-    grad_norms = [
-        torch.nn.utils.clip_grad_norm_(
-            group["params"],
-            max_norm
-            if max_norm > 0
-            else math.inf,  # Inf so no clipping but still call to calc
-            norm_type=2,
+    grad_norms, grad_norms_clipped = [], []
+    for group in param_groups:
+        grads = [p.grad for p in group["params"] if p.grad is not None]
+        norms = torch.stack([g.flatten(1).pow(2).sum(1) for g in grads]).sum(0).sqrt()
+        if max_norm > 0:
+            scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+            for g in grads:
+                g.mul_(scale.view(-1, *([1] * (g.dim() - 1))))
+        grad_norms.append(norms.max())
+        grad_norms_clipped.append(
+            norms.max().clamp(max=max_norm) if max_norm > 0 else norms.max()
         )
-        for group in param_groups
-    ]
-    grad_norms_clipped = (
-        [min(g_norm, max_norm) for g_norm in grad_norms] if max_norm > 0 else grad_norms
-    )
     return grad_norms, grad_norms_clipped
 
 
@@ -308,7 +350,10 @@ def train_epoch(
             epoch, optimizers[0].param_groups[0]["lr"], opts.run_name
         )
     )
-    step = epoch * (opts.dataset_size // opts.batch_size)
+    # Every rank trains on its 1 / world_size share of the batches of the epoch
+    step = epoch * (
+        opts.dataset_size // (opts.batch_size * getattr(opts, "world_size", 1))
+    )
     start_time = time.time()
 
     if not opts.no_tensorboard:
@@ -321,21 +366,26 @@ def train_epoch(
     #     training_dataset, batch_size=opts.batch_size, num_workers=1
     # )
 
+    if opts.use_cuda:
+        torch.cuda.reset_peak_memory_stats(opts.device)
+    checkpointer = getattr(get_inner_model(model), "checkpointer", None)
+    if checkpointer is not None:
+        checkpointer.reset_epoch()
+
     # Put model in train mode!
     model.train()
-    set_decode_type(model, "sampling")
+    set_decode_type(
+        model, "self-critical" if opts.baseline == "self-critical" else "sampling"
+    )
 
-    # if the model is supervised, train differently
-    if opts.model == "supervised" or opts.model == "ff-supervised":
+    # Profiles the first opts.profile batches of the run
+    profiler = PhaseProfiler(opts, "train")
 
-        for batch_id, batch in enumerate(
-            tqdm(training_dataloader, disable=opts.no_progress_bar)
-        ):
-            train_batch_supervised(
-                model, optimizers, epoch, batch_id, step, batch, tb_logger, opts
-            )
-
-            step += 1
+    # if the model is supervised, train differently
+    if opts.teacher_forcing:
+        step = train_epoch_teacher_forced(
+            model, optimizers, epoch, step, training_dataloader, tb_logger, opts
+        )
 
         epoch_duration = time.time() - start_time
         print(
@@ -344,24 +394,91 @@ def train_epoch(
             )
         )
 
-    # use train_batch if the model is not supervised
-    else:
+    elif opts.model == "supervised" or opts.model == "ff-supervised":
+
         for batch_id, batch in enumerate(
-            tqdm(training_dataloader, disable=opts.no_progress_bar)
+            tqdm(
+                timed_batches(training_dataloader, tb_logger),
+                total=len(training_dataloader),
+                disable=opts.no_progress_bar,
+            )
         ):
-            train_batch(
+            train_batch_supervised(
                 model,
                 optimizers,
-                baseline,
                 epoch,
                 batch_id,
                 step,
                 batch,
                 tb_logger,
                 opts,
+                num_batches=len(training_dataloader),
+            )
+
+            step += 1
+            profiler.step()
+
+        epoch_duration = time.time() - start_time
+        print(
+            "Finished epoch {}, took {} s".format(
+                epoch, time.strftime("%H:%M:%S", time.gmtime(epoch_duration))
+            )
+        )
+
+    elif opts.num_actors > 0:
+        step = train_epoch_actor_learner(
+            model, optimizers, baseline, epoch, step, training_dataloader, tb_logger, opts
+        )
+
+        epoch_duration = time.time() - start_time
+        print(
+            "Finished epoch {}, took {} s".format(
+                epoch, time.strftime("%H:%M:%S", time.gmtime(epoch_duration))
+            )
+        )
+
+    # use train_batch if the model is not supervised
+    else:
+        sampler = training_dataloader.sampler
+        if not isinstance(sampler, PrioritizedSampler):
+            sampler = None
+        for batch_id, batch in enumerate(
+            tqdm(
+                timed_batches(training_dataloader, tb_logger),
+                total=len(training_dataloader),
+                disable=opts.no_progress_bar,
             )
+        ):
+            if opts.ppo_epochs > 0:
+                train_batch_ppo(
+                    model,
+                    optimizers,
+                    baseline,
+                    epoch,
+                    batch_id,
+                    step,
+                    batch,
+                    tb_logger,
+                    opts,
+                    num_batches=len(training_dataloader),
+                )
+            else:
+                train_batch(
+                    model,
+                    optimizers,
+                    baseline,
+                    epoch,
+                    batch_id,
+                    step,
+                    batch,
+                    tb_logger,
+                    opts,
+                    num_batches=len(training_dataloader),
+                    sampler=sampler,
+                )
 
             step += 1
+            profiler.step()
 
         epoch_duration = time.time() - start_time
         print(
@@ -370,7 +487,17 @@ def train_epoch(
             )
         )
 
-    if (
+    profiler.stop()  # The epoch had fewer than opts.profile batches
+    # Each rank trains on its own shard of the dataset
+    log_epoch_throughput(
+        model, len(training_dataloader.sampler), epoch_duration, step, tb_logger, opts
+    )
+    if isinstance(tb_logger, MetricsLogger):
+        tb_logger.flush(step, epoch)
+
+    if not is_main_process(opts):  # Only rank 0 saves checkpoints
+        pass
+    elif (
         opts.checkpoint_epochs == 0 and (epoch == opts.n_epochs - 1) and not opts.tune
     ):  # TODO: This does not save both optimizers
         print("Saving model and state...")
@@ -381,6 +508,7 @@ def train_epoch(
                 "rng_state": torch.get_rng_state(),
                 "cuda_rng_state": torch.cuda.get_rng_state_all(),
                 "baseline": baseline.state_dict(),
+                **sampler_state(training_dataloader),
             },
             os.path.join(opts.save_dir, "latest-{}.pt".format(epoch)),
         )
@@ -397,13 +525,14 @@ def train_epoch(
                 "rng_state": torch.get_rng_state(),
                 "cuda_rng_state": torch.cuda.get_rng_state_all(),
                 "baseline": baseline.state_dict(),
+                **sampler_state(training_dataloader),
             },
             os.path.join(opts.save_dir, "epoch-{}.pt".format(epoch)),
         )
 
     avg_reward, min_cr, avg_cr, loss = validate(model, val_dataset, opts)
     # avg_reward, min_cr, avg_cr = 0,0,0
-    if avg_cr > best_avg_cr:
+    if avg_cr > best_avg_cr and is_main_process(opts):
         torch.save(
             {
                 "model": get_inner_model(model).state_dict(),
@@ -411,6 +540,7 @@ def train_epoch(
                 "rng_state": torch.get_rng_state(),
                 "cuda_rng_state": torch.cuda.get_rng_state_all(),
                 "baseline": baseline.state_dict(),
+                **sampler_state(training_dataloader),
             },
             os.path.join(opts.save_dir, "best-model.pt"),
         )
@@ -427,19 +557,113 @@ def train_epoch(
     return avg_reward, min_cr, avg_cr, loss
 
 
-def train_n_step(cost, ll, x, optimizer, baseline):
-    bl_val, bl_loss = baseline.eval(x, cost)
+def timed_batches(dataloader, tb_logger):
+    """
+    The batches of the dataloader, the time spent loading them is logged as "data" by a MetricsLogger.
+    """
+    if isinstance(tb_logger, MetricsLogger):
+        return tb_logger.timed(dataloader, "data")
+    return dataloader
+
+
+def log_batch(
+    cost,
+    epoch,
+    batch_id,
+    step,
+    log_likelihood,
+    tb_logger,
+    opts,
+    num_instances,
+    grad_norms=None,
+    reinforce_loss=None,
+    bl_loss=None,
+    batch_loss=None,
+    scalars=None,
+):
+    """
+    Logs the metrics of a training batch of num_instances instances. A MetricsLogger buffers them every batch,
+    otherwise they are printed and written by log_values every opts.log_step steps.
+    :param scalars: dict of the extra metrics of the training path (e.g. the PPO clip fraction)
+    """
+    scalars = scalars or {}
+    if isinstance(tb_logger, MetricsLogger):
+        # Buffered on the device, written by the background thread every opts.log_step batches
+        tb_logger.add("avg_cost", cost)
+        if batch_loss is not None:
+            tb_logger.add("batch loss", batch_loss)
+        if reinforce_loss is not None:
+            tb_logger.add("actor_loss", reinforce_loss)
+        if opts.baseline == "critic" and torch.is_tensor(bl_loss):
+            tb_logger.add("critic_loss", bl_loss)
+        if grad_norms is not None and torch.is_tensor(grad_norms[0][0]):
+            tb_logger.add("grad_norm", grad_norms[0][0])
+            tb_logger.add("grad_norm_clipped", grad_norms[1][0])
+            if opts.baseline == "critic":
+                tb_logger.add("critic_grad_norm", grad_norms[0][1])
+                tb_logger.add("critic_grad_norm_clipped", grad_norms[1][1])
+        for tag, value in scalars.items():
+            tb_logger.add(tag, value)
+        tb_logger.step(step, epoch, num_instances, cost.size(0) * opts.v_size)
+    elif step % int(opts.log_step) == 0:
+        log_values(
+            cost,
+            epoch,
+            batch_id,
+            step,
+            log_likelihood,
+            tb_logger,
+            opts=opts,
+            batch_loss=batch_loss,
+            grad_norms=grad_norms,
+            reinforce_loss=reinforce_loss,
+            bl_loss=bl_loss,
+        )
+        if not opts.no_tensorboard:
+            for tag, value in scalars.items():
+                tb_logger.add_scalar(tag, value, step)
 
-    # Calculate loss
-    # print("\nCost: " , cost.item())
-    reinforce_loss = ((cost.squeeze(1) - bl_val) * ll).mean()
-    loss = reinforce_loss + bl_loss
-    # print(loss.item())
-    # Perform backward pass and optimization step
-    optimizer.zero_grad()
-    loss.backward()
-    optimizer.step()
-    return
+
+def sampler_state(training_dataloader):
+    """
+    Checkpoint entry of the priorities of a prioritized sampler, so that --resume does not restart from uniform
+    sampling.
+    """
+    sampler = training_dataloader.sampler
+    if not isinstance(sampler, PrioritizedSampler):
+        return {}
+    return {"sampler": sampler.state_dict()}
+
+
+def log_epoch_throughput(model, num_instances, epoch_duration, step, tb_logger, opts):
+    """
+    Logs the training throughput and peak memory of the epoch under the encoder checkpoint policy used.
+    On CPU the peak memory is the peak RSS of the process so far, it cannot be reset every epoch.
+    When distributed, num_instances are the instances of this rank, rank 0 logs the throughput of all the ranks
+    (instances over the duration of the slowest rank) and its own peak memory.
+    """
+    num_instances = all_reduce_sum(torch.tensor(float(num_instances))).item()
+    epoch_duration = all_reduce_max(torch.tensor(float(epoch_duration))).item()
+    if not is_main_process(opts):
+        return
+    throughput = num_instances / max(epoch_duration, 1e-8)
+    peak_memory = get_peak_memory(opts.device) / 2 ** 20
+    memory_name = (
+        "peak_memory_mb" if opts.device.type == "cuda" else "process_peak_rss_mb"
+    )
+    print(
+        "Checkpoint policy {}: {:.2f} instances/s, {} {:.1f}".format(
+            opts.checkpoint_policy, throughput, memory_name, peak_memory
+        )
+    )
+    if not opts.no_tensorboard:
+        tag = "checkpoint_{}".format(opts.checkpoint_policy)
+        tb_logger.add_scalar(tag + "/throughput", throughput, step)
+        tb_logger.add_scalar(tag + "/" + memory_name, peak_memory, step)
+        checkpointer = getattr(get_inner_model(model), "checkpointer", None)
+        if checkpointer is not None:
+            for k, v in checkpointer.stats().items():
+                tb_logger.add_scalar(tag + "/" + k, v, step)
 
 
 def plot_grad_flow(named_parameters):
@@ -477,8 +701,48 @@ def plot_grad_flow(named_parameters):
     plt.savefig("grad.png")
 
 
+def accumulate_gradients(
+    loss, optimizers, batch_id, num_batches, opts, clip=True, clip_fn=None
+):
+    """
+    Backward pass of a micro-batch with gradient accumulation: gradients of opts.accumulation_steps
+    consecutive batches are averaged before each optimizer step.
+    :param num_batches: number of batches in the epoch (None if unknown), the last effective batch may be smaller
+    :param clip: whether to clip the gradient norms to opts.max_grad_norm before the step
+    :param clip_fn: function clipping the gradient norms, clip_grad_norms by default
+    :return: the (clipped) gradient norms if an optimizer step was made, None otherwise
+    """
+    k = opts.accumulation_steps
+    window_start = batch_id - batch_id % k
+    window_size = k if num_batches is None else min(k, num_batches - window_start)
+    if batch_id == window_start:
+        optimizers[0].zero_grad()
+    (loss / window_size).backward()
+    if batch_id + 1 < window_start + window_size:
+        return None
+    average_gradients(optimizers[0].param_groups)
+    grad_norms = [[0, 0], [0, 0]]
+    if clip:
+        # Clip gradient norms and get (clipped) gradient norms for logging
+        grad_norms = (clip_fn or clip_grad_norms)(
+            optimizers[0].param_groups, opts.max_grad_norm
+        )
+    optimizers[0].step()
+    return grad_norms
+
+
 def train_batch(
-    model, optimizers, baseline, epoch, batch_id, step, batch, tb_logger, opts
+    model,
+    optimizers,
+    baseline,
+    epoch,
+    batch_id,
+    step,
+    batch,
+    tb_logger,
+    opts,
+    num_batches=None,
+    sampler=None,
 ):
     x, bl_val = baseline.unwrap_batch(batch)
     x = move_to(x, opts.device)
@@ -486,64 +750,385 @@ def train_batch(
 
     # Evaluate model, get costs and log probabilities
 
-    cost, log_likelihood, e = model(x, opts, optimizers, baseline)
+    metrics = tb_logger if isinstance(tb_logger, MetricsLogger) else None
+    timer = metrics.timer if metrics is not None else lambda phase: nullcontext()
+    with timer("model"), phase("train/rollout"), count_env_time() as env_time:
+        if opts.pipeline_rollouts:
+            cost, log_likelihood, e = pipelined_forward(
+                model, x, opts, optimizers, baseline
+            )
+        else:
+            cost, log_likelihood, e = model(x, opts, optimizers, baseline)
+    if metrics is not None:
+        # The env steps of the rollout are timed apart from the model
+        metrics.add_time("model", -env_time[0])
+        metrics.add_time("env", env_time[0])
+    if opts.baseline == "self-critical":
+        # The second half of the trajectories are the greedy rollouts of the same instances
+        cost, bl_val = cost.chunk(2)
+        log_likelihood = log_likelihood.chunk(2)[0]
+        bl_val = bl_val.squeeze(1).detach()
+    elif opts.num_rollouts > 1:
+        # The baseline of a trajectory is the mean cost of the trajectories of its instance
+        bl_val = (
+            cost.view(opts.num_rollouts, -1).mean(0).repeat(opts.num_rollouts).detach()
+        )
     # Evaluate baseline, get baseline loss if any (only for critic)
-    bl_val, bl_loss = baseline.eval(x, cost) if bl_val is None else (bl_val, 0)
+    bl_val, bl_loss = baseline.eval_batch(x, cost, bl_val)
 
     # Calculate loss
     # print("\nCost: " , cost.item())
     grad_norms = [[0, 0], [0, 0]]
     reinforce_loss = torch.tensor(0)
     loss = 0
-    if not opts.n_step:
-        reinforce_loss = ((cost.squeeze(1) - bl_val) * log_likelihood).mean()
+    is_weights = 1.0
+    if sampler is not None:
+        # Record how the instances did and correct for their prioritized sampling
+        ids = x.sample_id.cpu()
+        opt_size = get_optimal_sizes(x, opts)
+        cr = -cost.detach().view(-1, ids.size(0)).mean(0) / (
+            opt_size + (opt_size == 0).float()
+        )
+        sampler.update(ids, cr.cpu())
+        is_weights = (
+            sampler.weights(ids).to(opts.device).repeat(cost.size(0) // ids.size(0))
+        )
+    if opts.n_step:
+        # The updates were made during the rollout, log the one of the last segment
+        grad_norms, reinforce_loss = getattr(
+            get_inner_model(model), "n_step_stats", (grad_norms, reinforce_loss)
+        )
+    else:
+        reinforce_loss = (
+            is_weights * (cost.squeeze(1) - bl_val) * log_likelihood
+        ).mean()
         loss = reinforce_loss + bl_loss - opts.ent_rate * e
-        # Perform backward pass and optimization step
-        optimizers[0].zero_grad()
-        loss.backward()
-        # Clip gradient norms and get (clipped) gradient norms for logging
-        grad_norms = clip_grad_norms(optimizers[0].param_groups, opts.max_grad_norm)
-        optimizers[0].step()
+        clip_fn = clip_grad_norms
+        if opts.ensemble_size > 1:
+            # Every member minimizes its own loss, the gradients of the members are independent
+            ensemble = get_inner_model(model)
+            reinforce_loss = ensemble.member_mean(
+                is_weights * (cost.squeeze(1) - bl_val) * log_likelihood
+            ).sum()
+            loss = reinforce_loss + bl_loss - (ensemble.ent_rates * e).sum()
+            clip_fn = clip_member_grad_norms
+        # Perform backward pass and optimization step (every opts.accumulation_steps batches)
+        with timer("backward"), phase("train/backward"):
+            grad_norms = (
+                accumulate_gradients(
+                    loss, optimizers, batch_id, num_batches, opts, clip_fn=clip_fn
+                )
+                or grad_norms
+            )
 
     # Logging
-    if step % int(opts.log_step) == 0:
-        log_values(
-            cost,
+    log_batch(
+        cost,
+        epoch,
+        batch_id,
+        step,
+        log_likelihood,
+        tb_logger,
+        opts,
+        x.num_graphs,
+        grad_norms=grad_norms,
+        reinforce_loss=reinforce_loss,
+        bl_loss=bl_loss,
+    )
+
+
+def train_epoch_actor_learner(
+    model, optimizers, baseline, epoch, step, training_dataloader, tb_logger, opts
+):
+    """
+    One epoch of asynchronous actor-learner training: opts.num_actors processes roll out the batches with
+    snapshots of the policy while the learner updates on the finished trajectories, publishing its parameters
+    every opts.sync_every updates.
+    """
+    pool = ActorPool(get_inner_model(model), opts)
+    batches = {}
+    loader = iter(enumerate(timed_batches(training_dataloader, tb_logger)))
+
+    def submit_next():
+        batch_id, batch = next(loader, (None, None))
+        if batch_id is None:
+            return
+        x, bl_val = baseline.unwrap_batch(batch)
+        batches[batch_id] = (x, bl_val)
+        pool.submit(batch_id, x)
+
+    # Keep a batch queued for every actor so that they never wait for the learner
+    for _ in range(2 * opts.num_actors):
+        submit_next()
+    num_updates = 0
+    pbar = tqdm(total=len(training_dataloader), disable=opts.no_progress_bar)
+    while len(batches) > 0:
+        batch_id, cost, actor_ll, pi, states = pool.get()
+        submit_next()
+        start = time.time()
+        x, bl_val = batches.pop(batch_id)
+        train_batch_replay(
+            model,
+            optimizers,
+            baseline,
             epoch,
-            batch_id,
+            num_updates,
             step,
-            log_likelihood,
+            (x, bl_val, cost, actor_ll, pi, states),
             tb_logger,
-            opts=opts,
-            batch_loss=None,
-            grad_norms=grad_norms,
-            reinforce_loss=reinforce_loss,
-            bl_loss=bl_loss,
+            opts,
+            num_batches=len(training_dataloader),
+        )
+        num_updates += 1
+        if num_updates % opts.sync_every == 0:
+            pool.publish(get_inner_model(model))
+        pool.learner_time += time.time() - start
+        step += 1
+        pbar.update(1)
+    pbar.close()
+    pool.close()
+
+    stats = pool.stats()
+    print(
+        "Actor utilization {:.2f}, learner utilization {:.2f}, policy lag {:.2f} versions".format(
+            stats["actor_utilization"],
+            stats["learner_utilization"],
+            stats["policy_lag"],
         )
+    )
+    if not opts.no_tensorboard:
+        for k, v in stats.items():
+            tb_logger.add_scalar("actor_learner/" + k, v, step)
+    return step
+
+
+def train_batch_replay(
+    model,
+    optimizers,
+    baseline,
+    epoch,
+    batch_id,
+    step,
+    trajectories,
+    tb_logger,
+    opts,
+    num_batches=None,
+):
+    """
+    Policy gradient update on the trajectories of an actor. Their log-likelihood is recomputed under the current
+    parameters and the actor's parameter lag is corrected with a truncated importance weight.
+    """
+    x, bl_val, cost, actor_ll, pi, states = trajectories
+    x, cost, actor_ll, pi, states = move_to(
+        [x, cost, actor_ll, pi, list(states)], opts.device
+    )
+    bl_val = move_to(bl_val, opts.device) if bl_val is not None else None
+    log_likelihood, e = get_inner_model(model).replay(states, pi, opts)
+    bl_val, bl_loss = baseline.eval_batch(x, cost, bl_val)
+
+    # Importance weight of the episode, truncated at opts.is_clip as in V-trace
+    rho = (log_likelihood.detach() - actor_ll).exp().clamp(max=opts.is_clip)
+    reinforce_loss = (rho * (cost.squeeze(1) - bl_val) * log_likelihood).mean()
+    loss = reinforce_loss + bl_loss - opts.ent_rate * e
+    grad_norms = accumulate_gradients(
+        loss, optimizers, batch_id, num_batches, opts
+    ) or [[0, 0], [0, 0]]
+
+    # Logging
+    log_batch(
+        cost,
+        epoch,
+        batch_id,
+        step,
+        log_likelihood,
+        tb_logger,
+        opts,
+        x.num_graphs,
+        grad_norms=grad_norms,
+        reinforce_loss=reinforce_loss,
+        bl_loss=bl_loss,
+        scalars={"actor_learner/importance_weight": rho.mean()},
+    )
+
+
+def train_batch_ppo(
+    model,
+    optimizers,
+    baseline,
+    epoch,
+    batch_id,
+    step,
+    batch,
+    tb_logger,
+    opts,
+    num_batches=None,
+):
+    """
+    Clipped-surrogate (PPO) updates: the batch is rolled out once and its decoding steps are reused for
+    opts.ppo_epochs passes of shuffled minibatch updates. The advantage of a step is the advantage of its episode.
+    """
+    x, bl_val = baseline.unwrap_batch(batch)
+    x = move_to(x, opts.device)
+    bl_val = move_to(bl_val, opts.device) if bl_val is not None else None
+    inner_model = get_inner_model(model)
+
+    # Rollout buffer with the inputs, action and log-probability of every decoding step, each step is
+    # replayed as an episode of length one
+    with torch.no_grad():
+        cost, log_likelihood, pi, (s, mask) = inner_model.act(x, opts)
+        s, mask = s.flatten(0, 1).unsqueeze(1), mask.flatten(0, 1).unsqueeze(1)
+        old_log_p, _ = inner_model.replay((s, mask), pi.reshape(-1, 1), opts)
+    bl_val, critic_loss = baseline.eval_batch(x, cost, bl_val)
+    bl_loss = critic_loss
+    adv = (cost.squeeze(1) - bl_val).detach().unsqueeze(1).expand_as(pi).flatten()
+    pi = pi.reshape(-1, 1)
+
+    num_steps = pi.size(0)
+    grad_norms = [[0, 0], [0, 0]]
+    for _ in range(opts.ppo_epochs):
+        perm = torch.randperm(num_steps, device=pi.device)
+        for start in range(0, num_steps, opts.ppo_minibatch_size):
+            idx = perm[start : start + opts.ppo_minibatch_size]
+            log_p, e = inner_model.replay((s[idx], mask[idx]), pi[idx], opts)
+            ratio = (log_p - old_log_p[idx]).exp()
+            # Costs are minimized, so the pessimistic surrogate is the maximum of the two
+            ppo_loss = torch.max(
+                ratio * adv[idx],
+                ratio.clamp(1 - opts.ppo_clip, 1 + opts.ppo_clip) * adv[idx],
+            ).mean()
+            loss = ppo_loss + bl_loss - opts.ent_rate * e
+            bl_loss = 0  # The baseline loss only enters the first update
+            grad_norms = accumulate_gradients(loss, optimizers, 0, None, opts)
+
+    # Logging
+    log_batch(
+        cost,
+        epoch,
+        batch_id,
+        step,
+        log_likelihood,
+        tb_logger,
+        opts,
+        x.num_graphs,
+        grad_norms=grad_norms,
+        reinforce_loss=ppo_loss,
+        bl_loss=critic_loss,
+        scalars={
+            "ppo/clip_fraction": ((ratio - 1).abs() > opts.ppo_clip).float().mean()
+        },
+    )
+
+
+def get_optimal_sizes(batch, opts):
+    # The batch size is the one of the batch, the last batch of a dataset may be smaller
+    if opts.problem == "osbm" or opts.problem == "adwords":
+        return batch.y.reshape(batch.num_graphs, opts.v_size + 1)[:, 0]
+    return batch.y
+
+
+def get_optimal_matchings(batch, opts):
+    if opts.problem == "osbm" or opts.problem == "adwords":
+        return batch.y.reshape(batch.num_graphs, opts.v_size + 1)[:, 1:]
+    return batch.x.reshape(batch.num_graphs, opts.v_size)
+
+
+def build_feature_dataset(model, dataloader, opts, teacher_forcing=True):
+    """
+    Precomputes the (state features, optimal action) pair of every arrival of the dataset.
+    """
+    print(
+        "Collecting {} features...".format(
+            "teacher-forced" if teacher_forcing else "on-policy"
+        )
+    )
+    model.eval()
+    features, labels = [], []
+    with torch.no_grad():
+        for batch in tqdm(dataloader, disable=opts.no_progress_bar):
+            batch = move_to(batch, opts.device)
+            s, y = get_inner_model(model).collect_features(
+                batch, get_optimal_matchings(batch, opts), opts, teacher_forcing
+            )
+            features.append(s.cpu())
+            labels.append(y.cpu())
+    model.train()
+    return TensorDataset(torch.cat(features, 0), torch.cat(labels, 0))
+
+
+def train_epoch_teacher_forced(
+    model, optimizers, epoch, step, training_dataloader, tb_logger, opts
+):
+    """
+    One epoch of ff-supervised training as plain classification of single arrivals. The teacher-forced
+    features are computed once and cached on the model, the on-policy ones are refreshed every
+    opts.dagger_every epochs.
+    """
+    inner = get_inner_model(model)
+    if inner.feature_cache is None:
+        inner.feature_cache = (
+            build_feature_dataset(model, training_dataloader, opts),
+            None,
+        )
+    if opts.dagger_every > 0 and (epoch + 1) % opts.dagger_every == 0:
+        inner.feature_cache = (
+            inner.feature_cache[0],
+            build_feature_dataset(
+                model, training_dataloader, opts, teacher_forcing=False
+            ),
+        )
+    dataset = ConcatDataset([d for d in inner.feature_cache if d is not None])
+    feature_dataloader = DataLoader(
+        dataset, batch_size=opts.tf_batch_size, shuffle=True
+    )
+    w = get_class_weights(opts)
+    for batch_id, (s, y) in enumerate(
+        tqdm(feature_dataloader, disable=opts.no_progress_bar)
+    ):
+        s, y = move_to(s, opts.device), move_to(y, opts.device)
+        loss = get_loss(inner.ff(s), y, optimizers, w, opts)
+        accumulate_gradients(
+            loss, optimizers, batch_id, len(feature_dataloader), opts, clip=False
+        )
+        if isinstance(tb_logger, MetricsLogger):
+            # Every feature is a single arrival
+            tb_logger.add("batch loss", loss)
+            tb_logger.step(step, epoch, s.size(0), s.size(0))
+        elif step % int(opts.log_step) == 0:
+            print(
+                "epoch: {}, train_batch_id: {}, loss: {}".format(
+                    epoch, batch_id, loss.item()
+                )
+            )
+            if not opts.no_tensorboard:
+                tb_logger.add_scalar("batch loss", loss.item(), step)
+        step += 1
+    return step
 
 
 def train_batch_supervised(
-    model, optimizers, epoch, batch_id, step, batch, tb_logger, opts
+    model, optimizers, epoch, batch_id, step, batch, tb_logger, opts, num_batches=None
 ):
     # Evaluate model, get costs and log probabilities
     batch = move_to(batch, opts.device)
-    if opts.problem == "e-obm":
-        matchings = batch.x.reshape(opts.batch_size, opts.v_size)
-    else:
-        matchings = batch.y.reshape(opts.batch_size, opts.v_size + 1)[:, 1:]
+    matchings = get_optimal_matchings(batch, opts)
     # print("batch.y ", batch.y)
     cost, log_likelihood, e, batch_loss = model(
         batch, matchings, opts, optimizers, training=True
     )
+    if opts.model == "ff-supervised":
+        accumulate_gradients(
+            batch_loss, optimizers, batch_id, num_batches, opts, clip=False
+        )
 
     # Logging
-    log_values(
+    log_batch(
         cost,
         epoch,
         batch_id,
         step,
         log_likelihood,
         tb_logger,
+        opts,
+        batch.num_graphs,
         batch_loss=batch_loss,
-        opts=opts,
     )
@@ -0,0 +1,106 @@
+import copy
+import time
+import torch
+import torch.multiprocessing as mp
+
+
+def _actor_loop(model, opts, shared_params, version, lock, jobs, results):
+    """
+    Rolls out the batches of the jobs queue with the latest published parameters until it receives None.
+    """
+    torch.set_num_threads(1)  # The actors run in parallel, one core each
+    model.set_decode_type("sampling")
+    local_version = -1
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        batch_id, x = job
+        start = time.time()
+        if version.value != local_version:
+            with lock:
+                model.load_state_dict(shared_params)
+                local_version = version.value
+        with torch.no_grad():
+            cost, ll, pi, states = model.act(x, opts)
+        results.put(
+            (batch_id, cost, ll, pi, states, local_version, time.time() - start)
+        )
+
+
+class ActorPool(object):
+    """
+    Actor processes rolling out batches with snapshots of the policy, for asynchronous actor-learner training.
+
+    The learner submits batches, collects the trajectories in the order they are finished and publishes its
+    parameters every so often; actors load the latest published parameters before each rollout.
+    """
+
+    def __init__(self, model, opts):
+        # Not fork, torch has started its thread pools in this process. The actors get a copy of the model and
+        # the handles of the shared-memory parameters it loads the published parameters from
+        ctx = mp.get_context("spawn")
+        self.shared_params = {
+            k: v.detach().cpu().clone().share_memory_()
+            for k, v in model.state_dict().items()
+        }
+        actor_model = copy.deepcopy(model)
+        self.version = ctx.Value("i", 0)
+        self.lock = ctx.Lock()
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.actors = [
+            ctx.Process(
+                target=_actor_loop,
+                args=(
+                    actor_model,
+                    opts,
+                    self.shared_params,
+                    self.version,
+                    self.lock,
+                    self.jobs,
+                    self.results,
+                ),
+                daemon=True,
+            )
+            for _ in range(opts.num_actors)
+        ]
+        self.start_time = time.time()
+        self.actor_time = 0.0
+        self.learner_time = 0.0
+        self.lags = []
+        for actor in self.actors:
+            actor.start()
+
+    def submit(self, batch_id, x):
+        self.jobs.put((batch_id, x))
+
+    def get(self):
+        """
+        Waits for the next finished rollout.
+        :return: (batch_id, cost, ll, pi, states), ll is the log-likelihood under the actor's parameters
+        """
+        batch_id, cost, ll, pi, states, version, duration = self.results.get()
+        self.actor_time += duration
+        self.lags.append(self.version.value - version)
+        return batch_id, cost, ll, pi, states
+
+    def publish(self, model):
+        with self.lock:
+            for k, v in model.state_dict().items():
+                self.shared_params[k].copy_(v.detach())
+            self.version.value += 1
+
+    def close(self):
+        for _ in self.actors:
+            self.jobs.put(None)
+        for actor in self.actors:
+            actor.join()
+
+    def stats(self):
+        wall_time = max(time.time() - self.start_time, 1e-8)
+        return {
+            "actor_utilization": self.actor_time / (len(self.actors) * wall_time),
+            "learner_utilization": self.learner_time / wall_time,
+            "policy_lag": sum(self.lags) / max(len(self.lags), 1),
+        }
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import socket
+import platform
+import resource
+import torch
+import multiprocessing as mp
+import torch.optim as optim
+from functools import partial
+from torch_geometric.data import DataLoader as geoDataloader
+
+from train import (
+    set_decode_type,
+    train_batch,
+    train_batch_ppo,
+    train_batch_supervised,
+    train_epoch_actor_learner,
+    train_epoch_teacher_forced,
+)
+from policy.ensemble import FFEnsemble
+from utils.functions import move_to
+from utils.reinforce_baselines import NoBaseline
+
+
+def get_fingerprint(opts):
+    """
+    Key of the tuned configuration: the host and its CPUs, the model, the graph size, the training path and the
+    dataset size (the batch size candidates divide it).
+    """
+    return "{}|{}|{}cpus|torch-{}|{}|{}|{}x{}|ensemble-{}|ppo-{}|actors-{}|tf-{}|{}".format(
+        socket.gethostname(),
+        platform.processor() or platform.machine(),
+        os.cpu_count(),
+        torch.__version__,
+        opts.model,
+        opts.problem,
+        opts.u_size,
+        opts.v_size,
+        opts.ensemble_size,
+        opts.ppo_epochs,
+        opts.num_actors,
+        int(opts.teacher_forcing),
+        opts.dataset_size,
+    )
+
+
+def _max_rss():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def train_batches(model, optimizers, baseline, batches, opts):
+    """
+    Trains on the batches with the training path the run will use (see train_epoch).
+    """
+    if opts.teacher_forcing:
+        train_epoch_teacher_forced(model, optimizers, 0, 1, batches, None, opts)
+    elif opts.model == "supervised" or opts.model == "ff-supervised":
+        for batch_id, batch in enumerate(batches):
+            train_batch_supervised(
+                model, optimizers, 0, batch_id, 1, batch, None, opts, len(batches)
+            )
+    elif opts.num_actors > 0:
+        train_epoch_actor_learner(model, optimizers, baseline, 0, 1, batches, None, opts)
+    else:
+        train_fn = train_batch_ppo if opts.ppo_epochs > 0 else train_batch
+        for batch_id, batch in enumerate(batches):
+            # step 1 is never a logging step
+            train_fn(
+                model,
+                optimizers,
+                baseline,
+                0,
+                batch_id,
+                1,
+                batch,
+                None,
+                opts,
+                num_batches=len(batches),
+            )
+
+
+def _benchmark_configs(conn, model_class, problem, dataset, interop_threads, opts):
+    """
+    Training throughput (instances/s) and peak RSS of every (batch size, intra-op threads) candidate with the
+    given number of inter-op threads, which can only be set once per process.
+    """
+    torch.set_num_interop_threads(interop_threads)
+    # Nothing to log, this is a copy of the options of the run
+    opts.no_tensorboard = opts.no_progress_bar = True
+    if opts.ensemble_size > 1:
+        model_class = partial(FFEnsemble, model_class)
+    results = []
+    # Ascending batch sizes, the peak RSS only grows
+    for batch_size in sorted(opts.autotune_batch_sizes):
+        opts.batch_size = batch_size
+        batches = [
+            move_to(batch, opts.device)
+            for _, batch in zip(
+                range(opts.autotune_steps + 1),
+                geoDataloader(dataset, batch_size=batch_size, shuffle=True),
+            )
+        ]
+        if len(batches) < 2:
+            continue  # Not enough instances to time a batch of this size
+        for threads in opts.autotune_threads:
+            torch.set_num_threads(threads)
+            torch.manual_seed(opts.seed)
+            model = model_class(
+                opts.embedding_dim,
+                opts.hidden_dim,
+                problem=problem,
+                n_encode_layers=opts.n_encode_layers,
+                mask_inner=True,
+                mask_logits=True,
+                normalization=opts.normalization,
+                tanh_clipping=opts.tanh_clipping,
+                checkpoint_encoder=opts.checkpoint_encoder,
+                shrink_size=opts.shrink_size,
+                num_actions=opts.u_size + 1,
+                n_heads=opts.n_heads,
+                encoder=opts.encoder,
+                opts=opts,
+            ).to(opts.device)
+            set_decode_type(
+                model,
+                "self-critical" if opts.baseline == "self-critical" else "sampling",
+            )
+            optimizers = [optim.Adam(model.parameters(), lr=opts.lr_model)]
+            baseline = NoBaseline()
+            # The first batch is a warm-up
+            train_batches(model, optimizers, baseline, batches[:1], opts)
+            start = time.perf_counter()
+            train_batches(model, optimizers, baseline, batches[1:], opts)
+            duration = time.perf_counter() - start
+            results.append(
+                {
+                    "batch_size": batch_size,
+                    "num_threads": threads,
+                    "num_interop_threads": interop_threads,
+                    "instances_per_sec": sum(b.num_graphs for b in batches[1:])
+                    / duration,
+                    "peak_rss": _max_rss(),
+                }
+            )
+    conn.send(results)
+    conn.close()
+
+
+def benchmark_configs(model_class, problem, dataset, opts):
+    """
+    Benchmarks every candidate configuration, one process per number of inter-op threads.
+    """
+    ctx = mp.get_context("spawn")
+    results = []
+    # Only the instances of the timed batches are sent to the processes
+    n = max(opts.autotune_batch_sizes) * (opts.autotune_steps + 1)
+    dataset = [dataset[i] for i in range(min(n, len(dataset)))]
+    for interop_threads in opts.autotune_interop_threads:
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        p = ctx.Process(
+            target=_benchmark_configs,
+            args=(child_conn, model_class, problem, dataset, interop_threads, opts),
+        )
+        p.start()
+        child_conn.close()
+        try:
+            results += parent_conn.recv()
+        except EOFError:  # Killed, most likely out of memory
+            print(
+                "Autotune: candidates with {} inter-op threads failed".format(
+                    interop_threads
+                )
+            )
+        p.join()
+    return results
+
+
+def describe(config):
+    return "batch size {batch_size}, {num_threads} threads, {num_interop_threads} inter-op threads".format(
+        **config
+    )
+
+
+def load_cache(opts):
+    if not os.path.isfile(opts.autotune_cache):
+        return {}
+    with open(opts.autotune_cache, "r") as f:
+        return json.load(f)
+
+
+def set_interop_threads(num_threads):
+    """
+    The inter-op thread pool of torch can only be sized before it starts. Once it is running with another size,
+    the tuned value is kept in the cache and applied by the next run, which sets it at startup.
+    """
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError:
+        if torch.get_num_interop_threads() != num_threads:
+            print(
+                "Autotune: torch already runs {} inter-op threads, the tuned {} apply from the next run".format(
+                    torch.get_num_interop_threads(), num_threads
+                )
+            )
+
+
+def apply_cached_interop_threads(opts):
+    """
+    Sets the cached number of inter-op threads of the run's fingerprint, must be called before any torch op.
+    """
+    config = load_cache(opts).get(get_fingerprint(opts), None)
+    if config is not None:
+        set_interop_threads(config["num_interop_threads"])
+
+
+def autotune(model_class, problem, dataset, opts):
+    """
+    Sets opts.batch_size and the number of intra- and inter-op threads to the configuration
+    with the highest training throughput whose peak memory fits in opts.autotune_memory_gb. The choice is cached
+    in opts.autotune_cache for the fingerprint of the host, model and size, and reused by later runs.
+    """
+    # The epochs must be whole numbers of batches
+    batch_sizes = [b for b in opts.autotune_batch_sizes if opts.dataset_size % b == 0]
+    assert (
+        len(batch_sizes) > 0
+    ), "No --autotune_batch_sizes candidate divides --dataset_size {}".format(
+        opts.dataset_size
+    )
+    opts.autotune_batch_sizes = batch_sizes
+    fingerprint = get_fingerprint(opts)
+    cache = load_cache(opts)
+    config = cache.get(fingerprint, None)
+    if config is None:
+        results = benchmark_configs(model_class, problem, dataset, opts)
+        budget = (
+            opts.autotune_memory_gb * 2 ** 30
+            if opts.autotune_memory_gb is not None
+            else float("inf")
+        )
+        feasible = [r for r in results if r["peak_rss"] <= budget]
+        assert len(feasible) > 0, "No autotune candidate fits in the memory budget"
+        for r in sorted(feasible, key=lambda r: -r["instances_per_sec"]):
+            print(
+                "Autotune: {}: {:.1f} instances/s".format(
+                    describe(r), r["instances_per_sec"]
+                )
+            )
+        config = max(feasible, key=lambda r: r["instances_per_sec"])
+        cache[fingerprint] = config
+        with open(opts.autotune_cache, "w") as f:
+            json.dump(cache, f, indent=True)
+    else:
+        print("Autotune: using the cached configuration of {}".format(fingerprint))
+
+    opts.batch_size = config["batch_size"]
+    torch.set_num_threads(config["num_threads"])
+    set_interop_threads(config["num_interop_threads"])
+    print("Autotune: {}".format(describe(config)))
+    return config
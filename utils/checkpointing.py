@@ -0,0 +1,116 @@
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+CHECKPOINT_POLICIES = ("none", "every-k", "memory-budget")
+
+
+class EncoderCheckpointer(object):
+    """
+    Decides for every decoding step whether the encoder call is wrapped in torch.utils.checkpoint.
+
+    Policies:
+    - "none": never checkpoint, keep all encoder activations for the backward pass.
+    - "every-k": checkpoint every k-th step (k = 1 checkpoints every step).
+    - "memory-budget": keep the activations of the steps as long as the measured activation size
+      fits in `budget` bytes, and checkpoint the remaining steps of the episode.
+    """
+
+    def __init__(self, policy="every-k", every=1, budget=None):
+        assert policy in CHECKPOINT_POLICIES, "Unknown checkpoint policy: {}".format(
+            policy
+        )
+        assert (
+            policy != "memory-budget" or budget is not None
+        ), "memory-budget checkpointing requires a byte budget"
+        self.policy = policy
+        self.every = max(int(every), 1)
+        self.budget = budget
+        self.reset_epoch()
+        self.reset()
+
+    def reset_epoch(self):
+        """
+        Call at the start of every epoch, stats() reports over the episodes since.
+        """
+        self.epoch_steps = 0
+        self.epoch_checkpointed = 0
+        self.epoch_episodes = 0
+        self.epoch_bytes = 0  # activation bytes kept for backward, summed over the episodes
+        self.peak_bytes = 0  # largest activation bytes kept at once in an episode
+
+    def reset(self):
+        """
+        Call at the start of every episode.
+        """
+        self.stored_bytes = 0  # activation bytes kept for backward in this episode
+        self.bytes_per_edge = None  # last measured activation bytes per subgraph edge
+        self.num_steps = 0
+        self.num_checkpointed = 0
+        self.epoch_episodes += 1
+
+    def free(self):
+        """
+        Call when the graph of the previous steps has been freed (e.g. after a truncated update).
+        """
+        self.stored_bytes = 0
+
+    def __call__(self, module, step, num_edges, *args):
+        """
+        Runs module(*args) for decoding step `step`, checkpointing it if the policy says so.
+        :param num_edges: number of edges of the subgraph passed to the encoder, used to estimate
+        the activation size of this step
+        """
+        if not torch.is_grad_enabled():  # Nothing to keep for backward
+            return module(*args)
+        self.num_steps += 1
+        self.epoch_steps += 1
+        if self._should_checkpoint(step, num_edges):
+            self.num_checkpointed += 1
+            self.epoch_checkpointed += 1
+            return checkpoint(module, *args)
+        if self.policy != "memory-budget":
+            return module(*args)
+
+        out, saved_bytes = self._measure(module, *args)
+        self.stored_bytes += saved_bytes
+        self.epoch_bytes += saved_bytes
+        self.peak_bytes = max(self.peak_bytes, self.stored_bytes)
+        self.bytes_per_edge = saved_bytes / max(num_edges, 1)
+        return out
+
+    def _should_checkpoint(self, step, num_edges):
+        if self.policy == "none":
+            return False
+        if self.policy == "every-k":
+            return step % self.every == 0
+        if self.bytes_per_edge is None:  # First step is run as is to measure its size
+            return False
+        return self.stored_bytes + self.bytes_per_edge * num_edges > self.budget
+
+    def _measure(self, module, *args):
+        """
+        Runs the module and returns its output with the number of bytes autograd saved for backward.
+        Parameters are not counted since they are kept in memory anyway.
+        """
+        saved = [0]
+
+        def pack(t):
+            if not (t.is_leaf and t.requires_grad):
+                saved[0] += t.numel() * t.element_size()
+            return t
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            out = module(*args)
+        return out, saved[0]
+
+    def stats(self):
+        """
+        Stats of the epoch: the ratio of checkpointed steps and the activation bytes kept per episode (only
+        measured by the memory-budget policy).
+        """
+        return {
+            "checkpointed_ratio": self.epoch_checkpointed / max(self.epoch_steps, 1),
+            "activation_bytes": self.epoch_bytes / max(self.epoch_episodes, 1),
+            "peak_activation_bytes": self.peak_bytes,
+        }
@@ -0,0 +1,128 @@
+import os
+import torch
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
+from torch_geometric.data import DataLoader as geoDataloader
+
+
+def init_distributed(opts):
+    """
+    Joins the process group when launched with torchrun (or any launcher setting RANK, WORLD_SIZE,
+    MASTER_ADDR and MASTER_PORT), e.g. torchrun --nproc_per_node=8 run.py --distributed ...
+    Only rank 0 writes TensorBoard logs and checkpoints.
+    """
+    opts.rank, opts.world_size = 0, 1
+    if not opts.distributed:
+        return
+    assert not opts.use_cuda, "Distributed training uses the gloo backend, run with --no_cuda"
+    dist.init_process_group(backend="gloo", init_method="env://")
+    opts.rank, opts.world_size = dist.get_rank(), dist.get_world_size()
+    assert (
+        opts.dataset_size % (opts.batch_size * opts.world_size) == 0
+    ), "Epoch size must be integer multiple of batch size times the number of processes!"
+    # Split the cores between the ranks, oversubscribing them slows everything down
+    torch.set_num_threads(max(1, os.cpu_count() // opts.world_size))
+    if opts.rank != 0:
+        opts.no_tensorboard = True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process(opts):
+    return getattr(opts, "rank", 0) == 0
+
+
+def make_training_dataloader(dataset, epoch, opts, sampler=None):
+    """
+    Shuffled training dataloader, each rank gets its own shard of the dataset when distributed.
+    :param sampler: sampler of the training instances instead of shuffling, e.g. a PrioritizedSampler
+    """
+    if sampler is not None:
+        return geoDataloader(
+            dataset, batch_size=opts.batch_size, num_workers=0, sampler=sampler
+        )
+    if not is_distributed():
+        return geoDataloader(
+            dataset, batch_size=opts.batch_size, num_workers=0, shuffle=True,
+        )
+    sampler = DistributedSampler(dataset, shuffle=True, seed=opts.seed)
+    sampler.set_epoch(epoch)
+    return geoDataloader(
+        dataset, batch_size=opts.batch_size, num_workers=0, sampler=sampler
+    )
+
+
+def broadcast_parameters(model):
+    """
+    Makes every rank start from the parameters of rank 0.
+    """
+    if not is_distributed():
+        return
+    for p in model.state_dict().values():
+        dist.broadcast(p, src=0)
+
+
+def average_gradients(param_groups):
+    """
+    All-reduces the gradients so that every rank takes the same optimizer step.
+    """
+    if not is_distributed():
+        return
+    params = [p for group in param_groups for p in group["params"]]
+    for p in params:
+        if p.grad is None:  # Every rank must reduce the same flat buffer
+            p.grad = torch.zeros_like(p)
+    # A single all-reduce of the flattened gradients is much cheaper than one per parameter
+    flat = torch.cat([p.grad.flatten() for p in params])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= dist.get_world_size()
+    offset = 0
+    for p in params:
+        p.grad.copy_(flat[offset : offset + p.numel()].view_as(p))
+        offset += p.numel()
+
+
+def all_reduce_mean(t):
+    """
+    Mean of a tensor over the ranks, the tensor itself if not distributed.
+    """
+    if not is_distributed():
+        return t
+    t = t.clone()
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t / dist.get_world_size()
+
+
+def all_reduce_sum(t):
+    """
+    Sum of a tensor over the ranks, the tensor itself if not distributed.
+    """
+    if not is_distributed():
+        return t
+    t = t.clone()
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t
+
+
+def all_reduce_max(t):
+    """
+    Max of a tensor over the ranks, the tensor itself if not distributed.
+    """
+    if not is_distributed():
+        return t
+    t = t.clone()
+    dist.all_reduce(t, op=dist.ReduceOp.MAX)
+    return t
+
+
+def broadcast_object(obj):
+    """
+    Returns the object of rank 0 on every rank.
+    """
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=0)
+    return objs[0]
@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+# Bump when the decoding of a policy or the evaluation changes, the results cached by older versions are not used
+CACHE_VERSION = 1
+
+# Per-instance results of a policy on an eval dataset, everything else is derived from them
+CACHED_RESULTS = ["cost", "cr", "actions", "matches_opt"]
+
+# Options the results of a policy on a dataset depend on, besides the checkpoint and the dataset
+EVAL_OPTIONS = [
+    "problem",
+    "eval_size",
+    "eval_batch_size",
+    "seed",
+    "embedding_dim",
+    "hidden_dim",
+    "n_encode_layers",
+    "n_heads",
+    "normalization",
+    "tanh_clipping",
+    "threshold",
+]
+
+_file_hashes = {}
+
+
+def file_hash(*paths):
+    """
+    sha256 of the content of the files, memoized per path.
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        if path not in _file_hashes:
+            with open(path, "rb") as f:
+                _file_hashes[path] = hashlib.sha256(f.read()).hexdigest()
+        h.update(_file_hashes[path].encode())
+    return h.hexdigest()
+
+
+def dataset_hash(dataset, opts):
+    return file_hash(
+        *("{}/data_{}.pt".format(dataset, i) for i in range(opts.eval_size))
+    )
+
+
+def result_key(model, checkpoint, dataset, u_size, v_size, opts):
+    """
+    Key of the results of a policy on an eval dataset: the content of its checkpoint (its name and tuned threshold
+    for the baselines, which have none), the content of the dataset, the graph size, the eval options and the
+    cache version.
+    """
+    policy = (
+        [model.model_name, getattr(model, "best_threshold", None)]
+        if checkpoint is None
+        else file_hash(checkpoint)
+    )
+    return hashlib.sha256(
+        json.dumps(
+            [
+                CACHE_VERSION,
+                policy,
+                dataset_hash(dataset, opts),
+                u_size,
+                v_size,
+                [getattr(opts, k) for k in EVAL_OPTIONS],
+            ]
+        ).encode()
+    ).hexdigest()
+
+
+def load_result(cache_dir, key):
+    """
+    The cached per-instance results of the key, or None if they were not computed yet.
+    """
+    path = os.path.join(cache_dir, "{}.npz".format(key))
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as f:
+        return {k: torch.from_numpy(f[k]) for k in CACHED_RESULTS}
+
+
+def save_result(cache_dir, key, result, model_name, checkpoint, dataset):
+    """
+    Stores the per-instance results of a policy, with the policy and the dataset they come from.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, "{}.npz".format(key))
+    # Written then renamed, an interrupted run does not leave a partial entry behind
+    tmp_path = path + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        model_name=model_name,
+        checkpoint=str(checkpoint),
+        dataset=dataset,
+        **{k: result[k].numpy() for k in CACHED_RESULTS}
+    )
+    os.replace(tmp_path, path)
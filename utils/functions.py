@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 import os
+import resource
 from tqdm import tqdm
 from multiprocessing.dummy import Pool as ThreadPool
 from multiprocessing import Pool
@@ -10,6 +11,7 @@ from problem_state.osbm_dataset import OSBM
 from problem_state.adwords_dataset import AdwordsBipartite
 import torch.nn.functional as F
 import csv
+import json
 
 
 def load_problem(name):
@@ -38,6 +40,14 @@ def move_to(var, device):
     return var.to(device)
 
 
+def get_peak_memory(device):
+    """Returns the peak memory (in bytes) of this process on the given device"""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 def _load_model_file(load_path, model):
     """Loads the model with parameters from the file and returns optimizer state dict if it is in the file"""
 
@@ -64,12 +74,22 @@ def _load_model_file(load_path, model):
     return model, load_optimizer_state_dict
 
 
+def get_threshold_results_file(model, opts):
+    return f"val_rewards_{model}_{opts.u_size}_{opts.v_size}_{opts.graph_family}_{opts.graph_family_parameter}.json"
+
+
 def get_best_t(model, opts):
+    # Results of the vectorized threshold sweep, see sweep_thresholds
+    results_file = get_threshold_results_file(model, opts)
+    if os.path.isfile(results_file):
+        with open(results_file) as f:
+            return json.load(f)["best_threshold"]
+    csv_file_name = f"val_rewards_{model}_{opts.u_size}_{opts.v_size}_{opts.graph_family}_{opts.graph_family_parameter}.csv"
+    if not os.path.isfile(csv_file_name):  # Not tuned yet
+        return None
     best_params = None
     best_r = 0
-    with open(
-        f"val_rewards_{model}_{opts.u_size}_{opts.v_size}_{opts.graph_family}_{opts.graph_family_parameter}.csv"
-    ) as csv_file:
+    with open(csv_file_name) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=",")
         for line in csv_reader:
             if abs(float(line[-1])) > best_r:
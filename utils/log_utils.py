@@ -1,3 +1,14 @@
+import os
+import csv
+import time
+import queue
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+
 def log_values(
     cost,
     epoch,
@@ -41,3 +52,133 @@ def log_values(
                 tb_logger.add_scalar(
                     "critic_grad_norm_clipped", grad_norms_clipped[1], step
                 )
+
+
+class MetricsLogger(object):
+    """
+    Buffered training metrics. Batch metrics are accumulated as running sums on their device without synchronizing,
+    every flush_every batches their means and the throughput (instances/s, env steps/s and the share of time spent in
+    the timed phases) are handed to a background thread that prints them and writes them to TensorBoard and to a
+    CSV file (step, tag, value).
+
+    It can be used in place of the SummaryWriter: add_scalar is also written by the background thread.
+    """
+
+    def __init__(self, tb_logger=None, csv_path=None, flush_every=50):
+        self.tb_logger = tb_logger
+        self.csv_path = csv_path
+        self.flush_every = max(1, int(flush_every))
+        self.sums, self.counts = {}, {}
+        self.timers = defaultdict(float)
+        self.num_batches = self.num_instances = self.num_env_steps = 0
+        self.start_time = time.time()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def add(self, tag, value):
+        if torch.is_tensor(value):
+            value = value.detach().float().mean()
+        self.sums[tag] = self.sums.get(tag, 0.0) + value
+        self.counts[tag] = self.counts.get(tag, 0) + 1
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.time()
+        yield
+        self.timers[phase] += time.time() - start
+
+    def add_time(self, phase, seconds):
+        self.timers[phase] += seconds
+
+    def timed(self, iterable, phase):
+        """
+        Yields the items of the iterable, timing the wait for every item as the phase (e.g. data loading).
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.timers[phase] += time.time() - start
+            yield item
+
+    def add_scalar(self, tag, value, step):
+        if torch.is_tensor(value):
+            value = value.detach().cpu()
+        self.queue.put(("scalar", {tag: value}, step))
+
+    def step(self, step, epoch, num_instances, num_env_steps):
+        """
+        Ends a batch of num_instances instances (num_env_steps environment steps), flushing every flush_every batches.
+        """
+        self.num_batches += 1
+        self.num_instances += num_instances
+        self.num_env_steps += num_env_steps
+        if self.num_batches % self.flush_every == 0:
+            self.flush(step, epoch)
+
+    def flush(self, step, epoch=None):
+        if self.num_batches == 0:
+            return
+        tags = list(self.sums.keys())
+        means = [self.sums[tag] / self.counts[tag] for tag in tags]
+        # A single device to host copy for all the tensor metrics
+        tensors = [m for m in means if torch.is_tensor(m)]
+        if len(tensors) > 0:
+            host = iter(torch.stack(tensors).cpu().tolist())
+            means = [next(host) if torch.is_tensor(m) else m for m in means]
+        values = dict(zip(tags, means))
+
+        elapsed = max(time.time() - self.start_time, 1e-8)
+        values["throughput/instances_per_sec"] = self.num_instances / elapsed
+        values["throughput/env_steps_per_sec"] = self.num_env_steps / elapsed
+        for phase, t in self.timers.items():
+            values["time/" + phase] = t / elapsed
+        values["time/other"] = max(0.0, 1.0 - sum(self.timers.values()) / elapsed)
+        self.queue.put(("flush", values, step, epoch))
+
+        self.sums, self.counts = {}, {}
+        self.timers = defaultdict(float)
+        self.num_batches = self.num_instances = self.num_env_steps = 0
+        self.start_time = time.time()
+
+    def _write(self, values, step):
+        if self.tb_logger is not None:
+            for tag, value in values.items():
+                self.tb_logger.add_scalar(tag, value, step)
+        if self.csv_path is not None:
+            new_file = not os.path.exists(self.csv_path)
+            with open(self.csv_path, "a") as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(["step", "tag", "value"])
+                for tag, value in values.items():
+                    writer.writerow([step, tag, float(value)])
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if item[0] == "scalar":
+                _, values, step = item
+            else:
+                _, values, step, epoch = item
+                print(
+                    "epoch: {}, step: {}, avg_cost: {:.4f}, {:.1f} instances/s".format(
+                        epoch,
+                        step,
+                        values.get("avg_cost", float("nan")),
+                        values["throughput/instances_per_sec"],
+                    )
+                )
+            self._write(values, step)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.tb_logger is not None:
+            self.tb_logger.flush()
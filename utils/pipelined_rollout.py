@@ -0,0 +1,173 @@
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+import torch
+from multiprocessing.dummy import Pool as ThreadPool
+from torch_geometric.data import Batch
+
+from utils.profiling import phase
+
+# (Lockstep, half) of the half rolled out by the current thread, only within a pipelined rollout
+_local = threading.local()
+
+
+def split_batch(x):
+    data_list = x.to_data_list()
+    half = len(data_list) // 2
+    return Batch.from_data_list(data_list[:half]), Batch.from_data_list(data_list[half:])
+
+
+def merge_outputs(outputs):
+    """
+    Concatenates the per-trajectory outputs of the two halves, scalars (the entropy bonus) are averaged.
+    """
+    merged = []
+    for a, b in zip(*outputs):
+        if a is None:
+            merged.append(None)
+        elif a.dim() == 0:
+            merged.append((a + b) / 2)
+        else:
+            merged.append(torch.cat((a, b), 0))
+    return tuple(merged)
+
+
+class Lockstep(object):
+    """
+    Alternates the model phases of the two halves of a batch. A half enters its model phase on its turn and hands
+    the turn to the other half when it leaves it, so the env update of one half runs while the other half's model
+    forward is computing. A finished half no longer holds up the other.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.turn = 0
+        self.finished = [False, False]
+
+    @contextmanager
+    def turn_of(self, half):
+        with self.cond:
+            self.cond.wait_for(lambda: self.turn == half or self.finished[1 - half])
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.turn = 1 - half
+                self.cond.notify_all()
+
+    def finish(self, half):
+        with self.cond:
+            self.finished[half] = True
+            self.cond.notify_all()
+
+
+@contextmanager
+def model_phase(name):
+    """
+    The phase of a policy's model forward in a decoding step. Within a pipelined rollout, waits for the turn of
+    the half of the current thread.
+    """
+    lockstep = getattr(_local, "lockstep", None)
+    if lockstep is None:
+        with phase(name):
+            yield
+        return
+    with lockstep.turn_of(_local.half), phase(name):
+        yield
+
+
+class PipelinedRollout(object):
+    """
+    Rolls out a batch as two halves in lockstep, the first half on the calling thread and the second on a worker
+    thread. PyTorch releases the GIL in its kernels, so the environment bookkeeping of one half (state updates,
+    masks, history features) runs while the model forward of the other half is computing, instead of the two
+    alternating on one thread.
+
+    The number of intra-op threads is process-wide, it is tuned on the first batch by timing the candidates and
+    only set for the duration of every rollout.
+    """
+
+    def __init__(self):
+        self.pool = ThreadPool(1)
+        self.num_threads = None
+
+    def _run_half(self, lockstep, half, model, x, opts, optimizer, baseline, **kwargs):
+        _local.lockstep, _local.half = lockstep, half
+        try:
+            return model(x, opts, optimizer, baseline, **kwargs)
+        finally:
+            _local.lockstep = None
+            lockstep.finish(half)
+
+    def _run(self, model, halves, opts, optimizer, baseline, **kwargs):
+        lockstep = Lockstep()
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(self.num_threads)
+        try:
+            second = self.pool.apply_async(
+                self._run_half,
+                (lockstep, 1, model, halves[1], opts, optimizer, baseline),
+                kwargs,
+            )
+            first = self._run_half(
+                lockstep, 0, model, halves[0], opts, optimizer, baseline, **kwargs
+            )
+            return first, second.get()
+        finally:
+            torch.set_num_threads(num_threads)
+
+    def tune(self, model, halves, opts):
+        max_threads = torch.get_num_threads()
+        times = {}
+        for num_threads in sorted({1, max(1, max_threads // 2), max_threads}):
+            self.num_threads = num_threads
+            start = time.time()
+            with torch.no_grad():
+                self._run(model, halves, opts, None, None)
+            times[num_threads] = time.time() - start
+        self.num_threads = min(times, key=times.get)
+        print(
+            "Pipelined rollouts: {} intra-op threads ({})".format(
+                self.num_threads,
+                ", ".join("{}: {:.3f}s".format(k, v) for k, v in times.items()),
+            )
+        )
+
+    def __call__(self, model, x, opts, optimizer, baseline, **kwargs):
+        if x.num_graphs < 2:  # E.g. the last batch of an epoch, nothing to split
+            return model(x, opts, optimizer, baseline, **kwargs)
+        halves = split_batch(x)
+        if self.num_threads is None:
+            self.tune(model, halves, opts)
+        return merge_outputs(
+            self._run(model, halves, opts, optimizer, baseline, **kwargs)
+        )
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+_executor = None
+
+
+def pipelined_forward(model, x, opts, optimizer, baseline, **kwargs):
+    """
+    Same outputs as model(x, opts, optimizer, baseline, **kwargs), computed by the shared PipelinedRollout.
+    """
+    global _executor
+    if _executor is None:
+        _executor = PipelinedRollout()
+    return _executor(model, x, opts, optimizer, baseline, **kwargs)
+
+
+@atexit.register
+def shutdown_pipeline():
+    """
+    Stops the worker thread of the shared PipelinedRollout, the next pipelined rollout starts and tunes a new one.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.close()
+        _executor = None
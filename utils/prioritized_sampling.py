@@ -0,0 +1,63 @@
+import torch
+from torch.utils.data import Sampler
+from torch_geometric.data import Dataset
+
+
+class IndexedDataset(Dataset):
+    """
+    Training dataset whose instances carry their index (batch.sample_id after collating), so that the
+    prioritized sampler can be told how each sampled instance did.
+    """
+
+    def __init__(self, dataset):
+        super(IndexedDataset, self).__init__(None)
+        self.dataset = dataset
+
+    def len(self):
+        return len(self.dataset)
+
+    def get(self, idx):
+        data = self.dataset[idx]
+        data.sample_id = torch.tensor([idx])
+        return data
+
+
+class PrioritizedSampler(Sampler):
+    """
+    Samples the training instances with replacement in proportion to their remaining gap to optimal
+    (1 - ratio to optimal of their last training rollout) raised to alpha. Instances that were not rolled out yet
+    have the largest priority. The importance weights (num_samples * P(i)) ** -beta, normalized so that the
+    largest is 1, correct the policy gradient for the non-uniform sampling.
+    """
+
+    def __init__(self, num_samples, alpha=1.0, beta=1.0, eps=0.01):
+        self.num_samples = num_samples
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps  # Keeps solved instances in the training distribution
+        self.priorities = torch.ones(num_samples)
+        self.probs = torch.full((num_samples,), 1.0 / num_samples)
+
+    def __iter__(self):
+        # The distribution of an epoch is fixed when it starts, the weights of its batches refer to it
+        p = self.priorities ** self.alpha
+        self.probs = p / p.sum()
+        return iter(
+            torch.multinomial(self.probs, self.num_samples, replacement=True).tolist()
+        )
+
+    def __len__(self):
+        return self.num_samples
+
+    def weights(self, ids):
+        w = (self.num_samples * self.probs[ids]) ** -self.beta
+        return w / (self.num_samples * self.probs.min()) ** -self.beta
+
+    def update(self, ids, cr):
+        self.priorities[ids] = (1.0 - cr).clamp(min=0.0) + self.eps
+
+    def state_dict(self):
+        return {"priorities": self.priorities}
+
+    def load_state_dict(self, state_dict):
+        self.priorities = state_dict["priorities"]
@@ -0,0 +1,166 @@
+import os
+import time
+import functools
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+from torch.profiler import profile, record_function, ProfilerActivity
+
+# Names of the runs profiled so far, every run (train, eval) is profiled once per process
+_profiled_runs = set()
+
+
+class _PhaseState(threading.local):
+    # Rollouts of --pipeline_rollouts and --bl_background run on worker threads, each thread only records the
+    # phases it started recording, so that they do not add to the phases of the main thread.
+    # Phase -> [total seconds, calls], only while a PhaseProfiler is recording
+    timers = None
+    # [seconds] spent in the env phases, only within count_env_time
+    env_time = None
+    env_depth = 0
+
+
+_state = _PhaseState()
+
+
+@contextmanager
+def phase(name):
+    """
+    Times a phase of an episode and marks it as a range of the trace while profiling, does nothing otherwise.
+    Within count_env_time, the env phases ("env/...") are also added to the env time.
+    Only the phases of the thread that started recording are recorded.
+    """
+    state = _state
+    count_env = state.env_time is not None and name.startswith("env/")
+    if state.timers is None and not count_env:
+        yield
+        return
+    start = time.perf_counter()
+    # Env methods call each other, only the outermost env phase is counted
+    state.env_depth += count_env
+    try:
+        if state.timers is None:
+            yield
+        else:
+            with record_function(name):
+                yield
+    finally:
+        state.env_depth -= count_env
+    duration = time.perf_counter() - start
+    if count_env and state.env_depth == 0:
+        state.env_time[0] += duration
+    if state.timers is not None:
+        timer = state.timers[name]
+        timer[0] += duration
+        timer[1] += 1
+
+
+def profiled(name):
+    """
+    Decorator timing every call of a function as the phase name while profiling.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _state.timers is None and _state.env_time is None:
+                return fn(*args, **kwargs)
+            with phase(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def count_env_time():
+    """
+    Yields [seconds], the time spent in the env phases of the calling thread within the block.
+    """
+    _state.env_time = [0.0]
+    try:
+        yield _state.env_time
+    finally:
+        _state.env_time = None
+
+
+def start_phases():
+    """
+    Starts recording the phases of the calling thread, returns their timers (phase -> [total seconds, calls]).
+    """
+    _state.timers = defaultdict(lambda: [0.0, 0])
+    return _state.timers
+
+
+def stop_phases():
+    _state.timers = None
+
+
+class PhaseProfiler(object):
+    """
+    Profiles the first opts.profile batches of a run: writes a Chrome/Perfetto trace (open it in chrome://tracing or
+    ui.perfetto.dev) with the phases as ranges and prints the time spent in every phase. Phases can be nested, e.g.
+    env/make_state includes the dense adjacency, so their shares do not add up to 100%.
+
+    Only the first profiler of every name records, e.g. the profiler of the first training epoch.
+    """
+
+    def __init__(self, opts, name):
+        self.num_batches = getattr(opts, "profile", 0)
+        self.output_dir = getattr(opts, "profile_dir", "profiles")
+        self.use_cuda = opts.use_cuda
+        self.name = name
+        self.batch = 0
+        self.prof = None
+        if self.num_batches > 0 and name not in _profiled_runs:
+            _profiled_runs.add(name)
+            self._start()
+
+    def _start(self):
+        self.timers = start_phases()
+        activities = [ProfilerActivity.CPU]
+        if self.use_cuda:
+            activities.append(ProfilerActivity.CUDA)
+        self.prof = profile(activities=activities)
+        self.prof.__enter__()
+        self.start_time = time.perf_counter()
+
+    def step(self):
+        if self.prof is None:
+            return
+        self.batch += 1
+        if self.batch >= self.num_batches:
+            self.stop()
+
+    def stop(self):
+        if self.prof is None:
+            return
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        total = time.perf_counter() - self.start_time
+        self.prof.__exit__(None, None, None)
+        os.makedirs(self.output_dir, exist_ok=True)
+        trace = os.path.join(self.output_dir, "{}_trace.json".format(self.name))
+        self.prof.export_chrome_trace(trace)
+
+        print(
+            "Profile of {} batches ({:.3f}s), trace written to {}".format(
+                self.batch, total, trace
+            )
+        )
+        print(
+            "{:<28}{:>12}{:>10}{:>14}{:>9}".format(
+                "phase", "total (ms)", "calls", "per call (us)", "share"
+            )
+        )
+        for name, (t, calls) in sorted(self.timers.items(), key=lambda kv: -kv[1][0]):
+            print(
+                "{:<28}{:>12.1f}{:>10}{:>14.1f}{:>8.1f}%".format(
+                    name, 1e3 * t, calls, 1e6 * t / calls, 100 * t / total
+                )
+            )
+        stop_phases()
+        self.prof = None
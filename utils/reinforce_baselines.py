@@ -1,12 +1,21 @@
 import torch
+import numpy as np
 import torch.nn.functional as F
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset
 from scipy.stats import ttest_rel
+import multiprocessing
+from multiprocessing.dummy import Pool as ThreadPool
 import copy
 from train import rollout, get_inner_model
+from utils.distributed import all_reduce_mean, broadcast_object
 from torch_geometric.data import DataLoader
 
 
+def _loader_workers():
+    # The --tune sweep trains in daemonic pool workers, which are not allowed to start loader processes
+    return 0 if multiprocessing.current_process().daemon else 1
+
+
 class Baseline(object):
     def wrap_dataset(self, dataset):
         return dataset
@@ -17,6 +26,15 @@ class Baseline(object):
     def eval(self, x, c):
         raise NotImplementedError("Override this method")
 
+    def eval_batch(self, x, c, bl_val):
+        """
+        Baseline values and loss of a batch, bl_val are the values unwrap_batch read from the wrapped dataset
+        (None if the baseline does not cache its values).
+        """
+        if bl_val is None:
+            return self.eval(x, c)
+        return bl_val, 0
+
     def get_learnable_parameters(self):
         return []
 
@@ -32,13 +50,13 @@ class Baseline(object):
 
 class WarmupBaseline(Baseline):
     def __init__(
-        self, baseline, n_epochs=1, warmup_exp_beta=0.8,
+        self, baseline, n_epochs=1, warmup_exp_beta=0.8, accumulation_steps=1,
     ):
         super(Baseline, self).__init__()
 
         self.baseline = baseline
         assert n_epochs > 0, "n_epochs to warmup must be positive"
-        self.warmup_baseline = ExponentialBaseline(warmup_exp_beta)
+        self.warmup_baseline = ExponentialBaseline(warmup_exp_beta, accumulation_steps)
         self.alpha = 0
         self.n_epochs = n_epochs
 
@@ -67,9 +85,17 @@ class WarmupBaseline(Baseline):
             self.alpha * t + (1 - self.alpha * lw),
         )
 
+    def eval_batch(self, x, c, bl_val):
+        if bl_val is None or self.alpha >= 1:
+            return super(WarmupBaseline, self).eval_batch(x, c, bl_val)
+        # The cached values of the inner baseline are blended with the warmup baseline as in eval
+        vw, lw = self.warmup_baseline.eval(x, c)
+        return self.alpha * bl_val + (1 - self.alpha) * vw, (1 - self.alpha) * lw
+
     def epoch_callback(self, model, epoch):
         # Need to call epoch callback of inner model (also after first epoch if we have not used it)
         self.baseline.epoch_callback(model, epoch)
+        self.warmup_baseline.epoch_callback(model, epoch)
         self.alpha = (epoch + 1) / float(self.n_epochs)
         if epoch < self.n_epochs:
             print("Set warmup alpha = {}".format(self.alpha))
@@ -89,21 +115,60 @@ class NoBaseline(Baseline):
 
 
 class ExponentialBaseline(Baseline):
-    def __init__(self, beta):
+    def __init__(self, beta, accumulation_steps=1, num_members=1):
         super(Baseline, self).__init__()
 
         self.beta = beta
         self.v = None
+        self.accumulation_steps = accumulation_steps
+        self.window = []  # Mean costs of the micro-batches of the current effective batch
+        self.num_members = num_members  # Every member of an ensemble has its own baseline
+
+    def _mean(self, c):
+        if self.num_members == 1:
+            return c.mean().detach()
+        # Member k decodes trajectories k * batch_size + b
+        return c.detach().view(self.num_members, -1).mean(1)
+
+    def _expand(self, v, c):
+        if self.num_members == 1 or v is None:
+            return v
+        return v.repeat_interleave(c.size(0) // self.num_members)
 
     def eval(self, x, c):
 
+        if self.accumulation_steps > 1:
+            return self._eval_accumulated(c)
+        # The mean cost is over the batches of all ranks when distributed
+        m = all_reduce_mean(self._mean(c))
         if self.v is None:
-            v = c.mean()
+            v = m
         else:
-            v = self.beta * self.v + (1.0 - self.beta) * c.mean()
+            v = self.beta * self.v + (1.0 - self.beta) * m
 
         self.v = v.detach()  # Detach since we never want to backprop
-        return self.v, 0  # No loss
+        return self._expand(self.v, c), 0  # No loss
+
+    def _eval_accumulated(self, c):
+        """
+        With gradient accumulation every micro-batch of an effective batch is compared to the same value
+        (the baseline after the previous effective batch), which is updated once the effective batch is complete.
+        """
+        self.window.append(all_reduce_mean(self._mean(c)))
+        v = self.v if self.v is not None else torch.stack(self.window).mean(0)
+        if len(self.window) == self.accumulation_steps:
+            self._update()
+        return self._expand(v, c), 0  # No loss
+
+    def _update(self):
+        m = torch.stack(self.window).mean(0)
+        self.v = m if self.v is None else self.beta * self.v + (1.0 - self.beta) * m
+        self.window = []
+
+    def epoch_callback(self, model, epoch):
+        # The last effective batch of an epoch may be incomplete
+        if len(self.window) > 0:
+            self._update()
 
     def state_dict(self):
         return {"v": self.v}
@@ -152,16 +217,42 @@ class GreedyBaseline(Baseline):
 
 
 class RolloutBaseline(Baseline):
+    """
+    Greedy rollout of a frozen copy of the best model so far.
+
+    The baseline values of the training instances are cached together with the version of the baseline model
+    that computed them, so they are only recomputed when the baseline model is replaced. With opts.bl_background
+    the challenge of the baseline by the candidate model runs in a background thread overlapped with the next
+    epoch (which still uses the current baseline), and with opts.bl_early_stop the t-test is stopped as soon as
+    it is decisive on a prefix of the evaluation dataset.
+    """
+
     def __init__(self, model, problem, opts, epoch=0):
         super(Baseline, self).__init__()
 
         self.problem = problem
         self.opts = opts
+        self.version = -1
+        # id of the training dataset of the current epoch -> (dataset, values, version of each value)
+        self.cache = {}
+        self.pool = ThreadPool(1) if opts.bl_background else None
+        self.pending = None
 
         self._update_model(model, epoch)
 
     def _update_model(self, model, epoch, dataset=None):
-        self.model = copy.deepcopy(model)
+        self._set_baseline(*self._make_baseline(model, epoch, dataset))
+
+    def _set_baseline(self, model, dataset, bl_vals, epoch):
+        self.model = model
+        self.dataset = dataset
+        self.bl_vals = bl_vals
+        self.mean = self.bl_vals.mean()
+        self.epoch = epoch
+        self.version += 1
+
+    def _make_baseline(self, model, epoch, dataset=None):
+        model = copy.deepcopy(model)
         # Always generate baseline dataset when updating model to prevent overfitting to the baseline dataset
 
         if dataset is not None:
@@ -179,7 +270,7 @@ class RolloutBaseline(Baseline):
                 dataset = None
 
         if dataset is None:
-            self.dataset = DataLoader(
+            dataset = DataLoader(
                 self.problem.make_dataset(
                     None,
                     self.opts.val_size,
@@ -188,33 +279,55 @@ class RolloutBaseline(Baseline):
                     opts=self.opts,
                 ),
                 batch_size=self.opts.eval_batch_size,
-                num_workers=1,
+                num_workers=_loader_workers(),
             )
-        else:
-            self.dataset = dataset
         print("Evaluating baseline model on evaluation dataset")
-        self.bl_vals = (
-            rollout(self.model, self.dataset, self.opts)[0].cpu().numpy() / 100.0
-        )
-        self.mean = self.bl_vals.mean()
-        self.epoch = epoch
+        bl_vals = rollout(model, dataset, self.opts)[0].cpu().numpy() / 100.0
+        return model, dataset, bl_vals, epoch
 
-    def wrap_dataset(self, dataset):
-        print("Evaluating baseline on dataset...")
+    def _rollout_values(self, model, dataset):
         # Need to convert baseline to 2D to prevent converting to double, see
         # https://discuss.pytorch.org/t/dataloader-gives-double-instead-of-float/717/3
         dataloader = DataLoader(
-            dataset, batch_size=self.opts.eval_batch_size, num_workers=1
+            dataset,
+            batch_size=self.opts.eval_batch_size,
+            num_workers=_loader_workers(),
         )
-        return BaselineDataset(
-            dataset, rollout(self.model, dataloader, self.opts)[0].view(-1, 1)
-        )
-        # return dataset
+        return rollout(model, dataloader, self.opts)[0].view(-1, 1).cpu()
+
+    def wrap_dataset(self, dataset):
+        self._apply_pending(wait=False)
+        dataset_id = id(dataset)
+        if dataset_id not in self.cache or self.cache[dataset_id][0] is not dataset:
+            # Only the values of the current training dataset are kept, the previous datasets can be freed
+            self.cache = {
+                dataset_id: (
+                    dataset,
+                    torch.zeros(len(dataset), 1),
+                    torch.full((len(dataset),), -1, dtype=torch.long),
+                )
+            }
+        _, values, versions = self.cache[dataset_id]
+        stale = (versions != self.version).nonzero(as_tuple=False).squeeze(1)
+        if len(stale) > 0:
+            print(
+                "Evaluating baseline on {} instances of the dataset...".format(
+                    len(stale)
+                )
+            )
+            values[stale] = self._rollout_values(
+                self.model,
+                dataset
+                if len(stale) == len(dataset)
+                else Subset(dataset, stale.tolist()),
+            )
+            versions[stale] = self.version
+        return BaselineDataset(dataset, values)
 
     def unwrap_batch(self, batch):
         return (
             batch["data"],
-            None,
+            batch["baseline"].view(-1),
         )  # Flatten result to undo wrapping as 2D
 
     def eval(self, x, c):
@@ -231,28 +344,110 @@ class RolloutBaseline(Baseline):
         :param model: The model to challenge the baseline by
         :param epoch: The current epoch
         """
+        # The previous challenge has to be settled before the next one
+        self._apply_pending(wait=True)
+        candidate = copy.deepcopy(model)
+        # wrap_dataset can add training datasets to the cache while the challenge runs in the background
+        datasets = [
+            (dataset_id, dataset) for dataset_id, (dataset, _, _) in self.cache.items()
+        ]
+        if self.pool is None:
+            self._apply(self._challenge(candidate, epoch, datasets))
+        else:
+            self.pending = self.pool.apply_async(
+                self._challenge, (candidate, epoch, datasets)
+            )
+
+    def _apply_pending(self, wait):
+        if self.pending is None or not (wait or self.pending.ready()):
+            return
+        result = self.pending.get()
+        self.pending = None
+        self._apply(result)
+
+    def _apply(self, result):
+        if result is None:
+            return
+        new_baseline, train_values = result
+        self._set_baseline(*new_baseline)
+        # Values of the training instances already computed with the new baseline
+        for dataset_id, (dataset, values) in train_values.items():
+            if self.cache.get(dataset_id, (None,))[0] is not dataset:
+                continue  # The dataset was replaced during the challenge
+            self.cache[dataset_id] = (
+                dataset,
+                values,
+                torch.full((len(values),), self.version, dtype=torch.long),
+            )
+
+    def _evaluate_candidate(self, candidate, epoch):
+        """
+        Greedy rollouts of the candidate on the evaluation dataset, one batch at a time so that the comparison
+        with the baseline can stop as soon as the t-test on the prefix evaluated so far is decisive.
+        """
         print("Evaluating candidate model on evaluation dataset")
-        candidate_vals = (
-            rollout(model, self.dataset, self.opts)[0].cpu().numpy() / 100.0
-        )
+        candidate_vals = []
+        for i, batch in enumerate(self.dataset):
+            candidate_vals.append(
+                rollout(candidate, [batch], self.opts)[0].cpu().numpy() / 100.0
+            )
+            vals = np.concatenate(candidate_vals)
+            if (
+                not self.opts.bl_early_stop
+                or i + 1 == len(self.dataset)
+                or len(vals) < 2
+            ):
+                continue
+            t, p = ttest_rel(vals, self.bl_vals[: len(vals)])
+            # The prefix is tested after every batch, so stopping early needs a much smaller p-value
+            if p / 2 < self.opts.bl_alpha / 10:
+                print(
+                    "Epoch {} t-test decisive after {} instances".format(
+                        epoch, len(vals)
+                    )
+                )
+                break
+        vals = np.concatenate(candidate_vals)
+        return vals, self.bl_vals[: len(vals)]
+
+    def _challenge(self, candidate, epoch, datasets):
+        """
+        :param datasets: the (id, dataset) of the cached training datasets
+        :return: None if the baseline is kept, otherwise the new baseline and the values of the cached
+        training instances under it
+        """
+        candidate_vals, bl_vals = self._evaluate_candidate(candidate, epoch)
 
         candidate_mean = candidate_vals.mean()
 
         print(
             "Epoch {} candidate mean {}, baseline epoch {} mean {}, difference {}".format(
-                epoch, candidate_mean, self.epoch, self.mean, candidate_mean - self.mean
+                epoch,
+                candidate_mean,
+                self.epoch,
+                bl_vals.mean(),
+                candidate_mean - bl_vals.mean(),
             )
         )
-        if candidate_mean - self.mean < 0:
+        update = False
+        if candidate_mean - bl_vals.mean() < 0:
             # Calc p value
-            t, p = ttest_rel(candidate_vals, self.bl_vals)
+            t, p = ttest_rel(candidate_vals, bl_vals)
 
             p_val = p / 2  # one-sided
             assert t < 0, "T-statistic should be negative"
             print("p-value: {}".format(p_val))
-            if p_val < self.opts.bl_alpha:
-                print("Update baseline")
-                self._update_model(model, epoch)
+            update = p_val < self.opts.bl_alpha
+        # All ranks replace their baseline model together, following the decision of rank 0
+        if not broadcast_object(update):
+            return None
+        print("Update baseline")
+        new_baseline = self._make_baseline(candidate, epoch)
+        train_values = {
+            dataset_id: (dataset, self._rollout_values(new_baseline[0], dataset))
+            for dataset_id, dataset in datasets
+        }
+        return new_baseline, train_values
 
     def state_dict(self):
         return {"model": self.model, "dataset": self.dataset, "epoch": self.epoch}
@@ -0,0 +1,40 @@
+import functools
+from contextlib import contextmanager
+
+import torch
+
+# (batch, its initial state) while several models are evaluated on the batch
+_shared = None
+
+
+@contextmanager
+def shared_initial_state(problem, input, opts):
+    """
+    Builds the initial state (dense adjacency, features) of a batch once, the models run on the batch in the block
+    start from copies of it instead of rebuilding it.
+    """
+    global _shared
+    _shared = (input, problem.make_state(input, opts.u_size, opts.v_size, opts))
+    try:
+        yield
+    finally:
+        _shared = None
+
+
+def reuse_initial_state(make_state):
+    """
+    Decorator of make_state returning a copy of the shared initial state of the batch, if there is one. States
+    are updated in place, every episode needs its own tensors.
+    """
+
+    @functools.wraps(make_state)
+    def wrapper(input, *args, **kwargs):
+        shared = _shared is not None and _shared[0] is input
+        if not shared or kwargs.get("num_rollouts", 1) != 1:
+            return make_state(input, *args, **kwargs)
+        state = _shared[1]
+        return state._replace(
+            **{k: v.clone() for k, v in state._asdict().items() if torch.is_tensor(v)}
+        )
+
+    return wrapper
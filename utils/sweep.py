@@ -0,0 +1,154 @@
+import os
+import copy
+import json
+import sqlite3
+import torch
+import torch.multiprocessing as mp
+
+from train import train_epoch, get_inner_model
+from utils.functions import torch_load_cpu
+from utils.log_utils import MetricsLogger
+from utils.distributed import make_training_dataloader
+
+# Filled in by _init_worker in every worker process. The workers are spawned, torch.multiprocessing moves the
+# tensors of the training dataset to shared memory instead of copying them into every worker
+_SWEEP = {}
+
+
+def _init_worker(sweep):
+    _SWEEP.update(sweep)
+
+
+def _train_trial(job):
+    """
+    Trains a configuration from epoch start_epoch to end_epoch, resuming from the checkpoint of its last rung.
+    :return: (trial_id, avg_reward, min_cr, avg_cr) of the last epoch
+    """
+    trial_id, params, start_epoch, end_epoch = job
+    opts = copy.copy(_SWEEP["opts"])
+    for k, v in params.items():
+        setattr(opts, k, v)
+    opts.save_dir = os.path.join(opts.sweep_dir, "trial-{}".format(trial_id))
+    opts.no_tensorboard = True
+    opts.no_progress_bar = True
+    os.makedirs(opts.save_dir, exist_ok=True)
+    torch.set_num_threads(max(1, os.cpu_count() // opts.sweep_workers))
+    torch.manual_seed(opts.seed)
+
+    checkpoint = os.path.join(opts.save_dir, "trial.pt")
+    load_data = torch_load_cpu(checkpoint) if os.path.exists(checkpoint) else {}
+    model, lr_schedulers, optimizers, val_dataloader, baseline = _SWEEP["setup"](
+        opts, _SWEEP["model_class"], _SWEEP["problem"], load_data, None
+    )
+    if "lr_scheduler" in load_data:
+        lr_schedulers[0].load_state_dict(load_data["lr_scheduler"])
+    best_avg_cr = load_data.get("best_avg_cr", 0.0)
+    # The batch metrics of a trial go to its own CSV file
+    metrics = MetricsLogger(
+        csv_path=os.path.join(opts.save_dir, "metrics.csv"), flush_every=opts.log_step
+    )
+    for epoch in range(start_epoch, end_epoch):
+        training_dataloader = make_training_dataloader(
+            baseline.wrap_dataset(_SWEEP["dataset"]), epoch, opts
+        )
+        avg_reward, min_cr, avg_cr, _ = train_epoch(
+            model,
+            optimizers,
+            baseline,
+            lr_schedulers,
+            epoch,
+            val_dataloader,
+            training_dataloader,
+            _SWEEP["problem"],
+            metrics,
+            opts,
+            best_avg_cr,
+        )
+        best_avg_cr = max(best_avg_cr, float(avg_cr))
+    metrics.close()
+    torch.save(
+        {
+            "model": get_inner_model(model).state_dict(),
+            "optimizer": optimizers[0].state_dict(),
+            "lr_scheduler": lr_schedulers[0].state_dict(),
+            "baseline": baseline.state_dict(),
+            "best_avg_cr": best_avg_cr,
+        },
+        checkpoint,
+    )
+    return trial_id, float(avg_reward), float(min_cr), float(avg_cr)
+
+
+def open_results_table(path):
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS trials ("
+        "run_name TEXT, trial_id INTEGER, params TEXT, rung INTEGER, epochs INTEGER, "
+        "avg_reward REAL, min_cr REAL, avg_cr REAL, PRIMARY KEY (run_name, params, rung))"
+    )
+    return conn
+
+
+def run_sweep(param_grid, setup_training_env, model_class, problem, training_dataset, opts):
+    """
+    Successive halving over the configurations of param_grid (dicts of option values) with a pool of
+    opts.sweep_workers processes. Every rung trains the surviving configurations for opts.sweep_eta times more
+    epochs than the previous one and keeps the best 1 / opts.sweep_eta of them by validation avg_cr, until
+    opts.n_epochs epochs are reached. Results are written to the trials table of opts.sweep_results.
+    :return: the best configuration and its avg_cr
+    """
+    opts.sweep_dir = os.path.join(opts.save_dir, "sweep")
+    os.makedirs(opts.sweep_dir, exist_ok=True)
+    conn = open_results_table(opts.sweep_results)
+
+    final_epoch = opts.epoch_start + opts.n_epochs
+    alive = list(range(len(param_grid)))
+    start, budget, rung = opts.epoch_start, opts.sweep_min_epochs, 0
+    sweep = dict(
+        opts=opts,
+        setup=setup_training_env,
+        model_class=model_class,
+        problem=problem,
+        dataset=training_dataset,
+    )
+    # Not fork, torch has started its thread pools (and maybe CUDA) in this process
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(
+        opts.sweep_workers, initializer=_init_worker, initargs=(sweep,)
+    ) as pool:
+        while True:
+            end = min(opts.epoch_start + budget, final_epoch)
+            jobs = [(i, param_grid[i], start, end) for i in alive]
+            avg_crs = {}
+            for trial_id, avg_reward, min_cr, avg_cr in pool.imap_unordered(
+                _train_trial, jobs
+            ):
+                avg_crs[trial_id] = avg_cr
+                conn.execute(
+                    "INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        opts.run_name,
+                        trial_id,
+                        json.dumps(param_grid[trial_id]),
+                        rung,
+                        end - opts.epoch_start,
+                        avg_reward,
+                        min_cr,
+                        avg_cr,
+                    ),
+                )
+                conn.commit()
+            alive = sorted(alive, key=lambda i: avg_crs[i], reverse=True)
+            print(
+                "Rung {}: {} configurations trained for {} epochs, best avg_cr {:.4f}".format(
+                    rung, len(jobs), end - opts.epoch_start, avg_crs[alive[0]]
+                )
+            )
+            if end == final_epoch or len(alive) == 1:
+                break
+            alive = alive[: max(1, len(alive) // opts.sweep_eta)]
+            start, budget, rung = end, budget * opts.sweep_eta, rung + 1
+    conn.close()
+    best = alive[0]
+    print("Best configuration: {}, avg_cr {:.4f}".format(param_grid[best], avg_crs[best]))
+    return param_grid[best], avg_crs[best]